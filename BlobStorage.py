@@ -0,0 +1,137 @@
+import logging
+import os
+import asyncio
+import threading
+import weakref
+
+# Size of the keep-alive connection pool shared by every upload of the worker
+CONNECTION_POOL_SIZE = int(os.environ.get("BLOB_CONNECTION_POOL_SIZE", 32))
+
+# Create the container on first use, for local storage emulators (Azurite) that start empty
+CREATE_CONTAINER = os.environ.get("BLOB_CREATE_CONTAINER", "false").lower() == "true"
+
+
+# Storage clients created once per worker and reused by every invocation, so uploads don't pay for
+# a new client, connection pool and TLS handshake each time. The connection string can point to
+# Azure Storage or to a local emulator ("UseDevelopmentStorage=true" for Azurite).
+# The storage SDK is imported when the first client is created, so cold starts that don't touch storage skip it.
+class BlobStorage:
+    def __init__(self, connection_string=None, pool_size=CONNECTION_POOL_SIZE):
+        self.connection_string = connection_string
+        self.pool_size = pool_size
+        self._service_client = None
+        self._container_clients = {}
+        self._async_service_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _get_connection_string(self):
+        return self.connection_string or os.environ["BLOB_CONNECTION_STRING"]
+
+    # Function to create the service client on a pooled keep-alive session
+    def _create_service_client(self):
+        import requests
+        from azure.core.pipeline.transport import RequestsTransport
+        from azure.storage.blob import BlobServiceClient
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        transport = RequestsTransport(session=session, session_owner=False)
+        logging.info("Creating pooled Blob Storage client.")
+        return BlobServiceClient.from_connection_string(self._get_connection_string(), transport=transport)
+
+    # Function to get the shared container client, creating it on first use
+    def get_container_client(self, container_name=None):
+        container_name = container_name or os.environ["BLOB_CONTAINER_NAME"]
+        container_client = self._container_clients.get(container_name)
+        if container_client is not None:
+            return container_client
+
+        with self._lock:
+            if self._service_client is None:
+                self._service_client = self._create_service_client()
+            if container_name not in self._container_clients:
+                from azure.core.exceptions import ResourceExistsError
+
+                container_client = self._service_client.get_container_client(container_name)
+                if CREATE_CONTAINER:
+                    try:
+                        container_client.create_container()
+                    except ResourceExistsError:
+                        pass
+                self._container_clients[container_name] = container_client
+            return self._container_clients[container_name]
+
+    # Function to get the async container client of the running event loop (the async clients are bound to a loop)
+    def get_async_container_client(self, container_name=None):
+        from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient        # Needs aiohttp
+
+        container_name = container_name or os.environ["BLOB_CONTAINER_NAME"]
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            service_client = self._async_service_clients.get(loop)
+            if service_client is None:
+                service_client = AsyncBlobServiceClient.from_connection_string(self._get_connection_string())
+                self._async_service_clients[loop] = service_client
+        return service_client.get_container_client(container_name)
+
+    # Function to drop the shared clients, so the next call reconnects with a fresh connection pool
+    def reset(self):
+        with self._lock:
+            service_client = self._service_client
+            self._service_client = None
+            self._container_clients = {}
+        if service_client is not None:
+            try:
+                service_client.close()
+            except Exception as e:
+                logging.warning(f"Failed to close the Blob Storage client: {e}")
+
+    # Function to upload a blob with the shared client, reconnecting once if the pooled connections are broken
+    def upload_blob(self, blob_name, data, container_name=None, **upload_options):
+        from azure.core.exceptions import ServiceRequestError
+
+        upload_options.setdefault("overwrite", True)
+        try:
+            blob_client = self.get_container_client(container_name).get_blob_client(blob_name)
+            blob_client.upload_blob(data, **upload_options)
+        except ServiceRequestError as e:
+            logging.warning(f"Blob Storage connection failed, reconnecting: {e}")
+            self.reset()
+            blob_client = self.get_container_client(container_name).get_blob_client(blob_name)
+            blob_client.upload_blob(data, **upload_options)
+        return blob_client
+
+    # Async variant of upload_blob
+    async def upload_blob_async(self, blob_name, data, container_name=None, **upload_options):
+        upload_options.setdefault("overwrite", True)
+        blob_client = self.get_async_container_client(container_name).get_blob_client(blob_name)
+        await blob_client.upload_blob(data, **upload_options)
+        return blob_client
+
+    # Function to check that the storage account and container are reachable, reconnecting if they are not
+    def check_health(self, container_name=None):
+        try:
+            self.get_container_client(container_name).get_container_properties()
+            return True
+        except Exception as e:
+            logging.error(f"Blob Storage health check failed: {e}")
+            self.reset()
+            return False
+
+
+# Clients shared by all the requests handled by this worker
+blob_storage = BlobStorage()
+
+
+def getContainerClient(container_name=None):
+    return blob_storage.get_container_client(container_name)
+
+
+def uploadBlob(blob_name, data, container_name=None, **upload_options):
+    return blob_storage.upload_blob(blob_name, data, container_name, **upload_options)
+
+
+async def uploadBlobAsync(blob_name, data, container_name=None, **upload_options):
+    return await blob_storage.upload_blob_async(blob_name, data, container_name, **upload_options)
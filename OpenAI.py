@@ -1,23 +1,215 @@
 import logging
 import os
-from openai import AzureOpenAI
+import time
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
 
-client = AzureOpenAI(
-    api_key=os.environ["AZURE_OPENAI_KEY"],
-    azure_endpoint=os.environ['AZURE_OPENAI_API_BASE'],
-    api_version=os.environ['AZURE_OPENAI_API_VERSION']   
+# The openai SDK takes about half a second to import, so the client is created on the first GPT call
+# instead of on every cold start (validation requests never need it)
+client = None
+client_lock = threading.Lock()
+
+
+def getClient():
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                from openai import AzureOpenAI
+                client = AzureOpenAI(
+                    api_key=os.environ["AZURE_OPENAI_KEY"],
+                    azure_endpoint=os.environ['AZURE_OPENAI_API_BASE'],
+                    api_version=os.environ['AZURE_OPENAI_API_VERSION']   
+                )
+    return client
+
+# Number of times a throttled or failed call is retried
+MAX_RETRIES = 5
+
+
+# Client-side limiter for the deployment's requests-per-minute and tokens-per-minute quota.
+# A single instance is shared by every thread and coroutine of the worker, so throttling is coordinated
+# instead of every call backing off on its own.
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute or 0)
+        self._available_tokens = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # Refill both buckets for the time elapsed since the last update
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._available_requests = min(self.requests_per_minute, self._available_requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._available_tokens = min(self.tokens_per_minute, self._available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    # Try to reserve capacity for a call, returning how long to wait before trying again (0 if reserved)
+    def _reserve(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+
+            wait = 0.0
+            if self.requests_per_minute and self._available_requests < 1:
+                wait = max(wait, (1 - self._available_requests) * 60 / self.requests_per_minute)
+            if self.tokens_per_minute:
+                # A call larger than the whole quota only waits for a full bucket
+                needed = min(tokens, self.tokens_per_minute)
+                if self._available_tokens < needed:
+                    wait = max(wait, (needed - self._available_tokens) * 60 / self.tokens_per_minute)
+            if wait > 0:
+                return wait
+
+            if self.requests_per_minute:
+                self._available_requests -= 1
+            if self.tokens_per_minute:
+                self._available_tokens -= tokens
+            return 0.0
+
+    # Block the calling thread until the call fits within the quota
+    def acquire(self, tokens):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    # Wait without blocking the event loop until the call fits within the quota
+    async def acquire_async(self, tokens):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    # Correct the token bucket once the actual usage of a call is known
+    def reconcile(self, estimated_tokens, actual_tokens):
+        if not self.tokens_per_minute:
+            return
+        with self._lock:
+            self._available_tokens = min(self.tokens_per_minute, self._available_tokens + estimated_tokens - actual_tokens)
+
+    # Hold back every caller until the retry-after period has passed
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def _env_limit(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+# Limiter shared by all the GPT calls made by this worker (no limits unless the quota is configured)
+rate_limiter = RateLimiter(
+    requests_per_minute=_env_limit("AZURE_OPENAI_RPM_LIMIT"),
+    tokens_per_minute=_env_limit("AZURE_OPENAI_TPM_LIMIT")
 )
 
+
+# Estimate the tokens a call counts against the TPM quota: the prompt plus the completion tokens reserved
+def estimateRequestTokens(gptOptions):
+    prompt_characters = sum(len(str(message.get('content', ''))) for message in gptOptions['messages'])
+    prompt_tokens = prompt_characters // 4 + 4 * len(gptOptions['messages'])    # ~4 characters per token plus message overhead
+    return prompt_tokens + gptOptions['max_tokens']
+
+
+# Estimate the usage of a streamed call whose usage chunk never arrived: the prompt estimate plus ~4 characters per
+# completion token streamed. It is what the limiter is corrected with, and what the request metrics record.
+def estimateStreamUsage(gptOptions, streamedCharacters):
+    prompt_tokens = estimateRequestTokens(gptOptions) - gptOptions['max_tokens']
+    completion_tokens = streamedCharacters // 4
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+
+
+# Streamed usage (stream_options) is only accepted from this api-version on, older versions reject the request
+STREAM_USAGE_MIN_API_VERSION = '2024-09-01'
+
+
+def supportsStreamUsage():
+    return os.environ.get('AZURE_OPENAI_API_VERSION', '')[:10] >= STREAM_USAGE_MIN_API_VERSION
+
+
+# Read the retry-after period (in seconds) from a throttled response
+def getRetryAfter(error, attempt):
+    headers = error.response.headers if getattr(error, 'response', None) is not None else {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return getBackoff(attempt)
+
+
+# Exponential backoff with jitter for errors without a retry-after period
+def getBackoff(attempt):
+    return min(60, 2 ** attempt) + random.uniform(0, 1)
+
+
+# Settings that are only sent when provided
+def getOptionalOptions(gptOptions):
+    optional_options = {}
+    if gptOptions.get('seed') is not None:
+        optional_options['seed'] = gptOptions['seed']
+    return optional_options
+
+
+# Create a chat completion within the shared quota, retrying throttled and failed calls
+def createChatCompletion(gptOptions, estimated_tokens, **extra_options):
+    from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+
+    attempt = 0
+    while True:
+        # Wait for quota before sending, so concurrent calls don't run into 429s
+        rate_limiter.acquire(estimated_tokens)
+        try:
+            # Retries are handled here, so throttling is coordinated through the shared limiter
+            return getClient().with_options(max_retries=0).chat.completions.create(    
+                model=gptOptions['engine'],    
+                messages=gptOptions['messages'],    
+                temperature=gptOptions['temperature'],    
+                max_tokens=gptOptions['max_tokens'],
+                **extra_options
+            )
+        except Exception as e:
+            # The failed call generated nothing, so its reservation is given back before the retry reserves again
+            # (the caller only reconciles the reservation of the call that succeeds)
+            rate_limiter.reconcile(estimated_tokens, 0)
+            if attempt >= MAX_RETRIES or not isinstance(e, (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)):
+                raise
+            if isinstance(e, RateLimitError):
+                retry_after = getRetryAfter(e, attempt)
+                logging.info('GPT endpoint throttled, pausing calls for %.1f seconds', retry_after)
+                rate_limiter.pause(retry_after)
+            else:
+                backoff = getBackoff(attempt)
+                logging.info('GPT endpoint call failed (%s), retrying in %.1f seconds', str(e), backoff)
+                time.sleep(backoff)
+        attempt += 1
+
+
 def callGptEndpoint(gptOptions):  
     try:  
         logging.info('GPT endpoint call initiating with engine %s',  str(gptOptions['engine']))
         
-        response = client.with_options(max_retries=5).chat.completions.create(    
-            model=gptOptions['engine'],    
-            messages=gptOptions['messages'],    
-            temperature=gptOptions['temperature'],    
-            max_tokens=gptOptions['max_tokens']
-        )
+        estimated_tokens = estimateRequestTokens(gptOptions)
+        response = createChatCompletion(gptOptions, estimated_tokens, **getOptionalOptions(gptOptions))
+
+        # Give back the tokens reserved but not used
+        if getattr(response, 'usage', None):
+            rate_limiter.reconcile(estimated_tokens, response.usage.total_tokens)
 
         logging.info('GPT endpoint call successful with engine %s',  str(gptOptions['engine']))
         logging.info(type(response))
@@ -25,4 +217,39 @@ def callGptEndpoint(gptOptions):
     
     except Exception as e:   
         logging.info('Unexpected error calling GPT endpoint:   %s',  str(e))
-        raise e
\ No newline at end of file
+        raise e
+
+
+# Stream a chat completion chunk by chunk. Closing the generator early closes the connection,
+# so the remaining completion tokens are not generated.
+def callGptEndpointStream(gptOptions):
+    logging.info('GPT endpoint streaming call initiating with engine %s',  str(gptOptions['engine']))
+
+    estimated_tokens = estimateRequestTokens(gptOptions)
+    stream_options = {'stream_options': {'include_usage': True}} if supportsStreamUsage() else {}
+    try:
+        stream = createChatCompletion(
+            gptOptions,
+            estimated_tokens,
+            stream=True,
+            **stream_options,
+            **getOptionalOptions(gptOptions)
+        )
+    except Exception as e:
+        logging.info('Unexpected error calling GPT endpoint:   %s',  str(e))
+        raise e
+
+    usage = None
+    streamed_characters = 0
+    try:
+        for chunk in stream:
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                streamed_characters += len(chunk.choices[0].delta.content)
+            yield chunk
+    finally:
+        stream.close()
+        # The usage chunk is only sent at the end of the stream, so estimate it if the stream was closed early
+        usage = usage or estimateStreamUsage(gptOptions, streamed_characters)
+        rate_limiter.reconcile(estimated_tokens, usage.total_tokens)
\ No newline at end of file
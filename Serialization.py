@@ -0,0 +1,71 @@
+import logging
+import os
+import json
+import gzip
+import azure.functions as func
+
+# Optional faster JSON backend, used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Serialization settings, overridable through the app settings
+JSON_BACKEND = os.environ.get("FHIR_JSON_BACKEND", "auto")                        # auto, json or orjson
+PRETTY_JSON = os.environ.get("FHIR_JSON_PRETTY", "false").lower() == "true"       # Indent for human readers, at the cost of size
+GZIP_BLOBS = os.environ.get("FHIR_BLOB_GZIP", "false").lower() == "true"
+GZIP_RESPONSES = os.environ.get("FHIR_RESPONSE_GZIP", "true").lower() == "true"
+GZIP_MIN_BYTES = int(os.environ.get("FHIR_GZIP_MIN_BYTES", 1024))                 # Smaller payloads are not worth compressing
+GZIP_LEVEL = int(os.environ.get("FHIR_GZIP_LEVEL", 6))
+
+if JSON_BACKEND == "orjson" and orjson is None:
+    logging.warning("FHIR_JSON_BACKEND is orjson but orjson is not installed, falling back to json.")
+USE_ORJSON = orjson is not None and JSON_BACKEND in ("auto", "orjson")
+
+
+# Function to serialize data to JSON bytes, compact unless pretty output is configured
+def dumpJsonBytes(data, pretty=None):
+    pretty = PRETTY_JSON if pretty is None else pretty
+    if USE_ORJSON:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0)
+        except TypeError:
+            pass        # Values orjson doesn't support (e.g. integers over 64 bits) go through json
+    if pretty:
+        return json.dumps(data, indent=2).encode("utf-8")
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+# Function to serialize data to a JSON string, for HTTP response bodies
+def dumpJson(data, pretty=None):
+    return dumpJsonBytes(data, pretty).decode("utf-8")
+
+
+# Function to encode data for a blob upload, returning the body and its content settings (gzip if configured)
+def encodeJsonBlob(data, content_type="application/fhir+json"):
+    from azure.storage.blob import ContentSettings        # Imported on first upload, to keep cold starts short
+
+    body = dumpJsonBytes(data)
+    if GZIP_BLOBS:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), ContentSettings(content_type=content_type, content_encoding="gzip")
+    return body, ContentSettings(content_type=content_type)
+
+
+# Function to gzip an HTTP response body if the client accepts it and the body is large enough
+def compressResponse(req, response):
+    if not GZIP_RESPONSES or "gzip" not in req.headers.get("Accept-Encoding", "").lower():
+        return response
+    body = response.get_body()
+    if len(body) < GZIP_MIN_BYTES or response.headers.get("Content-Encoding"):
+        return response
+
+    headers = dict(response.headers)
+    headers["Content-Encoding"] = "gzip"
+    headers["Vary"] = "Accept-Encoding"
+    return func.HttpResponse(
+        gzip.compress(body, compresslevel=GZIP_LEVEL),
+        status_code=response.status_code,
+        headers=headers,
+        mimetype=response.mimetype,
+        charset=response.charset
+    )
@@ -0,0 +1,70 @@
+# Micro-benchmark of the bundle serialization options: size and encode time of pretty, compact and gzipped JSON,
+# with the standard json module and with orjson when installed.
+# Run from the repository root: python benchmarks/serialization_benchmark.py [bundle_count]
+import os
+import sys
+import json
+import gzip
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fhir_data_generation.offline_resource_generation import generate_offline_resource
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Function to build a bundle like the generation API does: a patient and one of each included resource type
+def build_bundle(rng):
+    patient = generate_offline_resource("Patient", rng=rng)
+    resources = [patient]
+    for resource_type in ("Condition", "Encounter", "Appointment", "ServiceRequest", "MedicationRequest", "AllergyIntolerance"):
+        resources.append(generate_offline_resource(resource_type, patient["id"], rng=rng))
+    for observation_type in ("heart_rate", "blood_pressure", "laboratory"):
+        resources.append(generate_offline_resource("Observation", patient["id"], observation_type=observation_type, rng=rng))
+    return {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [{"fullUrl": f"urn:uuid:{resource['id']}", "resource": resource} for resource in resources]
+    }
+
+
+def time_encoder(encode, bundles, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        encoded = [encode(bundle) for bundle in bundles]
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, sum(len(body) for body in encoded)
+
+
+def main():
+    bundle_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rng = random.Random(42)
+    bundles = [build_bundle(rng) for _ in range(bundle_count)]
+
+    encoders = {
+        "json indent=2": lambda bundle: json.dumps(bundle, indent=2).encode("utf-8"),
+        "json compact": lambda bundle: json.dumps(bundle, separators=(",", ":")).encode("utf-8"),
+        "json compact + gzip": lambda bundle: gzip.compress(json.dumps(bundle, separators=(",", ":")).encode("utf-8"), compresslevel=6)
+    }
+    if orjson is not None:
+        encoders["orjson indent=2"] = lambda bundle: orjson.dumps(bundle, option=orjson.OPT_INDENT_2)
+        encoders["orjson compact"] = orjson.dumps
+        encoders["orjson compact + gzip"] = lambda bundle: gzip.compress(orjson.dumps(bundle), compresslevel=6)
+
+    baseline_bytes = None
+    print(f"{bundle_count} bundles of {len(bundles[0]['entry'])} resources")
+    print(f"{'encoder':<24}{'bytes/bundle':>14}{'size':>8}{'ms/bundle':>12}")
+    for name, encode in encoders.items():
+        elapsed, total_bytes = time_encoder(encode, bundles)
+        baseline_bytes = baseline_bytes or total_bytes
+        print(f"{name:<24}{total_bytes // bundle_count:>14}{total_bytes / baseline_bytes:>8.0%}{elapsed * 1000 / bundle_count:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
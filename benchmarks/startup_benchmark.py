@@ -0,0 +1,76 @@
+# Startup benchmark: import time of the function app and of each of its modules, measured in fresh interpreters
+# with `python -X importtime`, as a cold start would pay it. Reports the best of several runs.
+# Run from the repository root: python benchmarks/startup_benchmark.py [runs]
+import os
+import sys
+import subprocess
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules imported by the function host at startup, plus the SDKs they may pull in
+MODULES = [
+    "function_app",
+    "fhir_data_generation.fhir_resource_generation",
+    "fhir_data_generation.generation_jobs",
+    "fhir_data_generation.generation_stream",
+    "fhir_data_validation.fhir_resource_validation",
+    "fhir_data_validation.schema_index",
+    "OpenAI",
+    "BlobStorage",
+    "Serialization",
+    "azure.functions",
+    "openai",
+    "azure.storage.blob",
+    "fhir.resources",
+    "pydantic",
+    "pytz",
+    "requests"
+]
+
+# Placeholder settings, so the modules import without a configured function app (no connection is opened)
+BENCHMARK_ENVIRONMENT = {
+    "AZURE_OPENAI_KEY": "benchmark",
+    "AZURE_OPENAI_API_BASE": "https://benchmark.openai.azure.com",
+    "AZURE_OPENAI_API_VERSION": "2024-02-01",
+    "BLOB_CONNECTION_STRING": "UseDevelopmentStorage=true",
+    "BLOB_CONTAINER_NAME": "benchmark"
+}
+
+
+# Function to import a module in a fresh interpreter, returning the cumulative import time (in ms) of every module loaded
+def measure_imports(module_name):
+    environment = {**BENCHMARK_ENVIRONMENT, **os.environ}
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        cwd=REPOSITORY_ROOT, env=environment, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module_name} failed:\n{completed.stderr[-2000:]}")
+
+    import_times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        import_times.setdefault(name.strip(), int(cumulative) / 1000)
+    return import_times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    # Which SDKs a cold start of the function app loads
+    loaded = measure_imports("function_app")
+    print("Loaded by `import function_app`:")
+    for module_name in MODULES[1:]:
+        print(f"  {module_name:<48} {'yes' if module_name in loaded else 'no'}")
+
+    print(f"\nImport time of each module in a fresh interpreter (best of {runs} runs):")
+    print(f"  {'module':<48} {'ms':>9}")
+    for module_name in MODULES:
+        best = min(measure_imports(module_name)[module_name] for _ in range(runs))
+        print(f"  {module_name:<48} {best:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Benchmark of bundle validation: time and peak memory of validating generated bundles of increasing size (with one
+# invalid resource, so the repaired bundle is produced as well), serially and across the validation processes.
+# The smallest size at which the processes are faster is a good FHIR_PARALLEL_VALIDATION_MIN_RESOURCES.
+# Run from the repository root: python benchmarks/validation_benchmark.py [patients ...]
+# (FHIR_VALIDATION_PROCESSES sets the number of processes, the CPU count by default)
+import os
+import sys
+import time
+import random
+import logging
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fhir_data_validation.fhir_resource_validation import validate_bundle_resources, validate_individual_fhir_resource
+from fhir_data_validation.validation_pool import ValidationProcessPool, DEFAULT_VALIDATION_PROCESSES
+from serialization_benchmark import build_bundle
+
+
+# Function to build a bundle with the resources of several patients, one of them invalid
+def build_large_bundle(patient_count, rng):
+    entries = []
+    for _ in range(patient_count):
+        entries.extend(build_bundle(rng)["entry"])
+    entries[1]["resource"]["subject"] = "Patient/not-a-reference-object"
+    return {"resourceType": "Bundle", "type": "collection", "entry": entries}
+
+
+def time_function(function, argument, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure_peak_memory(bundle):
+    tracemalloc.start()
+    validate_bundle_resources(bundle)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    logging.disable(logging.CRITICAL)        # Validation logs every resource
+    patient_counts = [int(argument) for argument in sys.argv[1:]] or [1, 5, 10, 20, 50, 100]
+    rng = random.Random(42)
+    processes = max(2, DEFAULT_VALIDATION_PROCESSES)
+    process_pool = ValidationProcessPool(processes=processes, min_resources=1)
+
+    # Build the schema index and start the processes outside the measurements, as a warm worker would have them
+    validate_bundle_resources(build_large_bundle(1, rng))
+    process_pool.warm_up()
+
+    def validate_serially(resources):
+        return [validate_individual_fhir_resource(resource_data["resourceType"], resource_data) for resource_data in resources]
+
+    print(f"{os.cpu_count()} CPUs, {processes} validation processes")
+    print(f"{'resources':>10} {'serial s':>10} {'ms/resource':>12} {'peak MB':>9} {'parallel s':>11} {'speedup':>8}")
+    threshold = None
+    for patient_count in patient_counts:
+        bundle = build_large_bundle(patient_count, rng)
+        resources = [entry["resource"] for entry in bundle["entry"]]
+        serial_seconds = time_function(validate_serially, resources)
+        parallel_seconds = time_function(process_pool.validate_resources, resources)
+        if threshold is None and parallel_seconds < serial_seconds:
+            threshold = len(resources)
+        print(
+            f"{len(resources):>10} {serial_seconds:>10.3f} {1000 * serial_seconds / len(resources):>12.2f} "
+            f"{measure_peak_memory(bundle) / 1024 / 1024:>9.1f} {parallel_seconds:>11.3f} {serial_seconds / parallel_seconds:>8.2f}"
+        )
+    process_pool.shutdown()
+    print(f"Parallel validation is faster from {threshold} resources." if threshold else "Parallel validation was not faster at these sizes.")
+
+
+if __name__ == "__main__":
+    main()
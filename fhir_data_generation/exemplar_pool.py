@@ -0,0 +1,224 @@
+import logging
+import os
+import re
+import json
+import uuid
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+from fhir_data_generation.offline_resource_generation import (
+    shared_rng, FAMILY_NAMES, GIVEN_NAMES, ADDRESSES, STREET_NAMES,
+    CONDITION_CODES, MEDICATION_CODES, ALLERGY_CODES, OBSERVATION_CODES, SNOMED, RXNORM, LOINC
+)
+
+
+# Default pool settings, overridable through the app settings
+DEFAULT_POOL_DIR = os.environ.get("FHIR_EXEMPLAR_POOL_DIR", ".exemplar_pool")
+DEFAULT_EXEMPLAR_RATIO = int(os.environ.get("FHIR_EXEMPLAR_RATIO", 200))        # Instances derived per LLM-generated exemplar
+DEFAULT_MAX_POOL_SIZE = int(os.environ.get("FHIR_EXEMPLAR_POOL_SIZE", 50))       # Exemplars kept per resource type and prompt
+DEFAULT_JITTER_DAYS = int(os.environ.get("FHIR_EXEMPLAR_JITTER_DAYS", 180))
+
+# Matches FHIR date, dateTime and instant values
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:\d{2})?)?$")
+
+# Coded element swapped from the vocabularies for each resource type: (candidate element paths, vocabulary, code system)
+CODE_SWAPS = {
+    "Condition": ([("code",)], CONDITION_CODES, SNOMED),
+    "AllergyIntolerance": ([("code",)], [(code, display) for code, display, _ in ALLERGY_CODES], SNOMED),
+    "MedicationRequest": ([("medication", "concept"), ("medicationCodeableConcept",)], [(code, display) for code, display, _ in MEDICATION_CODES], RXNORM)
+}
+
+
+# Pool of LLM-generated exemplars per resource type and prompt, stored locally.
+# New resources are derived from an exemplar by mutation, and a new exemplar is only generated
+# once every `ratio` instances, so bulk runs cost a small fraction of the completions.
+class ExemplarPool:
+    def __init__(self, pool_dir=DEFAULT_POOL_DIR, max_pool_size=DEFAULT_MAX_POOL_SIZE):
+        self.pool_dir = pool_dir
+        self.max_pool_size = max_pool_size
+        self._pools = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "exemplars_generated": 0,
+            "instances_derived": 0
+        }
+
+    # Function to build the pool key from the resource type and the prompt (without the patient ID)
+    @staticmethod
+    def make_key(resource_type, prompt):
+        return f"{resource_type}_{hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]}"
+
+    def _path(self, key):
+        return os.path.join(self.pool_dir, f"{key}.json")
+
+    def _load(self, key):
+        if key not in self._pools:
+            exemplars = []
+            try:
+                with open(self._path(key), "r") as pool_file:
+                    exemplars = json.load(pool_file)
+            except (OSError, ValueError):
+                pass
+            self._pools[key] = {"exemplars": exemplars, "instances_since_refresh": 0}
+        return self._pools[key]
+
+    def _save(self, key, exemplars):
+        try:
+            os.makedirs(self.pool_dir, exist_ok=True)
+            temp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as pool_file:
+                json.dump(exemplars, pool_file)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            logging.error(f"Failed to store exemplar pool {key}: {e}")
+
+    # Function to get a new resource, derived from a pooled exemplar or from a freshly generated one
+    def get_resource(self, resource_type, prompt, generate_exemplar, patient_id=None, ratio=DEFAULT_EXEMPLAR_RATIO, rng=None):
+        rng = rng or shared_rng
+        key = self.make_key(resource_type, prompt)
+
+        # Reserve the refresh under the lock, so concurrent callers don't all generate an exemplar
+        with self._lock:
+            pool = self._load(key)
+            refresh = not pool["exemplars"] or pool["instances_since_refresh"] >= ratio
+            if refresh:
+                pool["instances_since_refresh"] = 0
+            else:
+                pool["instances_since_refresh"] += 1
+                exemplar = rng.choice(pool["exemplars"])
+
+        if refresh:
+            exemplar = generate_exemplar()
+            if isinstance(exemplar, dict):
+                with self._lock:
+                    pool["exemplars"].append(exemplar)
+                    del pool["exemplars"][:-self.max_pool_size]        # Keep the most recent exemplars
+                    exemplars = list(pool["exemplars"])
+                    self.stats["exemplars_generated"] += 1
+                self._save(key, exemplars)
+                logging.info(f"Added exemplar to pool {key} ({len(exemplars)} exemplars).")
+            else:
+                # Fall back to an existing exemplar if the refresh failed
+                with self._lock:
+                    if not pool["exemplars"]:
+                        logging.error(f"Failed to generate an exemplar for pool {key}.")
+                        return None
+                    exemplar = rng.choice(pool["exemplars"])
+
+        with self._lock:
+            self.stats["instances_derived"] += 1
+        return mutate_resource(exemplar, patient_id, rng)
+
+
+# Function to shift a FHIR date, dateTime or instant value by the given offset, keeping its precision
+def shift_date(value, offset):
+    try:
+        if len(value) == 10:
+            return (datetime.fromisoformat(value) + offset).date().isoformat()
+        shifted = datetime.fromisoformat(value.replace("Z", "+00:00")) + offset
+    except ValueError:
+        return value
+    result = shifted.isoformat()
+    return result.replace("+00:00", "Z") if value.endswith("Z") else result
+
+
+# Function to replace the digits of an identifier value, keeping its format
+def scramble_digits(value, rng):
+    return re.sub(r"\d", lambda _: str(rng.randint(0, 9)), value)
+
+
+# Function to walk the resource, re-linking patient references, scrambling identifiers and jittering dates
+def mutate_values(data, patient_id, offset, rng, key=None):
+    if isinstance(data, dict):
+        for child_key, value in data.items():
+            if child_key == "reference" and isinstance(value, str) and value.startswith("Patient/") and patient_id:
+                data[child_key] = f"Patient/{patient_id}"
+            elif child_key == "identifier":
+                for identifier in value if isinstance(value, list) else [value]:
+                    if isinstance(identifier, dict) and isinstance(identifier.get("value"), str):
+                        identifier["value"] = scramble_digits(identifier["value"], rng)
+            else:
+                data[child_key] = mutate_values(value, patient_id, offset, rng, child_key)
+        return data
+    if isinstance(data, list):
+        return [mutate_values(item, patient_id, offset, rng, key) for item in data]
+    if isinstance(data, str) and key != "lastUpdated" and DATE_PATTERN.match(data):
+        return shift_date(data, offset)
+    return data
+
+
+# Function to swap the main code of the resource with another one from the vocabulary
+def swap_code(resource, rng):
+    resource_type = resource.get("resourceType")
+
+    if resource_type == "Observation":
+        # Only laboratory results are swapped - vital signs codes determine the shape of the value
+        categories = json.dumps(resource.get("category", []))
+        if "laboratory" not in categories or "valueQuantity" not in resource:
+            return
+        code, display, unit, ucum, low, high = rng.choice(OBSERVATION_CODES["laboratory"])
+        resource["code"] = {"coding": [{"system": LOINC, "code": code, "display": display}], "text": display}
+        resource["valueQuantity"] = {"value": round(rng.uniform(low * 0.8, high * 1.2), 1), "unit": unit, "system": "http://unitsofmeasure.org", "code": ucum}
+        resource.pop("referenceRange", None)
+        return
+
+    if resource_type not in CODE_SWAPS:
+        return
+    paths, vocabulary, system = CODE_SWAPS[resource_type]
+    for path in paths:
+        parent = resource
+        for part in path[:-1]:
+            parent = parent.get(part) if isinstance(parent, dict) else None
+        if not isinstance(parent, dict) or path[-1] not in parent:
+            continue
+        code, display = rng.choice(vocabulary)
+        parent[path[-1]] = {"coding": [{"system": system, "code": code, "display": display}], "text": display}
+        return
+
+
+# Function to give a derived patient a new name, address and phone number
+def swap_demographics(resource, rng):
+    gender = resource.get("gender") if resource.get("gender") in GIVEN_NAMES else "unknown"
+    for name in resource.get("name", []):
+        if isinstance(name, dict):
+            name["family"] = rng.choice(FAMILY_NAMES)
+            name["given"] = [rng.choice(GIVEN_NAMES[gender])]
+            name.pop("text", None)
+    for address in resource.get("address", []):
+        if isinstance(address, dict):
+            city, state, postal_prefix = rng.choice(ADDRESSES)
+            address.update({
+                "line": [f"{rng.randint(1, 9999)} {rng.choice(STREET_NAMES)}"],
+                "city": city,
+                "state": state,
+                "postalCode": f"{postal_prefix}{rng.randint(10, 99)}"
+            })
+            address.pop("text", None)
+    for telecom in resource.get("telecom", []):
+        if isinstance(telecom, dict) and telecom.get("system") == "phone":
+            telecom["value"] = f"555-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}"
+
+
+# Function to derive a new resource from an exemplar: fresh ids and identifiers, jittered dates,
+# re-linked patient references and codes swapped from the vocabularies
+def mutate_resource(exemplar, patient_id=None, rng=None, jitter_days=DEFAULT_JITTER_DAYS):
+    rng = rng or shared_rng
+    resource = json.loads(json.dumps(exemplar))        # Never mutate the pooled exemplar
+    resource_type = resource.get("resourceType", "resource")
+
+    resource["id"] = f"{resource_type.lower()}-{uuid.UUID(int=rng.getrandbits(128), version=4).hex[:12]}"
+    offset = timedelta(days=rng.randint(-jitter_days, jitter_days))
+    mutate_values(resource, patient_id, offset, rng)
+
+    if isinstance(resource.get("meta"), dict):
+        resource["meta"]["lastUpdated"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    if resource_type == "Patient":
+        swap_demographics(resource, rng)
+    swap_code(resource, rng)
+    resource.pop("text", None)        # The exemplar's narrative no longer matches the derived resource
+
+    return resource
+
+
+# Pool shared by all the requests handled by this worker
+exemplar_pool = ExemplarPool()
@@ -2,16 +2,176 @@ import logging
 import os
 import json
 import azure.functions as func
-import requests.exceptions
-from OpenAI import callGptEndpoint
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+import time
+import html
+import uuid
+import threading
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from OpenAI import callGptEndpoint, callGptEndpointStream, estimateStreamUsage
+from BlobStorage import uploadBlob
+from Serialization import dumpJson, encodeJsonBlob
+from fhir_data_generation.gpt_response_cache import gpt_response_cache
+from fhir_data_generation.incremental_json import IncrementalJsonObjectScanner, JsonStructureError
+from fhir_data_generation.offline_resource_generation import generate_offline_resource, create_offline_rng, validate_offline_config
+from fhir_data_generation.exemplar_pool import exemplar_pool, DEFAULT_EXEMPLAR_RATIO
+from fhir_data_generation.token_budget import token_budget, MAX_TOKENS_CEILING
+from fhir_data_generation.generation_checkpoints import checkpoint_store, BUNDLE_ID_PATTERN
+from fhir_data_generation.ndjson_export import NdjsonExportWriter, NdjsonBundleBuffer
+from fhir_data_validation.fhir_resource_validation import validate_individual_fhir_resource
+from fhir_data_validation.schema_index import get_schema_prompt_hint
+from fhir_data_validation.repair_rules import count_repair_rules
 
 
 fhir_resource_generation_blueprint=func.Blueprint()
 
 
+# Request-scoped generation settings and metrics, visible to every GPT call made while generating a bundle
+generation_context = contextvars.ContextVar("generation_context", default=None)
+
+
+# Function to create the context for a single bundle generation request
+def create_generation_context(user_parameters, progress_callback=None, entry_callback=None):
+    return {
+        "lock": threading.Lock(),
+        "progress_callback": progress_callback,
+        "bundle_id": user_parameters.get("bundle_id"),
+        "entry_callback": entry_callback,
+        "use_cache": bool(user_parameters.get("use_cache", False)),
+        "stream": bool(user_parameters.get("stream", False)),
+        "seed": user_parameters.get("seed"),
+        "offline_config": user_parameters.get("offline_config"),
+        "exemplar_ratio": int(user_parameters.get("exemplar_ratio", DEFAULT_EXEMPLAR_RATIO)),
+        "validate_resources": bool(user_parameters.get("validate_resources", False)),
+        "completed_resources": {},
+        "ndjson_writer": None,
+        "gpt_semaphore": None,
+        "metrics": {
+            "mode": "one_shot" if user_parameters.get("one_shot", False) else "per_resource",
+            "engine": user_parameters.get("generation_engine", "llm"),
+            "completions": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+            "gpt_latency_seconds": 0.0,
+            "cache_hits": 0,
+            "cache_misses": 0
+        }
+    }
+
+
+# Function to record the token usage and latency of a GPT call against the current request
+def record_gpt_usage(usage, latency):
+    context = generation_context.get()
+    if context is None:
+        return
+
+    with context["lock"]:
+        metrics = context["metrics"]
+        metrics["completions"] += 1
+        metrics["gpt_latency_seconds"] += latency
+        if usage:
+            metrics["prompt_tokens"] += usage.prompt_tokens or 0
+            metrics["completion_tokens"] += usage.completion_tokens or 0
+            metrics["total_tokens"] += usage.total_tokens or 0
+
+
+# Function to record a GPT response cache lookup against the current request
+def record_cache_lookup(hit):
+    context = generation_context.get()
+    if context is None:
+        return
+
+    with context["lock"]:
+        context["metrics"]["cache_hits" if hit else "cache_misses"] += 1
+
+
+# Function to report the progress of a resource type (pending, running, completed or failed) to the caller, if it asked for it
+def report_progress(resource_key, status):
+    context = generation_context.get()
+    if context is None or context["progress_callback"] is None:
+        return
+
+    try:
+        context["progress_callback"](resource_key, status)
+    except Exception as e:
+        logging.error(f"Failed to report the progress of {resource_key}: {e}")
+
+
+# Function to decode the generated data of a resource type, returning the (observation type, resource) pairs that are valid JSON
+def decode_generated_data(resource_key, resource_data):
+    if not resource_data:
+        return []
+    if resource_key == "observation":
+        decoded = [(obs["observation_type"], clean_fhir_data(obs["data"]) if obs["data"] else None) for obs in resource_data]
+    else:
+        decoded = [(None, clean_fhir_data(resource_data))]
+    return [(observation_type, resource) for observation_type, resource in decoded if resource]
+
+
+# Function to persist a generated resource type as soon as it decodes, so a retried request with the same bundle ID resumes from it
+def save_checkpoint(resource_key, resource_data):
+    context = generation_context.get()
+    if context is None or not context["bundle_id"]:
+        return
+
+    # Store the decoded resources in the shape returned by the generators
+    decoded = decode_generated_data(resource_key, resource_data)
+    if not decoded:
+        return
+    if resource_key == "observation":
+        checkpoint_data = [{"observation_type": observation_type, "data": json.dumps(resource)} for observation_type, resource in decoded]
+    else:
+        checkpoint_data = json.dumps(decoded[0][1])
+
+    try:
+        checkpoint_store.save(context["bundle_id"], resource_key, checkpoint_data)
+    except Exception as e:
+        logging.error(f"Failed to checkpoint {resource_key} data of bundle {context['bundle_id']}: {e}")
+
+
+# Function to send the completed entries of a resource type to the caller, if it streams the bundle. The entries are sent
+# once validated (and repaired), so they match the stored bundle.
+def emit_entries(resource_key, completed):
+    context = generation_context.get()
+    if context is None or context["entry_callback"] is None:
+        return
+
+    for observation_type, resource in ((item["observation_type"], item["resource"]) for item in completed if item["resource"]):
+        resource_type = resource.get("resourceType", resource_key)
+        resource_id = resource.get("id", f"unknown_{resource_key}")
+        line = {
+            "type": "entry",
+            "resource_key": resource_key,
+            "entry": {
+                "fullUrl": f"urn:uuid:{resource_id}",
+                "resource": resource
+            },
+            "success_data": {
+                "message": f"{resource_type} data for {resource_type}/{resource_id} generated successfully."
+            }
+        }
+        if observation_type:
+            line["success_data"]["observation_type"] = observation_type
+        try:
+            context["entry_callback"](line)
+        except Exception as e:
+            logging.error(f"Failed to emit the {resource_key} entry: {e}")
+
+
+# Function to submit a call to an executor so it runs with the caller's request context
+def submit_with_context(executor, fn, *args):
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
 # Function to generate FHIR data using GPT
-def generate_fhir_data_using_gpt(prompt):
+def generate_fhir_data_using_gpt(prompt, max_tokens=None, json_response=True, resource_type=None, variant="default"):
+    # Reserve only the tokens this kind of resource needs, unless the caller sets the budget
+    requested_max_tokens = max_tokens
+    if max_tokens is None:
+        max_tokens = token_budget.get_budget(resource_type, variant)
+
     user_message = {  
         "role": "user",  
         "content": prompt  
@@ -22,15 +182,72 @@ def generate_fhir_data_using_gpt(prompt):
         "engine": os.environ["AZURE_OPENAI_MODEL"],  
         "messages": messages,  
         "temperature": 0.7,  
-        "max_tokens": 4096,
+        "max_tokens": max_tokens,
         "timeout": 300
     }
-    
+
+    # Apply the request settings (seed and response cache) if the call is part of a bundle generation
+    context = generation_context.get() or {}
+    if context.get("seed") is not None:
+        gpt_options["seed"] = context["seed"]
+
+    # Serve identical prompts from the response cache if requested
+    cache_key = None
+    if context.get("use_cache"):
+        cache_key = gpt_response_cache.make_key(
+            gpt_options["engine"],
+            prompt,
+            gpt_options["temperature"],
+            max_tokens=requested_max_tokens,
+            resource_type=resource_type,
+            seed=gpt_options.get("seed")
+        )
+        cached_response = gpt_response_cache.get(cache_key)
+        record_cache_lookup(cached_response is not None)
+        if cached_response is not None:
+            logging.info("GPT response served from cache.")
+            return cached_response
+
+    # Stream the completion if requested, so generation stops as soon as the resource is complete
+    if context.get("stream") and json_response:
+        request_completion = stream_fhir_data_using_gpt
+    else:
+        request_completion = request_fhir_data_using_gpt
+
+    # Hold one of the request's concurrent GPT call slots, if it caps them, for the whole call (nested pools included)
+    with context.get("gpt_semaphore") or contextlib.nullcontext():
+        response, truncated = request_completion(gpt_options, resource_type, variant)
+
+        # Retry a completion cut off by its budget once, with a larger budget
+        if truncated and max_tokens < MAX_TOKENS_CEILING:
+            gpt_options["max_tokens"] = token_budget.get_retry_budget(max_tokens)
+            logging.info(f"GPT response truncated at {max_tokens} tokens, retrying with {gpt_options['max_tokens']} tokens.")
+            response, truncated = request_completion(gpt_options, resource_type, variant)
+
+    if truncated:
+        logging.error(f"GPT response truncated at {gpt_options['max_tokens']} tokens.")
+        return None
+    if response and cache_key:
+        gpt_response_cache.set(cache_key, response)
+    return response
+
+
+# Function to request a GPT completion, returning its content and whether it was truncated by max_tokens
+def request_fhir_data_using_gpt(gpt_options, resource_type=None, variant="default"):
     try:
+        start_time = time.perf_counter()
         gpt_response = callGptEndpoint(gpt_options)
+        record_gpt_usage(getattr(gpt_response, "usage", None), time.perf_counter() - start_time)
         if not gpt_response or not gpt_response.choices:  
             logging.error("Error occurred while calling GPT endpoint or no choices in response.")  
-            return None  
+            return None, False
+
+        # Record the completion tokens used, so the budget of this kind of resource adapts
+        truncated = getattr(gpt_response.choices[0], "finish_reason", None) == "length"
+        usage = getattr(gpt_response, "usage", None)
+        token_budget.record(resource_type, variant, usage.completion_tokens if usage else None, truncated)
+        if truncated:
+            return None, True
     
         # Extract the generated content
         response = gpt_response.choices[0].message.content.strip() if gpt_response.choices[0].message.content else None  
@@ -38,22 +255,179 @@ def generate_fhir_data_using_gpt(prompt):
             logging.info("GPT response processed successfully.")  
         else:  
             logging.error("No content found in GPT response.")
-        return response
-    except requests.exceptions.RequestException as e:  
-        if e.response and e.response.status_code == 504:  
+        return response, False
+    except Exception as e:  
+        if getattr(getattr(e, "response", None), "status_code", None) == 504:  
             logging.error("504 Gateway Timeout error occurred.")  
         else:  
             logging.error(f"An error occurred while calling GPT endpoint: {e}")  
-        return None
-    except Exception as e:  
-        logging.error(f"An error occurred while calling GPT endpoint: {e}")  
-        return None
+        return None, False
+
+
+# Function to generate FHIR data using a streamed GPT completion, parsing the resource incrementally
+def stream_fhir_data_using_gpt(gpt_options, resource_type=None, variant="default"):
+    scanner = IncrementalJsonObjectScanner()
+    usage = None
+    finish_reason = None
+    start_time = time.perf_counter()
+    stream = None
+    streamed_characters = 0
+
+    try:
+        stream = callGptEndpointStream(gpt_options)
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if chunk.choices and getattr(chunk.choices[0], "finish_reason", None):
+                finish_reason = chunk.choices[0].finish_reason
+            if not chunk.choices or not chunk.choices[0].delta or not chunk.choices[0].delta.content:
+                continue
+            streamed_characters += len(chunk.choices[0].delta.content)
+
+            # Stop as soon as the top-level object closes - the rest of the completion is not needed
+            if scanner.feed(chunk.choices[0].delta.content):
+                logging.info(f"Streamed FHIR resource completed after {time.perf_counter() - start_time:.2f} seconds.")
+                break
+
+        # The usage is only reported when the whole stream is consumed, so estimate it from the resource otherwise
+        completion_tokens = usage.completion_tokens if usage else len(scanner.text) // 4
+        token_budget.record(resource_type, variant, completion_tokens, finish_reason == "length")
+
+        if not scanner.complete:
+            if finish_reason == "length":
+                return None, True
+            logging.error("Streamed GPT response ended before the FHIR resource was complete.")
+            return None, False
+        logging.info("GPT response processed successfully.")
+        return scanner.text, False
+    except JsonStructureError as e:
+        # Abort the completion early instead of paying for the rest of an unusable response
+        logging.error(f"Aborted streamed GPT response after {time.perf_counter() - start_time:.2f} seconds: {e}")
+        return None, False
+    except Exception as e:
+        logging.error(f"An error occurred while calling GPT endpoint: {e}")
+        return None, False
+    finally:
+        if stream is not None:
+            stream.close()
+            # The usage chunk does not arrive when the stream is closed early (or on api-versions without streamed
+            # usage), so record the same estimate the rate limiter is corrected with
+            usage = usage or estimateStreamUsage(gpt_options, streamed_characters)
+        record_gpt_usage(usage, time.perf_counter() - start_time)
+
+
+# Engines that can be selected per request: LLM only, offline only, offline with the LLM writing the narrative (hybrid),
+# or mutations of pooled LLM-generated exemplars (exemplar)
+GENERATION_ENGINES = ("llm", "offline", "hybrid", "exemplar")
+OFFLINE_ENGINES = ("offline", "hybrid")
+
+# Layouts the generated data can be stored in: a single Bundle, or one NDJSON file per resource type (FHIR Bulk Data)
+OUTPUT_FORMATS = ("bundle", "ndjson")
+
+# Maximum number of tokens reserved for the narrative of a resource in hybrid mode
+NARRATIVE_MAX_TOKENS = 300
+
+
+# Function to get the random generator of a resource of the current bundle. With a seed, each resource gets its own,
+# seeded from "<seed>:<bundle ID>:<resource key>", so the output doesn't depend on the order the threads run in.
+def get_offline_rng(resource_key):
+    context = generation_context.get() or {}
+    return create_offline_rng(context.get("offline_config"), f"{context.get('bundle_id')}:{resource_key}")
+
+
+# Function to generate a resource with the offline engine, adding an LLM-written narrative in hybrid mode
+def generate_resource_without_llm(resource_type, engine, patient_id=None, input_data=None, observation_type=None):
+    context = generation_context.get() or {}
+    resource = generate_offline_resource(
+        resource_type,
+        patient_id,
+        input_data,
+        observation_type,
+        context.get("offline_config"),
+        get_offline_rng(f"{resource_type}/{observation_type}" if observation_type else resource_type)
+    )
+
+    if engine == "hybrid":
+        add_narrative_using_gpt(resource)
+
+    # Return the JSON string, the same as the LLM generated data
+    return json.dumps(resource)
+
+
+# Function to generate the free-text narrative of a resource using GPT
+def add_narrative_using_gpt(resource):
+    prompt = f'''
+    Write a short clinical narrative (two or three sentences, plain text without any markup) describing the following FHIR {resource["resourceType"]} resource:
+    {json.dumps(resource)}
+    '''
+    narrative = generate_fhir_data_using_gpt(prompt, max_tokens=NARRATIVE_MAX_TOKENS, json_response=False)
+    if not narrative:
+        logging.error(f"Failed to generate the narrative for {resource['resourceType']}/{resource.get('id')}.")
+        return resource
+
+    resource["text"] = {
+        "status": "generated",
+        "div": f'<div xmlns="http://www.w3.org/1999/xhtml">{html.escape(narrative)}</div>'
+    }
+    return resource
+
+
+# Function to generate a resource by mutating an exemplar from the pool, refreshing the pool with the LLM as configured
+def generate_from_exemplar_pool(resource_type, prompt, patient_id=None, variant="default"):
+    context = generation_context.get() or {}
+
+    # The pool is keyed on the prompt without the patient ID, so exemplars are shared across patients
+    pool_prompt = prompt.replace(patient_id, "{patient_id}") if patient_id else prompt
+
+    def generate_exemplar():
+        exemplar_data = generate_fhir_data_using_gpt(prompt, resource_type=resource_type, variant=variant)
+        return clean_fhir_data(exemplar_data) if exemplar_data else None
+
+    resource = exemplar_pool.get_resource(
+        resource_type,
+        pool_prompt,
+        generate_exemplar,
+        patient_id,
+        context.get("exemplar_ratio", DEFAULT_EXEMPLAR_RATIO),
+        get_offline_rng(f"{resource_type}/{variant}")
+    )
+    return json.dumps(resource) if resource else None
+
+
+# Function to generate the data for a resource from its prompt with the selected engine
+def generate_resource_data(resource_type, prompt, patient_id=None, engine="llm", variant="default"):
+    # Ask for the shapes the validator would otherwise have to repair (list elements, timezones)
+    prompt += f"\n    {get_schema_prompt_hint(resource_type)}\n"
+    if engine == "exemplar":
+        return generate_from_exemplar_pool(resource_type, prompt, patient_id, variant)
+    return generate_fhir_data_using_gpt(prompt, resource_type=resource_type, variant=variant)
+
+
+# Function to name the prompt variant used to keep separate token budgets for default and customised prompts
+def get_prompt_variant(data_elements=None, input_data=None, observation_type=None):
+    variant = "custom" if data_elements or input_data else "default"
+    return f"{observation_type}/{variant}" if observation_type else variant
+
+
+# Function to pick the user input data of a single observation type for the offline engine
+def get_observation_input_data(input_data, observation_type):
+    if not isinstance(input_data, dict):
+        return input_data
+    if observation_type == "laboratory":
+        return input_data.get("laboratory", input_data)
+    vital_signs_input_data = input_data.get("vital-signs", input_data)
+    if isinstance(vital_signs_input_data, dict):
+        return vital_signs_input_data.get(observation_type, vital_signs_input_data)
+    return vital_signs_input_data
 
 
 # Function to generate patient data based on user input
-def generate_patient_data(data_elements=None, input_data=None):
+def generate_patient_data(data_elements=None, input_data=None, engine="llm"):
     logging.info('Generating patient data for the FHIR resource.')
 
+    if engine in OFFLINE_ENGINES:
+        return generate_resource_without_llm("Patient", engine, input_data=input_data)
+
     prompt = '''
     Generate realistic healthcare data in the FHIR format containing the Patient resourceType including details such as -
       - resourceType, id, meta (versionId and lastUpdated), identifiers, names, telecoms, gender, birth date, 
@@ -66,11 +440,14 @@ def generate_patient_data(data_elements=None, input_data=None):
     if input_data:  
         prompt += f" with input data: {input_data}"  
   
-    return generate_fhir_data_using_gpt(prompt)
+    return generate_resource_data("Patient", prompt, engine=engine, variant=get_prompt_variant(data_elements, input_data))
 
 
 # Function to handle the inclusion of condition data based on user input
-def generate_condition_data(patient_id, data_elements=None, input_data=None):  
+def generate_condition_data(patient_id, data_elements=None, input_data=None, engine="llm"):  
+    if engine in OFFLINE_ENGINES:
+        return generate_resource_without_llm("Condition", engine, patient_id, input_data)
+
     prompt = f'''
     Generate realistic healthcare data in the FHIR format containing the Condition resourceType linked to Patient FHIR ID {patient_id} including details such as -
       - resourceType, id, meta (versionId and lastUpdated), identifiers, clinical status, verification status, 
@@ -83,11 +460,14 @@ def generate_condition_data(patient_id, data_elements=None, input_data=None):
     if input_data:  
         prompt += f" with input data: {input_data}" 
 
-    return generate_fhir_data_using_gpt(prompt)
+    return generate_resource_data("Condition", prompt, patient_id, engine, get_prompt_variant(data_elements, input_data))
 
 
 # Function to handle the inclusion of encounter data based on user input
-def generate_encounter_data(patient_id, data_elements=None, input_data=None):        
+def generate_encounter_data(patient_id, data_elements=None, input_data=None, engine="llm"):        
+    if engine in OFFLINE_ENGINES:
+        return generate_resource_without_llm("Encounter", engine, patient_id, input_data)
+
     prompt = f'''      
     Generate realistic healthcare data in the FHIR format containing the Encounter resourceType linked to Patient FHIR ID {patient_id} including details such as -          
       - resourceType, id, meta (versionId and lastUpdated), identifiers, status, type, subject, location, diagnosis
@@ -99,11 +479,14 @@ def generate_encounter_data(patient_id, data_elements=None, input_data=None):
     if input_data:            
         prompt += f" with input data: {input_data}"
 
-    return generate_fhir_data_using_gpt(prompt)
+    return generate_resource_data("Encounter", prompt, patient_id, engine, get_prompt_variant(data_elements, input_data))
 
 
 # Function to handle the inclusion of appointment data based on user input  
-def generate_appointment_data(patient_id, data_elements=None, input_data=None):  
+def generate_appointment_data(patient_id, data_elements=None, input_data=None, engine="llm"):  
+    if engine in OFFLINE_ENGINES:
+        return generate_resource_without_llm("Appointment", engine, patient_id, input_data)
+
     prompt = f'''
     Generate realistic healthcare data in the FHIR format containing the Appointment resourceType linked to Patient FHIR ID {patient_id} including details such as -  
       - resourceType, id, meta (versionId and lastUpdated), identifiers, status, service category, appointment type,
@@ -116,11 +499,12 @@ def generate_appointment_data(patient_id, data_elements=None, input_data=None):
     if input_data:  
         prompt += f" with input data: {input_data}"  
     
-    return generate_fhir_data_using_gpt(prompt)
+    return generate_resource_data("Appointment", prompt, patient_id, engine, get_prompt_variant(data_elements, input_data))
 
 
-# Function to handle the inclusion of observation data based on user input
-def generate_observation_data(patient_id, category, data_elements=None, input_data=None):
+# Function to handle the inclusion of observation data based on user input (only the given observation types of the
+# categories, if any, e.g. the ones that failed)
+def generate_observation_data(patient_id, category, data_elements=None, input_data=None, engine="llm", observation_types=None):
     valid_categories = {'vital-signs', 'laboratory'}  
       
     # Check for invalid categories
@@ -129,6 +513,16 @@ def generate_observation_data(patient_id, category, data_elements=None, input_da
         logging.error(f"Invalid category provided: {invalid_categories}")  
         return None  
 
+    if engine in OFFLINE_ENGINES:
+        return [
+            {
+                "observation_type": observation_type,
+                "data": generate_resource_without_llm("Observation", engine, patient_id, get_observation_input_data(input_data, observation_type), observation_type)
+            }
+            for observation_type in get_observation_types(category)
+            if observation_types is None or observation_type in observation_types
+        ]
+
     prompts = []      # Initialize empty list to store different prompts
     
     if 'vital-signs' in category:
@@ -147,7 +541,7 @@ def generate_observation_data(patient_id, category, data_elements=None, input_da
                 heart_rate_prompt += f" with input data: {input_data.get('vital-signs')}"  
             else:    
                 heart_rate_prompt += f" with input data: {input_data}"  
-        prompts.append(heart_rate_prompt)
+        prompts.append(("heart_rate", heart_rate_prompt))
 
         blood_pressure_prompt = f'''
         Generate realistic healthcare data in the FHIR format containing an Observation resourceTypes linked to Patient FHIR ID {patient_id} blood-pressure, including components for systolic and diastolic blood pressure.
@@ -164,7 +558,7 @@ def generate_observation_data(patient_id, category, data_elements=None, input_da
                 blood_pressure_prompt += f" with input data: {input_data.get('vital-signs')}"  
             else:    
                 blood_pressure_prompt += f" with input data: {input_data}"  
-        prompts.append(blood_pressure_prompt)
+        prompts.append(("blood_pressure", blood_pressure_prompt))
     
     if 'laboratory' in category:  
         laboratory_prompt = f'''
@@ -181,26 +575,48 @@ def generate_observation_data(patient_id, category, data_elements=None, input_da
                 laboratory_prompt += f" with input data: {input_data.get('laboratory')}"  
             else:    
                 laboratory_prompt += f" with input data: {input_data}"  
-        prompts.append(laboratory_prompt)
+        prompts.append(("laboratory", laboratory_prompt))
+
+    if observation_types is not None:
+        prompts = [(observation_type, prompt) for observation_type, prompt in prompts if observation_type in observation_types]
     
     observation_data = []    # Initialize empty list to store different prompt responses
-    
-    # Iterate through each prompt generated for the valid categories
-    for prompt in prompts:
-        # Generate FHIR data using GPT based on the prompt
-        response = generate_fhir_data_using_gpt(prompt)  
-        if response:
-            observation_data.append(response)     # If the response is valid, append it to the obs_data list
-        else:  
-            logging.error(f"Failed to generate Observation data for prompt category: {category}")
-            return None
-    
-    # Return the list of responses containing the generated observation data
+
+    # Send the prompts generated for the valid categories concurrently, so all of them cost a single round trip
+    with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+        futures = [
+            (observation_type, submit_with_context(executor, generate_resource_data, "Observation", prompt, patient_id, engine, get_prompt_variant(data_elements, input_data, observation_type)))
+            for observation_type, prompt in prompts
+        ]
+
+        # Gather the responses in the original prompt order, keeping the ones that succeeded
+        for observation_type, future in futures:
+            try:
+                response = future.result()
+            except Exception as e:
+                logging.error(f"Exception while generating Observation data for {observation_type}: {e}")
+                response = None
+            if not response:
+                logging.error(f"Failed to generate Observation data for prompt category: {observation_type}")
+            observation_data.append({
+                "observation_type": observation_type,
+                "data": response
+            })
+
+    # Fail only if none of the prompts produced any data
+    if not any(obs["data"] for obs in observation_data):
+        logging.error(f"Failed to generate Observation data for prompt category: {category}")
+        return None
+
+    # Return the list of responses (per observation type) containing the generated observation data
     return observation_data
 
 
 # Function to handle the inclusion of service request data based on user input  
-def generate_service_request_data(patient_id, data_elements=None, input_data=None):  
+def generate_service_request_data(patient_id, data_elements=None, input_data=None, engine="llm"):  
+    if engine in OFFLINE_ENGINES:
+        return generate_resource_without_llm("ServiceRequest", engine, patient_id, input_data)
+
     prompt = f'''  
     Generate realistic healthcare data in the FHIR format containing the ServiceRequest resourceType linked to Patient FHIR ID {patient_id} including details such as -  
       - resourceType, id, meta (versionId and lastUpdated), identifiers, based on, status, intent, category, subject, 
@@ -213,11 +629,14 @@ def generate_service_request_data(patient_id, data_elements=None, input_data=Non
     if input_data:  
         prompt += f" with input data: {input_data}"  
   
-    return generate_fhir_data_using_gpt(prompt)
+    return generate_resource_data("ServiceRequest", prompt, patient_id, engine, get_prompt_variant(data_elements, input_data))
 
 
 # Function to handle the inclusion of medication request data based on user input  
-def generate_medication_request_data(patient_id, data_elements=None, input_data=None):  
+def generate_medication_request_data(patient_id, data_elements=None, input_data=None, engine="llm"):  
+    if engine in OFFLINE_ENGINES:
+        return generate_resource_without_llm("MedicationRequest", engine, patient_id, input_data)
+
     prompt = f'''  
     Generate realistic healthcare data in the FHIR format containing the MedicationRequest resourceType linked to Patient FHIR ID {patient_id} including details such as -  
       - resourceType, id, meta (versionId and lastUpdated), identifiers, status, intent, category, medication, medication codeable concept, 
@@ -230,11 +649,14 @@ def generate_medication_request_data(patient_id, data_elements=None, input_data=
     if input_data:  
         prompt += f" with input data: {input_data}"  
     
-    return generate_fhir_data_using_gpt(prompt)
+    return generate_resource_data("MedicationRequest", prompt, patient_id, engine, get_prompt_variant(data_elements, input_data))
 
 
 # Function to handle the inclusion of allergy intolerance data based on user input  
-def generate_allergy_intolerance_data(patient_id, data_elements=None, input_data=None):  
+def generate_allergy_intolerance_data(patient_id, data_elements=None, input_data=None, engine="llm"):  
+    if engine in OFFLINE_ENGINES:
+        return generate_resource_without_llm("AllergyIntolerance", engine, patient_id, input_data)
+
     prompt = f'''  
     Generate realistic healthcare data in the FHIR format containing the AllergyIntolerance resourceType linked to Patient FHIR ID {patient_id} including details such as -  
       - resourceType, id, meta (versionId and lastUpdated), identifiers, clinical status, verification status, codes, patient, recorded date
@@ -246,7 +668,7 @@ def generate_allergy_intolerance_data(patient_id, data_elements=None, input_data
     if input_data:  
         prompt += f" with input data: {input_data}"  
     
-    return generate_fhir_data_using_gpt(prompt)
+    return generate_resource_data("AllergyIntolerance", prompt, patient_id, engine, get_prompt_variant(data_elements, input_data))
 
 
 # Utility function to clean up and extract valid JSON from generated FHIR data
@@ -263,8 +685,332 @@ def clean_fhir_data(fhir_data):
         return None
 
 
-def generate_fhir_bundle(user_parameters):
+# Function to validate a decoded resource, returning the validation result and the repaired resource,
+# so the bundle is stored already repaired
+def validate_generated_resource(resource_json):
+    try:
+        # The validator repairs known issues (e.g. timezones, list fields) before checking the resource model
+        validation_result, resource_json = validate_individual_fhir_resource(resource_json.get("resourceType"), resource_json)
+    except Exception as e:
+        logging.error(f"Exception while validating {resource_json.get('resourceType')}/{resource_json.get('id')}: {e}")
+        validation_result = {
+            "status": "error",
+            "resourceType": resource_json.get("resourceType"),
+            "message": f"Resource {resource_json.get('resourceType')}/{resource_json.get('id', 'unknown')} could not be validated."
+        }
+    return validation_result, resource_json
+
+
+# Function to decode the generated data of a resource type as soon as it completes, validating (and repairing) each
+# resource when the request asks for it, then appending it to the NDJSON files of the request and streaming it to the
+# caller, if any. Returns the completed resources in the order they were generated, also kept in the request context.
+def complete_resource_data(resource_key, resource_data):
+    if resource_key == "observation":
+        generated = [(obs["observation_type"], obs["data"]) for obs in resource_data or []]
+    else:
+        generated = [(None, resource_data)] if resource_data else []
+
+    context = generation_context.get()
+    # Resources already completed by a previous attempt (the observation types that succeeded) are kept as they are
+    previous = [item for item in context["completed_resources"].get(resource_key, []) if item["resource"]]
+    completed = []
+    new_items = []
+    for observation_type, data in generated:
+        reused = next((item for item in previous if item["observation_type"] == observation_type and item["data"] == data), None)
+        if reused:
+            previous.remove(reused)
+            completed.append(reused)
+            continue
+        resource = clean_fhir_data(data) if data else None
+        validation_result = None
+        if resource and context["validate_resources"]:
+            validation_result, resource = validate_generated_resource(resource)
+        if resource and context["ndjson_writer"] is not None:
+            context["ndjson_writer"].append(resource)
+        item = {"observation_type": observation_type, "data": data, "resource": resource, "validation_result": validation_result}
+        completed.append(item)
+        new_items.append(item)
+
+    context["completed_resources"][resource_key] = completed
+    emit_entries(resource_key, new_items)
+    return completed
+
+
+# Resource types that can be included in the FHIR bundle, in the order they are appended after the patient
+# (parameter key, label used in messages, FHIR resourceType, generator function)
+FHIR_RESOURCE_TYPES = [
+    ("condition", "Condition", "Condition", generate_condition_data),
+    ("encounter", "Encounter", "Encounter", generate_encounter_data),
+    ("appointment", "Appointment", "Appointment", generate_appointment_data),
+    ("observation", "Observation", "Observation", generate_observation_data),
+    ("service_request", "Service Request", "ServiceRequest", generate_service_request_data),
+    ("medication_request", "Medication Request", "MedicationRequest", generate_medication_request_data),
+    ("allergy_intolerance", "Allergy Intolerance", "AllergyIntolerance", generate_allergy_intolerance_data)
+]
+
+# Default cap on the number of GPT calls running at the same time in concurrent generation mode
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("FHIR_GENERATION_MAX_CONCURRENCY", len(FHIR_RESOURCE_TYPES)))
+
+# Tag system of the per-type status in Bundle.meta and attempts per resource type, in partial-success mode
+RESOURCE_STATUS_TAG_SYSTEM = "urn:fhir-test-data-generation:resource-status"
+DEFAULT_MAX_ATTEMPTS = int(os.environ.get("FHIR_RESOURCE_MAX_ATTEMPTS", 3))
+
+# Maximum number of patients and default number of bundles generated at the same time in a single batch request
+MAX_BATCH_PATIENTS = int(os.environ.get("FHIR_BATCH_MAX_PATIENTS", 500))
+DEFAULT_BATCH_CONCURRENCY = int(os.environ.get("FHIR_BATCH_MAX_CONCURRENCY", 4))
+
+
+# Function to collect the user input for a resource type that needs to be included in the FHIR bundle
+def collect_resource_parameters(user_parameters, resource_key, resource_label):
+    resource_parameters = {
+        "data_elements": None,
+        "input_data": None
+    }
+
+    # Check if the resource needs updates
+    if user_parameters.get(f"update_{resource_key}", False):
+        logging.info(f'Resource needs updates. Collecting {resource_label.lower()} user input for data elements and input data.')
+
+        # Collect user input for data elements and input data
+        resource_parameters["data_elements"] = user_parameters.get(f"{resource_key}_data_elements")
+        resource_parameters["input_data"] = user_parameters.get(f"{resource_key}_input_data")
+
+    # Observation data is always generated for the categories provided by the user
+    if resource_key == "observation":
+        resource_parameters["category"] = user_parameters.get("observation_category")
+
+        if user_parameters.get("update_observation", False):
+            if not resource_parameters["data_elements"] or not resource_parameters["input_data"] or not resource_parameters["category"]:
+                logging.error("Data elements, input data, or category not provided for observation updates.")
+                return None, func.HttpResponse(
+                    "Data elements, input data, or category not provided for observation updates.",
+                    status_code=400
+                )
+        elif not resource_parameters["category"]:
+            logging.error("Category not provided for observation data generation.")
+            return None, func.HttpResponse(
+                "Category not provided for observation data generation.",
+                status_code=400
+            )
+    elif user_parameters.get(f"update_{resource_key}", False):
+        if not resource_parameters["data_elements"] or not resource_parameters["input_data"]:
+            logging.error(f"Data elements or input data not provided for {resource_label.lower()} updates.")
+            return None, func.HttpResponse(
+                f"Data elements or input data not provided for {resource_label.lower()} updates.",
+                status_code=400
+            )
+
+    return resource_parameters, None
+
+
+# Function to run the generation calls for the included resource types, either one after another or concurrently
+def run_generation_tasks(generation_tasks, max_concurrency=1):
+    generated_data = {}
+
+    # Sequential generation (default mode)
+    if max_concurrency <= 1 or len(generation_tasks) <= 1:
+        for resource_key, generator, args in generation_tasks:
+            report_progress(resource_key, "running")
+            generated_data[resource_key] = generator(*args)
+            save_checkpoint(resource_key, generated_data[resource_key])
+            complete_resource_data(resource_key, generated_data[resource_key])
+            report_progress(resource_key, "completed" if generated_data[resource_key] else "failed")
+        return generated_data
+
+    # Concurrent generation - every call only needs the patient ID, so all of them can be in flight at once
+    logging.info(f"Generating {len(generation_tasks)} resource types concurrently with max concurrency {max_concurrency}.")
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(generation_tasks))) as executor:
+        futures = {}
+        for resource_key, generator, args in generation_tasks:
+            report_progress(resource_key, "running")
+            futures[submit_with_context(executor, generator, *args)] = resource_key
+        # Handle each resource type as soon as it completes, so it is checkpointed and streamed without waiting for the others
+        for future in as_completed(futures):
+            resource_key = futures[future]
+            try:
+                generated_data[resource_key] = future.result()
+            except Exception as e:
+                logging.error(f"Exception while generating {resource_key} data: {e}")
+                generated_data[resource_key] = None
+            save_checkpoint(resource_key, generated_data[resource_key])
+            complete_resource_data(resource_key, generated_data[resource_key])
+            report_progress(resource_key, "completed" if generated_data[resource_key] else "failed")
+
+    return generated_data
+
+
+# Function to check that the generated data of a resource type can be decoded, so a failed completion can be retried
+def is_resource_data_usable(resource_key, resource_data):
+    return bool(decode_generated_data(resource_key, resource_data))
+
+
+# Function to list the observation types of the categories that were not generated or could not be decoded
+def get_failed_observation_types(category, observation_data):
+    decoded_types = {observation_type for observation_type, _ in decode_generated_data("observation", observation_data)}
+    return [observation_type for observation_type in get_observation_types(category) if observation_type not in decoded_types]
+
+
+# Function to generate the failed observation types again, returning the observation data of every type with the ones
+# that succeeded before kept as they are
+def retry_observation_data(observation_data, patient_id, category, data_elements=None, input_data=None, engine="llm"):
+    failed_types = get_failed_observation_types(category, observation_data)
+    retried = {obs["observation_type"]: obs for obs in generate_observation_data(patient_id, category, data_elements, input_data, engine, failed_types) or []}
+    return [retried.get(obs["observation_type"], obs) if obs["observation_type"] in failed_types else obs for obs in observation_data]
+
+
+# Function to build the tasks of the next attempt: the resource types that failed, and for observations the failed
+# observation types only (a list where some categories failed still counts as generated)
+def get_retry_tasks(generation_tasks, generated_data):
+    retry_tasks = []
+    for resource_key, generator, args in generation_tasks:
+        resource_data = generated_data.get(resource_key)
+        if resource_key == "observation" and resource_data and get_failed_observation_types(args[1], resource_data):
+            retry_tasks.append((resource_key, retry_observation_data, (resource_data, *args)))
+        elif not is_resource_data_usable(resource_key, resource_data):
+            retry_tasks.append((resource_key, generator, args))
+    return retry_tasks
+
+
+# Details requested for each resource type when the whole bundle is generated in a single completion
+ONE_SHOT_RESOURCE_DETAILS = {
+    "patient": "resourceType, id, meta (versionId and lastUpdated), identifiers, names, telecoms, gender, birth date, addresses, marital status, link, contacts, communication, general practitioner, managing organization",
+    "condition": "resourceType, id, meta (versionId and lastUpdated), identifiers, clinical status, verification status, categories, codes, severity, subject, onset period (start and end dates), recorded date, encounter",
+    "encounter": "resourceType, id, meta (versionId and lastUpdated), identifiers, status, type, subject, location, diagnosis",
+    "appointment": "resourceType, id, meta (versionId and lastUpdated), identifiers, status, service category, appointment type, start and end times, minutes duration, creation date, patient instruction",
+    "observation": "resourceType, id, meta (versionId and lastUpdated), identifiers, based on, status, category, code, subject, encounter, effective date/time, issued date, performer, value quantity or components",
+    "service_request": "resourceType, id, meta (versionId and lastUpdated), identifiers, based on, status, intent, category, subject, encounter, occurrence timing, authored on date, requester, specimen",
+    "medication_request": "resourceType, id, meta (versionId and lastUpdated), identifiers, status, intent, category, medication, medication codeable concept, subject, encounter, authored on date, requester, recorder, course of therapy type, dosage instruction, dispense request, prior prescription",
+    "allergy_intolerance": "resourceType, id, meta (versionId and lastUpdated), identifiers, clinical status, verification status, codes, patient, recorded date"
+}
+
+# Maximum number of tokens reserved for the single completion containing the whole bundle
+ONE_SHOT_MAX_TOKENS = int(os.environ.get("FHIR_ONE_SHOT_MAX_TOKENS", 4096))
+
+
+# Function to list the observation types generated for the given categories, in prompt order
+def get_observation_types(category):
+    observation_types = []
+    if 'vital-signs' in category:
+        observation_types.extend(["heart_rate", "blood_pressure"])
+    if 'laboratory' in category:
+        observation_types.append("laboratory")
+    return observation_types
+
+
+# Function to get the codes of the codings of a CodeableConcept, or of a list of them, ignoring malformed elements
+def get_coding_codes(concepts):
+    concepts = concepts if isinstance(concepts, list) else [concepts]
+    return {
+        coding.get("code")
+        for concept in concepts if isinstance(concept, dict)
+        for coding in concept.get("coding") or [] if isinstance(coding, dict)
+    }
+
+
+# Function to get the observation type of a generated Observation from its own category (and code, to tell the vital
+# signs apart), rather than from its position in the generated bundle
+def get_observation_type(observation):
+    category_codes = get_coding_codes(observation.get("category"))
+    if "laboratory" in category_codes:
+        return "laboratory"
+    if "vital-signs" in category_codes:
+        return "blood_pressure" if "85354-9" in get_coding_codes(observation.get("code")) or observation.get("component") else "heart_rate"
+    return "observation"
+
+
+# Function to generate the patient and all the included resource types in a single completion
+def generate_bundle_data_one_shot(patient_data_elements, patient_input_data, included_resources):
+    logging.info('Generating the whole FHIR bundle in a single completion.')
+
+    prompt = '''
+    Generate realistic healthcare data in the FHIR format as a single Bundle resourceType of type collection.
+    The Bundle entries should contain one Patient resourceType and the following resourceTypes, all linked to that Patient FHIR ID.
+    Return only the JSON Bundle.
+    '''
+    prompt += f"\n    - Patient including details such as - {ONE_SHOT_RESOURCE_DETAILS['patient']}"
+    if patient_data_elements:
+        prompt += f" with data elements: {patient_data_elements}"
+    if patient_input_data:
+        prompt += f" with input data: {patient_input_data}"
+
+    for resource_key, _, resource_type, _ in FHIR_RESOURCE_TYPES:
+        if resource_key not in included_resources:
+            continue
+        resource_parameters = included_resources[resource_key]
+        if resource_key == "observation":
+            observation_types = ", ".join(observation_type.replace("_", " ") for observation_type in get_observation_types(resource_parameters["category"]))
+            prompt += f"\n    - One {resource_type} for each of: {observation_types}, including details such as - {ONE_SHOT_RESOURCE_DETAILS[resource_key]}"
+        else:
+            prompt += f"\n    - {resource_type} including details such as - {ONE_SHOT_RESOURCE_DETAILS[resource_key]}"
+        if resource_parameters["data_elements"]:
+            prompt += f" with data elements: {resource_parameters['data_elements']}"
+        if resource_parameters["input_data"]:
+            prompt += f" with input data: {resource_parameters['input_data']}"
+
+    prompt += '''
+    Make sure none of the specified fields are missing.
+    Also, add appropriate SNOMED, LOINC, and RXNorm codes wherever necessary.
+    '''
+
+    bundle_data = generate_fhir_data_using_gpt(prompt, max_tokens=ONE_SHOT_MAX_TOKENS, resource_type="Bundle")
+    if not bundle_data:
+        logging.error("Failed to generate the FHIR bundle in a single completion.")
+        return {}
+
+    bundle_data_json = clean_fhir_data(bundle_data)
+    if not isinstance(bundle_data_json, dict):
+        logging.error("Failed to decode the FHIR bundle generated in a single completion.")
+        return {}
+
+    # Split the generated bundle into its resources, grouped by resource type
+    resources_by_type = {}
+    for entry in bundle_data_json.get("entry", []):
+        resource = entry.get("resource") if isinstance(entry, dict) else None
+        if isinstance(resource, dict) and resource.get("resourceType"):
+            resources_by_type.setdefault(resource["resourceType"], []).append(resource)
+
+    # The other resources reference the patient of the completion, so they are only kept with it (as with checkpoints)
+    if not resources_by_type.get("Patient"):
+        logging.error("The FHIR bundle generated in a single completion has no Patient, falling back to per-resource generation.")
+        return {}
+
+    # Return the resources in the same shape as the per-resource generators, so they follow the same processing
+    generated_data = {"patient": json.dumps(resources_by_type["Patient"][0])}
+    for resource_key, _, resource_type, _ in FHIR_RESOURCE_TYPES:
+        if resource_key not in included_resources or not resources_by_type.get(resource_type):
+            continue
+        if resource_key == "observation":
+            generated_data[resource_key] = [
+                {"observation_type": get_observation_type(resource), "data": json.dumps(resource)}
+                for resource in resources_by_type[resource_type]
+            ]
+        else:
+            generated_data[resource_key] = json.dumps(resources_by_type[resource_type][0])
+
+    logging.info(f"Single completion generated data for: {list(generated_data)}")
+    return generated_data
+
+
+def generate_fhir_bundle(user_parameters, blob_name_prefix="", progress_callback=None, ndjson_writer=None, entry_callback=None):
+    # Check the offline config before it seeds the random generator of the request
+    try:
+        validate_offline_config(user_parameters.get("offline_config"))
+    except ValueError as e:
+        logging.error(f"Invalid offline config provided: {e}")
+        return func.HttpResponse(str(e), status_code=400)
+
+    # Run the generation with its own request context, so the metrics of concurrent bundles don't mix
+    token = generation_context.set(create_generation_context(user_parameters, progress_callback, entry_callback))
+    try:
+        return create_fhir_bundle(user_parameters, blob_name_prefix, ndjson_writer)
+    finally:
+        generation_context.reset(token)
+
+
+# Function to generate the FHIR bundle for a single patient and store it in Azure Blob Storage
+def create_fhir_bundle(user_parameters, blob_name_prefix="", ndjson_writer=None):
     logging.info('Generating FHIR resource.')
+    generation_start_time = time.perf_counter()
 
     # -------------------- Combined FHIR data -------------------------
     # Combine FHIR bundle (patient, condition, encounter, appointment, observation, service request, medication request, allergy intolerance data)
@@ -297,20 +1043,106 @@ def generate_fhir_bundle(user_parameters):
                 "Data elements or input data not provided for patient updates.",  
                 status_code=400  
             )
-        
-        patient_data = generate_patient_data(patient_data_elements, patient_input_data)  
+
+    # Check which engine generates the resources
+    engine = user_parameters.get("generation_engine", "llm")
+    if engine not in GENERATION_ENGINES:
+        logging.error(f"Invalid generation engine provided: {engine}")
+        return func.HttpResponse(
+            f"generation_engine must be one of: {', '.join(GENERATION_ENGINES)}.",
+            status_code=400
+        )
+
+    # Check the layout the generated data is stored in
+    output_format = user_parameters.get("output_format", "bundle")
+    if output_format not in OUTPUT_FORMATS:
+        logging.error(f"Invalid output format provided: {output_format}")
+        return func.HttpResponse(
+            f"output_format must be one of: {', '.join(OUTPUT_FORMATS)}.",
+            status_code=400
+        )
+
+    # Collect user input for all the included resource types before paying for any generation
+    included_resources = {}
+    for resource_key, resource_label, _, _ in FHIR_RESOURCE_TYPES:
+        if user_parameters.get(f"include_{resource_key}", False):
+            resource_parameters, error_response = collect_resource_parameters(user_parameters, resource_key, resource_label)
+            if error_response:
+                return error_response
+            included_resources[resource_key] = resource_parameters
+
+    for resource_key in ["patient", *included_resources]:
+        report_progress(resource_key, "pending")
+
+    # Check if the resource types should be generated concurrently
+    if user_parameters.get("concurrent_generation", False):
+        max_concurrency = int(user_parameters.get("max_concurrency", DEFAULT_MAX_CONCURRENCY))
+        # Cap every GPT call of the bundle, including the observation category prompts each sent from their own pool
+        generation_context.get()["gpt_semaphore"] = threading.BoundedSemaphore(max(1, max_concurrency))
+    else:
+        max_concurrency = 1
+
+    # Check if each resource should be validated (and repaired) before the bundle is stored
+    validation_results = [] if user_parameters.get("validate_resources", False) else None
+
+    # Check if the bundle should keep the resource types that succeeded when others fail
+    partial_success = user_parameters.get("partial_success", False)
+    max_attempts = max(1, int(user_parameters.get("max_attempts", DEFAULT_MAX_ATTEMPTS))) if partial_success else 1
+
+    # Resume from the resource types checkpointed by a previous attempt with the same bundle ID
+    bundle_id = user_parameters.get("bundle_id")
+    generated_data = {}
+    if bundle_id:
+        if not isinstance(bundle_id, str) or not BUNDLE_ID_PATTERN.match(bundle_id):
+            logging.error(f"Invalid bundle ID provided: {bundle_id}")
+            return func.HttpResponse(
+                "bundle_id must be 1 to 64 letters, digits, '-' or '_'.",
+                status_code=400
+            )
+        checkpoint = checkpoint_store.load(bundle_id)
+        # The other resource types reference the checkpointed patient, so they are only reused with it
+        if "patient" in checkpoint:
+            generated_data = {
+                resource_key: resource_data for resource_key, resource_data in checkpoint.items()
+                if resource_key == "patient" or resource_key in included_resources
+            }
+            logging.info(f"Resuming bundle {bundle_id} with checkpointed data for: {list(generated_data)}")
+            for resource_key in generated_data:
+                report_progress(resource_key, "completed")
+    resumed_resources = list(generated_data)
+
+    # Generate the patient and all the included resource types in a single completion if requested
+    if user_parameters.get("one_shot", False) and engine == "llm" and not generated_data:
+        generated_data = generate_bundle_data_one_shot(patient_data_elements, patient_input_data, included_resources)
+        for resource_key, resource_data in generated_data.items():
+            save_checkpoint(resource_key, resource_data)
+            report_progress(resource_key, "completed")
+
+    if "patient" not in generated_data:
+        report_progress("patient", "running")
+    if "patient" in generated_data:
+        patient_data = generated_data.pop("patient")
+    elif user_parameters.get("update_patient", False):
+        patient_data = generate_patient_data(patient_data_elements, patient_input_data, engine)  
     # Else if the resource doesn't need updates
     else:         
-        patient_data = generate_patient_data()    # Simply generate patient data
+        patient_data = generate_patient_data(engine=engine)    # Simply generate patient data
 
     if not patient_data:  
+        report_progress("patient", "failed")
         return func.HttpResponse("Failed to generate Patient data.", status_code=500)  
+    if "patient" not in resumed_resources:
+        save_checkpoint("patient", patient_data)
+    report_progress("patient", "completed")
       
     try:
-        # Clean up the generated FHIR data to extract valid JSON
-        patient_data_json = clean_fhir_data(patient_data)  
+        # Clean up the generated FHIR data to extract valid JSON (and validate it if requested)
+        completed_patient = complete_resource_data("patient", patient_data)
+        patient_data_json = completed_patient[0]["resource"] if completed_patient else None
         if not patient_data_json:  
             return func.HttpResponse("Failed to decode generated Patient data.", status_code=500)
+        if completed_patient[0]["validation_result"]:
+            validation_results.append(completed_patient[0]["validation_result"])
         
         # Append patient data to the combined JSON FHIR bundle
         if patient_data_json:  
@@ -322,6 +1154,16 @@ def generate_fhir_bundle(user_parameters):
         
         # Set success data for patient
         patient_id = patient_data_json.get("id", "unknown_patient")
+
+        # Append each resource to the NDJSON files of its type as soon as it completes - written for this patient only,
+        # or held until the bundle is stored when the files are shared by the whole batch
+        if output_format == "ndjson":
+            generation_context.get()["ndjson_writer"] = NdjsonBundleBuffer(ndjson_writer) if ndjson_writer else NdjsonExportWriter(f"{blob_name_prefix}generated_fhir_ndjson_{patient_id}/")
+            generation_context.get()["ndjson_writer"].append(patient_data_json)
+
+        # Complete (and stream) the resource types already available after the patient, checkpointed or from the single completion
+        for resource_key, resource_data in generated_data.items():
+            complete_resource_data(resource_key, resource_data)
         success_data["patient"] = {  
             "message": f"Patient data for ID: Patient/{patient_id} generated successfully.",
             "patient_data_elements": patient_data_elements
@@ -330,289 +1172,94 @@ def generate_fhir_bundle(user_parameters):
         # Append patient success data to the combined success data
         combined_success_data["patient"] = success_data["patient"] 
 
-        # -------------------- Condition data -------------------------
-        # Initialize condition data
-        condition_data_elements = None  
-        condition_input_data = None  
-
-        # Generate condition data if specified by user
-        condition_data_json = None  
-        if user_parameters.get("include_condition", False):  
+        # -------------------- Included resource data -------------------------
+        # Generate data for all the resource types specified by user
+        if included_resources:
             patient_id = patient_data_json.get("id")  
             if not patient_id:  
                 logging.error("Patient ID not found in generated patient data.")  
                 return func.HttpResponse("Patient ID not found.", status_code=500)
-            
-            # Check if the resource needs updates
-            if user_parameters.get("update_condition", False):  
-                logging.info('Resource needs updates. Collecting condition user input for data elements and input data.')  
-  
-                # Collect user input for data elements and input data  
-                condition_data_elements = user_parameters.get("condition_data_elements")  
-                condition_input_data = user_parameters.get("condition_input_data")  
-  
-                if not condition_data_elements or not condition_input_data:  
-                    logging.error("Data elements or input data not provided for condition updates.")  
-                    return func.HttpResponse(  
-                        "Data elements or input data not provided for condition updates.",  
-                        status_code=400  
-                    )
-                
-                condition_data = generate_condition_data(patient_id, condition_data_elements, condition_input_data)  
-            # Else if the resource doesn't need updates
-            else:         
-                condition_data = generate_condition_data(patient_id)    # Simply generate condition data for the patient
-  
-            if not condition_data:  
-                return func.HttpResponse("Failed to generate Condition data.", status_code=500)
-
-            try:
-                # Clean up the generated FHIR data to extract valid JSON
-                condition_data_json = clean_fhir_data(condition_data)  
-                if not condition_data_json:  
-                    return func.HttpResponse("Failed to decode generated Condition data.", status_code=500)
-                logging.info("Condition data generated successfully.")
-
-                # Append condition data to the combined JSON FHIR bundle
-                if condition_data_json:  
-                    combined_data["entry"].append({  
-                        "fullUrl": f"urn:uuid:{condition_data_json['id']}",  
-                        "resource": condition_data_json  
-                    })  
-                    logging.info(f"Condition Data for {condition_data_json['id']} appended successfully.")
-
-                # Set success data for condition  
-                if condition_data_json:  
-                    condition_id = condition_data_json.get("id", "unknown_condition")  
-                    success_data["condition"] = {  
-                        "message": f"Condition data for Condition/{condition_id} generated successfully.",  
-                        "condition_data_elements": condition_data_elements
-                    } 
-
-                # Append condition success data to the combined success data
-                if condition_data_json:
-                    combined_success_data["condition"] = success_data["condition"] 
 
-            except Exception as e:  
-                logging.error(f"Exception while processing Condition data: {e}")  
-                logging.error(f"Generated Condition data: {condition_data}")  
-                return func.HttpResponse(
-                    "An error occurred while processing the generated Condition data.", 
-                    status_code=500
-                )
-        
-        # -------------------- Encounter data -------------------------
-        # Initialize encounter data
-        encounter_data_elements = None  
-        encounter_input_data = None 
-
-        # Generate encounter data if specified by user  
-        encounter_data_json = None  
-        if user_parameters.get("include_encounter", False):  
-            patient_id = patient_data_json.get("id")  
-            if not patient_id:  
-                logging.error("Patient ID not found in generated patient data.")  
-                return func.HttpResponse("Patient ID not found.", status_code=500)
-            
-            # Check if the resource needs updates  
-            if user_parameters.get("update_encounter", False):  
-                logging.info('Resource needs updates. Collecting encounter user input for data elements and input data.')  
-                
-                # Collect user input for data elements and input data  
-                encounter_data_elements= user_parameters.get("encounter_data_elements")  
-                encounter_input_data = user_parameters.get("encounter_input_data")  
-  
-                if not encounter_data_elements or not encounter_input_data:  
-                    logging.error("Data elements or input data not provided for encounter updates.")  
-                    return func.HttpResponse(  
-                        "Data elements or input data not provided for encounter updates.",  
-                        status_code=400  
-                    )
-                
-                encounter_data = generate_encounter_data(patient_id, encounter_data_elements, encounter_input_data)
-            # Else if the resource doesn't need updates
+        # Generate any resource type that is not already available (e.g. missing from the single completion)
+        generation_tasks = []
+        for resource_key, _, _, generator in FHIR_RESOURCE_TYPES:
+            if resource_key not in included_resources or resource_key in generated_data:
+                continue
+            resource_parameters = included_resources[resource_key]
+            if resource_key == "observation":
+                args = (patient_id, resource_parameters["category"], resource_parameters["data_elements"], resource_parameters["input_data"], engine)
             else:
-                encounter_data = generate_encounter_data(patient_id)    # Simply generate encounter data for the patient  
-  
-            if not encounter_data:  
-                return func.HttpResponse("Failed to generate Encounter data.", status_code=500)
-            
-            try:
-                # Clean up the generated FHIR data to extract valid JSON
-                encounter_data_json = clean_fhir_data(encounter_data)  
-                if not encounter_data_json:  
-                    return func.HttpResponse("Failed to decode generated Encounter data.", status_code=500)
-                logging.info("Encounter data generated successfully.")
-
-                # Append encounter data to the combined JSON FHIR bundle
-                if encounter_data_json:  
-                    combined_data["entry"].append({  
-                        "fullUrl": f"urn:uuid:{encounter_data_json['id']}",
-                        "resource": encounter_data_json  
-                    })
-                    logging.info(f"Encounter Data for {encounter_data_json['id']} appended successfully.")
-
-                # Set success data for encounter
-                if encounter_data_json:  
-                    encounter_id = encounter_data_json.get("id", "unknown_encounter")  
-                    success_data["encounter"] = {  
-                        "message": f"Encounter data for Encounter/{encounter_id} generated successfully.",  
-                        "encounter_data_elements": encounter_data_elements  
-                    } 
-
-                # Append encounter success data to the combined success data
-                if encounter_data_json:
-                    combined_success_data["encounter"] = success_data["encounter"] 
+                args = (patient_id, resource_parameters["data_elements"], resource_parameters["input_data"], engine)
+            generation_tasks.append((resource_key, generator, args))
+
+        if generated_data and generation_tasks:
+            logging.info(f"Falling back to per-resource generation for: {[task[0] for task in generation_tasks]}")
+        fallback_resources = [task[0] for task in generation_tasks] if user_parameters.get("one_shot", False) else []
+        generated_data.update(run_generation_tasks(generation_tasks, max_concurrency))
+        attempts = {resource_key: 1 for resource_key in included_resources}
+
+        # Retry each failed resource type on its own, up to the maximum number of attempts
+        for attempt in range(2, max_attempts + 1):
+            retry_tasks = get_retry_tasks(generation_tasks, generated_data)
+            if not retry_tasks:
+                break
+            logging.info(f"Retrying failed resource types (attempt {attempt} of {max_attempts}): {[task[0] for task in retry_tasks]}")
+            generation_context.get()["use_cache"] = False        # A cached response would fail the same way
+            generated_data.update(run_generation_tasks(retry_tasks, max_concurrency))
+            for resource_key, _, _ in retry_tasks:
+                attempts[resource_key] = attempt
+        failed_resources = {}
+
+        # Append the generated data to the combined JSON FHIR bundle in the original resource order
+        for resource_key, resource_label, resource_type, _ in FHIR_RESOURCE_TYPES:
+            if resource_key not in included_resources:
+                continue
+            resource_parameters = included_resources[resource_key]
+            resource_data = generated_data.get(resource_key)
+            completed = generation_context.get()["completed_resources"].get(resource_key, [])
+
+            if not resource_data:  
+                if partial_success:
+                    failed_resources[resource_key] = f"Failed to generate {resource_label} data."
+                    continue
+                return func.HttpResponse(f"Failed to generate {resource_label} data.", status_code=500)
+
+            # -------------------- Observation data -------------------------
+            if resource_key == "observation":
+                observation_id = "unknown_observation"
+                try:
+                    for obs in completed:
+                        observation_type = obs["observation_type"]
+                        observation_entry = {
+                            "observation_type": observation_type
+                        }
+                        if resource_parameters["category"]:  
+                            observation_entry["observation_category"] = resource_parameters["category"]
+                        if resource_parameters["data_elements"]:  
+                            observation_entry["observation_data_elements"] = resource_parameters["data_elements"]  
+
+                        # The generated FHIR data was decoded (and validated if requested) as soon as it completed
+                        observation_data_json = obs["resource"]
+                        if observation_data_json:
+                            if obs["validation_result"]:
+                                validation_results.append(obs["validation_result"])
+                            # Append observation data to the combined JSON FHIR bundle one-at-a-time
+                            observation_id = observation_data_json.get("id", "unknown_observation")
+                            combined_data["entry"].append({  
+                                "fullUrl": f"urn:uuid:{observation_id}",  
+                                "resource": observation_data_json
+                            })
+                            logging.info(f"Observation Data for {observation_id} appended successfully.")
+                            observation_entry["status"] = "success"
+                            observation_entry["message"] = f"Observation data for ID:Observation/{observation_id} generated successfully."
+                        # Keep the observations that already succeeded and report the failed category
+                        elif obs["data"]:
+                            observation_entry["status"] = "error"
+                            observation_entry["message"] = f"Failed to decode generated Observation data for {observation_type}."
+                        else:
+                            observation_entry["status"] = "error"
+                            observation_entry["message"] = f"Failed to generate Observation data for {observation_type}."
 
-            except Exception as e:  
-                logging.error(f"Exception while processing Encounter data: {e}")  
-                logging.error(f"Generated Encounter data: {encounter_data}")  
-                return func.HttpResponse(  
-                    "An error occurred while processing the generated Encounter data.",  
-                    status_code=500  
-                )
-        
-        # -------------------- Appointment data -------------------------
-        # Initialize appointment data
-        appointment_data_elements = None  
-        appointment_input_data = None 
-
-        # Generate appointment data if specified by user  
-        appointment_data_json = None  
-        if user_parameters.get("include_appointment", False):  
-            patient_id = patient_data_json.get("id")  
-            if not patient_id:  
-                logging.error("Patient ID not found in generated patient data.")  
-                return func.HttpResponse("Patient ID not found.", status_code=500)
-            
-            # Check if the resource needs updates  
-            if user_parameters.get("update_appointment", False):  
-                logging.info('Resource needs updates. Collecting appointment user input for data elements and input data.')  
-                
-                # Collect user input for data elements and input data  
-                appointment_data_elements = user_parameters.get("appointment_data_elements")  
-                appointment_input_data = user_parameters.get("appointment_input_data")  
-  
-                if not appointment_data_elements or not appointment_input_data:  
-                    logging.error("Data elements or input data not provided for appointment updates.")  
-                    return func.HttpResponse(  
-                        "Data elements or input data not provided for appointment updates.",  
-                        status_code=400  
-                    )
-                
-                appointment_data = generate_appointment_data(patient_id, appointment_data_elements, appointment_input_data)  
-            # Else if the resource doesn't need updates
-            else:  
-                appointment_data = generate_appointment_data(patient_id)  # Simply generate appointment data for the patient  
-  
-            if not appointment_data:  
-                return func.HttpResponse("Failed to generate Appointment data.", status_code=500)
-            
-            try:
-                # Clean up the generated FHIR data to extract valid JSON
-                appointment_data_json = clean_fhir_data(appointment_data)  
-                if not appointment_data_json:  
-                    return func.HttpResponse("Failed to decode generated Appointment data.", status_code=500)
-            
-                logging.info("Appointment data generated successfully.")
-
-                # Append appointment data to the combined JSON FHIR bundle
-                if appointment_data_json:  
-                    combined_data["entry"].append({  
-                        "fullUrl": f"urn:uuid:{appointment_data_json['id']}",  
-                        "resource": appointment_data_json  
-                    })          
-                    logging.info("Appointment data appended successfully.")
-
-                # Set success data for appointment  
-                if appointment_data_json:  
-                    appointment_id = appointment_data_json.get("id", "unknown_appointment")  
-                    success_data["appointment"] = {  
-                        "message": f"Appointment data for Appointment/{appointment_id} generated successfully.",  
-                        "appointment_data_elements": appointment_data_elements
-                    }
-
-                # Append appointment success data to the combined success data
-                if appointment_data_json:
-                    combined_success_data["appointment"] = success_data["appointment"] 
-
-            except Exception as e:  
-                logging.error(f"Exception while processing Appointment data: {e}")  
-                logging.error(f"Generated Appointment data could not be processed due to an error.")  
-                return func.HttpResponse(  
-                    "An error occurred while processing the generated Appointment data.",  
-                    status_code=500  
-                )
-        
-        # -------------------- Observation data -------------------------
-        # Initialize observation data
-        observation_data_elements = None  
-        observation_input_data = None
-        observation_category = None
-
-        # Generate observation data if specified by user  
-        observation_data_json = None  
-        if user_parameters.get("include_observation", False):  
-            patient_id = patient_data_json.get("id")  
-            if not patient_id:  
-                logging.error("Patient ID not found in generated patient data.")  
-                return func.HttpResponse("Patient ID not found.", status_code=500)
-            
-            # Check if the resource needs updates  
-            if user_parameters.get("update_observation", False):  
-                logging.info('Resource needs updates. Collecting observation user input for data elements and input data.')  
-                
-                # Collect user input for data elements and input data  
-                observation_data_elements = user_parameters.get("observation_data_elements")  
-                observation_input_data = user_parameters.get("observation_input_data")  
-                observation_category = user_parameters.get("observation_category")
-  
-                if not observation_data_elements or not observation_input_data or not observation_category:  
-                    logging.error("Data elements, input data, or category not provided for observation updates.")  
-                    return func.HttpResponse(  
-                        "Data elements, input data, or category not provided for observation updates.",  
-                        status_code=400  
-                    )
-
-                observation_data = generate_observation_data(patient_id, observation_category, observation_data_elements, observation_input_data)
-            # Else if the resource doesn't need updates
-            else:  
-                observation_category = user_parameters.get("observation_category")
-                if not observation_category:  
-                    logging.error("Category not provided for observation data generation.")  
-                    return func.HttpResponse(  
-                        "Category not provided for observation data generation.",  
-                        status_code=400  
-                    )
-  
-                observation_data = generate_observation_data(patient_id, observation_category)
-        
-            if not observation_data:  
-                return func.HttpResponse("Failed to generate Observation data.", status_code=500)
-
-            try:
-                for obs in observation_data:
-                    try:
-                        # Clean up the generated FHIR data to extract valid JSON
-                        observation_data_json = clean_fhir_data(obs) 
-                        if not observation_data_json:  
-                            return func.HttpResponse("Failed to decode generated observation data.", status_code=500)
-
-                        # Append observation data to the combined JSON FHIR bundle one-at-a-time
-                        observation_id = observation_data_json.get("id", "unknown_observation")
-                        combined_data["entry"].append({  
-                            "fullUrl": f"urn:uuid:{observation_id}",  
-                            "resource": observation_data_json
-                        })
-                        logging.info(f"Observation Data for {observation_id} appended successfully.")
-                        observation_entry = {  
-                            "message": f"Observation data for ID:Observation/{observation_id} generated successfully."  
-                        }  
-                        if observation_category:  
-                            observation_entry["observation_category"] = observation_category
-                        if observation_data_elements:  
-                            observation_entry["observation_data_elements"] = observation_data_elements  
-                        
                         # Set success data for all the observation entries in a list
                         if "observation" not in success_data:  
                             success_data["observation"] = []  
@@ -620,236 +1267,87 @@ def generate_fhir_bundle(user_parameters):
   
                         # Append observation success data to the combined success data  
                         combined_success_data["observation"] = success_data["observation"]  
-                    
-                    except Exception as e:  
-                        logging.error(f"Exception while processing Observation data for ID:Observation/{observation_id}: {e}")
-                        return func.HttpResponse(  
-                            f"An error occurred while processing the generated Observation data for ID:Observation/{observation_id}",  
-                            status_code=500  
-                        )
-            
-            except Exception as e:  
-                logging.error(f"Exception while processing Observation data: {e}")
-                return func.HttpResponse(  
-                    "An error occurred while processing the generated Observation data.",  
-                    status_code=500  
-                )
-        
-        # -------------------- Service Request data -------------------------
-        # Initialize Service Request data
-        service_request_data_elements = None  
-        service_request_input_data = None 
-
-        # Generate service request data if specified by user  
-        service_request_data_json = None  
-        if user_parameters.get("include_service_request", False):  
-            patient_id = patient_data_json.get("id")  
-            if not patient_id:  
-                logging.error("Patient ID not found in generated patient data.")  
-                return func.HttpResponse("Patient ID not found.", status_code=500)
-            
-            # Check if the resource needs updates  
-            if user_parameters.get("update_service_request", False):  
-                logging.info('Resource needs updates. Collecting service request user input for data elements and input data.')  
                 
-                # Collect user input for data elements and input data  
-                service_request_data_elements = user_parameters.get("service_request_data_elements")  
-                service_request_input_data = user_parameters.get("service_request_input_data")  
-  
-                if not service_request_data_elements or not service_request_input_data:  
-                    logging.error("Data elements or input data not provided for service request updates.")  
+                except Exception as e:  
+                    logging.error(f"Exception while processing Observation data for ID:Observation/{observation_id}: {e}")
+                    if partial_success:
+                        failed_resources[resource_key] = f"An error occurred while processing the generated Observation data for ID:Observation/{observation_id}"
+                        continue
                     return func.HttpResponse(  
-                        "Data elements or input data not provided for service request updates.",  
-                        status_code=400  
-                    )  
-  
-                service_request_data = generate_service_request_data(patient_id, service_request_data_elements, service_request_input_data)
-            # Else if the resource doesn't need updates
-            else:  
-                service_request_data = generate_service_request_data(patient_id)  # Simply generate service request data for the patient  
-  
-            if not service_request_data:  
-                return func.HttpResponse("Failed to generate Service Request data.", status_code=500)
-            
-            try:
-                # Clean up the generated FHIR data to extract valid JSON
-                service_request_data_json = clean_fhir_data(service_request_data)  
-                if not service_request_data_json:  
-                    return func.HttpResponse("Failed to decode generated Service Request data.", status_code=500)  
-                
-                logging.info("Service Request data generated successfully.")
-
-                # Append service-request data to the combined JSON FHIR bundle
-                if service_request_data_json:  
-                    combined_data["entry"].append({  
-                        "fullUrl": f"urn:uuid:{service_request_data_json['id']}",  
-                        "resource": service_request_data_json  
-                    })
-                    logging.info(f"Service Request Data for {service_request_data_json['id']} appended successfully.")
-
-                # Set success data for service-request  
-                if service_request_data_json:  
-                    service_request_id = service_request_data_json.get("id", "unknown_service_request")  
-                    success_data["service_request"] = {  
-                        "message": f"ServiceRequest data for ServiceRequest/{service_request_id} generated successfully.",
-                        "service_request_data_elements": service_request_data_elements
-                    }
+                        f"An error occurred while processing the generated Observation data for ID:Observation/{observation_id}",  
+                        status_code=500  
+                    )
 
-                # Append service_request success data to the combined success data
-                if service_request_data_json:
-                    combined_success_data["service_request"] = success_data["service_request"] 
+                if not any(obs_entry["status"] == "success" for obs_entry in success_data["observation"]):
+                    if partial_success:
+                        failed_resources[resource_key] = "Failed to decode generated observation data."
+                        continue
+                    return func.HttpResponse("Failed to decode generated observation data.", status_code=500)
+                continue
 
-            except Exception as e:  
-                logging.error(f"Exception while processing Service Request data: {e}")  
-                logging.error(f"Generated Service Request data could not be processed due to an error.")  
-                return func.HttpResponse(  
-                    "An error occurred while processing the generated Service Request data.",  
-                    status_code=500  
-                )
-        
-        # -------------------- Medication Request data -------------------------
-        # Initialize Medication Request data
-        medication_request_data_elements = None  
-        medication_request_input_data = None 
-
-        # Generate medication request data if specified by user  
-        medication_request_data_json = None  
-        if user_parameters.get("include_medication_request", False):  
-            patient_id = patient_data_json.get("id")  
-            if not patient_id:  
-                logging.error("Patient ID not found in generated patient data.")  
-                return func.HttpResponse("Patient ID not found.", status_code=500)
-            
-            # Check if the resource needs updates  
-            if user_parameters.get("update_medication_request", False):  
-                logging.info('Resource needs updates. Collecting medication request user input for data elements and input data.')  
-                
-                # Collect user input for data elements and input data  
-                medication_request_data_elements = user_parameters.get("medication_request_data_elements")  
-                medication_request_input_data = user_parameters.get("medication_request_input_data")
-                
-                if not medication_request_data_elements or not medication_request_input_data:
-                    logging.error("Data elements or input data not provided for medication request updates.")  
-                    return func.HttpResponse(  
-                        "Data elements or input data not provided for medication request updates.",  
-                        status_code=400  
-                    )
-                
-                medication_request_data = generate_medication_request_data(patient_id, medication_request_data_elements, medication_request_input_data)
-            # Else if the resource doesn't need updates
-            else:  
-                medication_request_data = generate_medication_request_data(patient_id)  # Simply generate medication request data for the patient  
-        
-            if not medication_request_data:  
-                return func.HttpResponse("Failed to generate Medication Request data.", status_code=500)  
-        
+            # -------------------- Condition, Encounter, Appointment, Service Request, Medication Request, Allergy Intolerance data -------------------------
             try:
-                # Clean up the generated FHIR data to extract valid JSON  
-                medication_request_data_json = clean_fhir_data(medication_request_data)  
-                if not medication_request_data_json:  
-                    return func.HttpResponse("Failed to decode generated Medication Request data.", status_code=500)
-                
-                logging.info("Medication Request data generated successfully.")
-
-                # Append medication-request data to the combined JSON FHIR bundle
-                if medication_request_data_json:  
-                    combined_data["entry"].append({  
-                        "fullUrl": f"urn:uuid:{medication_request_data_json['id']}",  
-                        "resource": medication_request_data_json  
-                    })
-                    logging.info(f"Medication Request Data for {medication_request_data_json['id']} appended successfully.")
-
-                # Set success data for medication-request
-                if medication_request_data_json:  
-                    medication_request_id = medication_request_data_json.get("id", "unknown_medication_request")  
-                    success_data["medication_request"] = {  
-                        "message": f"MedicationRequest data for MedicationRequest/{medication_request_id} generated successfully.",  
-                        "medication_request_data_elements": medication_request_data_elements
-                    }
-
-                # Append medication_request success data to the combined success data
-                if medication_request_data_json:
-                    combined_success_data["medication_request"] = success_data["medication_request"] 
+                # The generated FHIR data was decoded (and validated if requested) as soon as it completed
+                resource_data_json = completed[0]["resource"] if completed else None
+                if not resource_data_json:  
+                    if partial_success:
+                        failed_resources[resource_key] = f"Failed to decode generated {resource_label} data."
+                        continue
+                    return func.HttpResponse(f"Failed to decode generated {resource_label} data.", status_code=500)
+                logging.info(f"{resource_label} data generated successfully.")
+                if completed[0]["validation_result"]:
+                    validation_results.append(completed[0]["validation_result"])
+
+                # Append resource data to the combined JSON FHIR bundle
+                combined_data["entry"].append({  
+                    "fullUrl": f"urn:uuid:{resource_data_json['id']}",  
+                    "resource": resource_data_json  
+                })  
+                logging.info(f"{resource_label} Data for {resource_data_json['id']} appended successfully.")
+
+                # Set success data for the resource
+                resource_id = resource_data_json.get("id", f"unknown_{resource_key}")  
+                success_data[resource_key] = {  
+                    "message": f"{resource_type} data for {resource_type}/{resource_id} generated successfully.",  
+                    f"{resource_key}_data_elements": resource_parameters["data_elements"]
+                } 
+
+                # Append resource success data to the combined success data
+                combined_success_data[resource_key] = success_data[resource_key] 
 
             except Exception as e:  
-                logging.error(f"Exception while processing Medication Request data: {e}")  
-                logging.error(f"Generated Medication Request data could not be processed due to an error.")  
-                return func.HttpResponse(  
-                    "An error occurred while processing the generated Medication Request data.",  
-                    status_code=500  
+                logging.error(f"Exception while processing {resource_label} data: {e}")  
+                logging.error(f"Generated {resource_label} data could not be processed due to an error.")  
+                if partial_success:
+                    failed_resources[resource_key] = f"An error occurred while processing the generated {resource_label} data."
+                    continue
+                return func.HttpResponse(
+                    f"An error occurred while processing the generated {resource_label} data.", 
+                    status_code=500
                 )
-        
-        # -------------------- Allergy Intolerance data -------------------------
-        # Initialize Allergy Intolerance data
-        allergy_intolerance_data_elements = None  
-        allergy_intolerance_input_data = None
-        
-        # Generate allergy intolerance data if specified by user  
-        allergy_intolerance_data_json = None  
-        if user_parameters.get("include_allergy_intolerance", False):  
-            patient_id = patient_data_json.get("id")  
-            if not patient_id:  
-                logging.error("Patient ID not found in generated patient data.")  
-                return func.HttpResponse("Patient ID not found.", status_code=500)
-            
-            # Check if the resource needs updates  
-            if user_parameters.get("update_allergy_intolerance", False):  
-                logging.info('Resource needs updates. Collecting allergy intolerance user input for data elements and input data.')  
-                
-                # Collect user input for data elements and input data  
-                allergy_intolerance_data_elements = user_parameters.get("allergy_intolerance_data_elements")  
-                allergy_intolerance_input_data = user_parameters.get("allergy_intolerance_input_data")  
-    
-                if not allergy_intolerance_data_elements or not allergy_intolerance_input_data:
-                    logging.error("Data elements or input data not provided for allergy intolerance updates.")  
-                    return func.HttpResponse(  
-                        "Data elements or input data not provided for allergy intolerance updates.",  
-                        status_code=400  
-                    )  
-                
-                allergy_intolerance_data = generate_allergy_intolerance_data(patient_id, allergy_intolerance_data_elements, allergy_intolerance_input_data)
-            # Else if the resource doesn't need updates
-            else:  
-                allergy_intolerance_data = generate_allergy_intolerance_data(patient_id)  # Simply generate allergy intolerance data for the patient  
-        
-            if not allergy_intolerance_data:  
-                return func.HttpResponse("Failed to generate Allergy Intolerance data.", status_code=500)  
-        
-            try:
-                # Clean up the generated FHIR data to extract valid JSON  
-                allergy_intolerance_data_json = clean_fhir_data(allergy_intolerance_data)  
-                if not allergy_intolerance_data_json:  
-                    return func.HttpResponse("Failed to decode generated Allergy Intolerance data.", status_code=500)  
-                
-                logging.info("Allergy Intolerance data generated successfully.")
-
-                # Append allergy-intolerance data to the combined JSON FHIR bundle
-                if allergy_intolerance_data_json:  
-                    combined_data["entry"].append({  
-                        "fullUrl": f"urn:uuid:{allergy_intolerance_data_json['id']}",  
-                        "resource": allergy_intolerance_data_json  
-                    })
-                    logging.info(f"Allergy Intolerance Data for {allergy_intolerance_data_json['id']} appended successfully.")
-
-                # Set success data for allergy-intolerance  
-                if allergy_intolerance_data_json:  
-                    allergy_intolerance_id = allergy_intolerance_data_json.get("id", "unknown_allergy_intolerance")  
-                    success_data["allergy_intolerance"] = {  
-                        "message": f"AllergyIntolerance data for AllergyIntolerance/{allergy_intolerance_id} generated successfully.", 
-                        "allergy_intolerance_data_elements": allergy_intolerance_data_elements
-                    }
-
-                # Append allergy_intolerance success data to the combined success data
-                if allergy_intolerance_data_json:
-                    combined_success_data["allergy_intolerance"] = success_data["allergy_intolerance"] 
 
-            except Exception as e:  
-                logging.error(f"Exception while processing Allergy Intolerance data: {e}")  
-                logging.error(f"Generated Allergy Intolerance data could not be processed due to an error.")  
-                return func.HttpResponse(  
-                    "An error occurred while processing the generated Allergy Intolerance data.",  
-                    status_code=500  
-                )  
+        # Report the status of each resource type in the response and in the bundle tags
+        resource_status = {}
+        if partial_success:
+            for resource_key in included_resources:
+                status = "failed" if resource_key in failed_resources else "success"
+                resource_status[resource_key] = {"status": status, "attempts": attempts[resource_key]}
+                if status == "failed":
+                    logging.error(f"Keeping the bundle without {resource_key} data after {attempts[resource_key]} attempts.")
+                    combined_success_data[resource_key] = {
+                        "status": "error",
+                        "message": failed_resources[resource_key]
+                    }
+            combined_data["meta"] = {
+                "tag": [
+                    {
+                        "system": RESOURCE_STATUS_TAG_SYSTEM,
+                        "code": f"{resource_key}-{status['status']}",
+                        "display": f"{resource_key} {status['status']} after {status['attempts']} attempt(s)"
+                    }
+                    for resource_key, status in resource_status.items()
+                ]
+            }
   
         # -------------------- Combined FHIR data -------------------------
         # Store the combined JSON in a separate file dyanmically with patient ID
@@ -858,40 +1356,80 @@ def generate_fhir_bundle(user_parameters):
         else:  
             patient_id = "unknown_patient"
 
-        # Convert combined data into a JSON string  
-        combined_data_json = json.dumps(combined_data, indent=2)  
         logging.info("FHIR bundle generation process completed successfully.") 
 
-        # Store the JSON file in Azure Blob Storage  
-        container_name = os.environ["BLOB_CONTAINER_NAME"]
-        file_name = f"generated_fhir_bundle_{patient_id}.json"  
-        
-        # Initialize the BlobServiceClient with connection string  
-        blob_service_client = BlobServiceClient.from_connection_string("BLOB_CONNECTION_STRING")  
-        container_client = blob_service_client.get_container_client(container_name)  
-        blob_client = container_client.get_blob_client(file_name)  
-
-        # Upload the JSON string to the blob  
-        blob_client.upload_blob(combined_data_json, overwrite=True)
-        blob_url = blob_client.url         # Fetch the URL of the uploaded blob  
+        # Record token usage and latency of the generation, so the per-resource and one-shot modes can be compared
+        generation_metrics = dict(generation_context.get()["metrics"])
+        generation_metrics["generation_seconds"] = round(time.perf_counter() - generation_start_time, 3)
+        generation_metrics["gpt_latency_seconds"] = round(generation_metrics["gpt_latency_seconds"], 3)
+        if generation_metrics["mode"] == "one_shot":
+            generation_metrics["fallback_resources"] = fallback_resources
+        if bundle_id:
+            generation_metrics["resumed_resources"] = resumed_resources
+        logging.info(f"Generation metrics for {patient_id}: {generation_metrics}")
+
+        ndjson_output = None
+        if output_format == "ndjson":
+            # The resources were appended as they completed, so only the files of a single bundle are left to commit.
+            # In a batch, the bundle is complete, so its resources are added to the batch's files, committed by the batch.
+            writer = generation_context.get()["ndjson_writer"]
+            if ndjson_writer is None:
+                ndjson_output = writer.close()
+            else:
+                writer.flush()
+            # The response lists the NDJSON files, like a Bulk Data export manifest
+            file_name = f"{blob_name_prefix}generated_fhir_ndjson_{patient_id}_manifest.json"
+            file_path = f"Generated FHIR NDJSON files under {writer.blob_prefix}"
+            blob_url = None
+        else:
+            # Convert combined data into JSON, compact and gzipped as configured
+            combined_data_body, content_settings = encodeJsonBlob(combined_data)
+
+            # Store the JSON file in Azure Blob Storage  
+            file_name = f"{blob_name_prefix}generated_fhir_bundle_{patient_id}.json"  
+            file_path = f"Generated FHIR bundle {file_name} available to download from Postman. "
+
+            # Upload the JSON string to the blob with the worker's pooled storage client
+            blob_client = uploadBlob(file_name, combined_data_body, content_settings=content_settings)
+            blob_url = blob_client.url         # Fetch the URL of the uploaded blob  
+
+        # The resources are stored, so the checkpoints are no longer needed (a batch's NDJSON files are committed by the batch)
+        if bundle_id and ndjson_writer is None:
+            try:
+                checkpoint_store.delete(bundle_id)
+            except Exception as e:
+                logging.error(f"Failed to delete the checkpoints of bundle {bundle_id}: {e}")
 
         # Create the response dictionary  
         response_content = {  
             "message": "FHIR data generated and stored successfully.", 
-            "filePath": f"Generated FHIR bundle {file_name} available to download from Postman. ", 
+            "filePath": file_path, 
             "blobUrl": blob_url,
-            "success_data": combined_success_data
+            "success_data": combined_success_data,
+            "generation_metrics": generation_metrics
         }  
+        if partial_success:
+            response_content["resource_status"] = resource_status
+        if ndjson_output is not None:
+            response_content["output"] = ndjson_output
+        if validation_results is not None:
+            response_content["validation"] = {
+                "valid": sum(1 for result in validation_results if result["status"] == "success"),
+                "invalid": sum(1 for result in validation_results if result["status"] != "success"),
+                "repaired": sum(1 for result in validation_results if result.get("repaired")),
+                "repair_rules": count_repair_rules(validation_results),
+                "results": validation_results
+            }
         # Convert response dictionary to JSON string  
-        response_json = json.dumps(response_content, indent=2)  
+        response_json = dumpJson(response_content)
 
         # Return the JSON content in the response with headers to prompt download  
         logging.info("Generated FHIR bundle available to download from Postman. Click on the 'Save Response' button and choose 'Save to a file' to download the JSON file.") 
         return func.HttpResponse(  
             response_json,
-            status_code=200,  
+            status_code=207 if failed_resources else 200,        # Multi-status when the bundle is missing failed resource types
             headers={  
-                "Content-Disposition": f"attachment; filename=generated_fhir_bundle_{patient_id}.json",  
+                "Content-Disposition": f"attachment; filename={os.path.basename(file_name)}",  
                 "Content-Type": "application/json"  
             }  
         )  
@@ -903,3 +1441,166 @@ def generate_fhir_bundle(user_parameters):
                 "An error occurred while processing the generated Patient data.",
                  status_code=500
         )
+
+
+# Function to generate multiple patient bundles in a single invocation
+def generate_fhir_bundle_batch(user_parameters, progress_callback=None):
+    logging.info('Generating batch of FHIR bundles.')
+
+    # Parameters shared by every patient in the batch
+    base_parameters = {
+        key: value for key, value in user_parameters.items()
+        if key not in ("patient_count", "patients", "batch_concurrency", "batch_id")
+    }
+
+    # Build the parameter set for each patient, either from the list provided or by repeating the shared parameters
+    patients = user_parameters.get("patients")
+    if patients is not None:
+        if not isinstance(patients, list) or not patients or not all(isinstance(patient, dict) for patient in patients):
+            logging.error("patients must be a non-empty list of parameter sets.")
+            return func.HttpResponse("patients must be a non-empty list of parameter sets.", status_code=400)
+        patient_parameters = [{**base_parameters, **patient} for patient in patients]
+    else:
+        try:
+            patient_count = int(user_parameters.get("patient_count"))
+        except (TypeError, ValueError):
+            patient_count = 0
+        if patient_count < 1:
+            logging.error("patient_count must be a positive integer.")
+            return func.HttpResponse("patient_count must be a positive integer.", status_code=400)
+        patient_parameters = [dict(base_parameters) for _ in range(patient_count)]
+
+    # Check every offline config up front, rather than failing each bundle of the batch
+    for parameters in patient_parameters:
+        try:
+            validate_offline_config(parameters.get("offline_config"))
+        except ValueError as e:
+            logging.error(f"Invalid offline config provided: {e}")
+            return func.HttpResponse(str(e), status_code=400)
+
+    if len(patient_parameters) > MAX_BATCH_PATIENTS:
+        logging.error(f"Batch size {len(patient_parameters)} exceeds the maximum of {MAX_BATCH_PATIENTS} patients.")
+        return func.HttpResponse(
+            f"A batch can contain at most {MAX_BATCH_PATIENTS} patients.",
+            status_code=400
+        )
+
+    # The batch ID names the blob folder of the batch and prefixes the bundle IDs derived from it
+    batch_id = user_parameters.get("batch_id")
+    if batch_id is not None and (not isinstance(batch_id, str) or not BUNDLE_ID_PATTERN.match(f"{batch_id}_0000")):
+        logging.error(f"Invalid batch ID provided: {batch_id}")
+        return func.HttpResponse(
+            "batch_id must be 1 to 59 letters, digits, '-' or '_'.",
+            status_code=400
+        )
+
+    # Give each bundle of a named batch its own bundle ID, so retrying the batch resumes its unfinished bundles
+    if batch_id:
+        for index, parameters in enumerate(patient_parameters):
+            parameters.setdefault("bundle_id", f"{batch_id}_{index:04d}")
+    else:
+        batch_id = uuid.uuid4().hex[:12]
+
+    batch_concurrency = max(1, int(user_parameters.get("batch_concurrency", DEFAULT_BATCH_CONCURRENCY)))
+
+    # Write the resources of every bundle to the same NDJSON files per resource type if requested
+    ndjson_writer = NdjsonExportWriter(f"fhir_bundle_batch_{batch_id}/") if user_parameters.get("output_format") == "ndjson" else None
+
+    # Report the progress of each bundle as "<index>" and of its resource types as "<index>.<resource key>"
+    def get_bundle_progress_callback(index):
+        if progress_callback is None:
+            return None
+        return lambda resource_key, status: progress_callback(f"{index:04d}.{resource_key}", status)
+
+    # Generate the bundles with bounded concurrency - each one is uploaded to storage as soon as it completes
+    manifest = [None] * len(patient_parameters)
+    with ThreadPoolExecutor(max_workers=min(batch_concurrency, len(patient_parameters))) as executor:
+        futures = {
+            submit_with_context(
+                executor,
+                generate_fhir_bundle,
+                parameters,
+                f"fhir_bundle_batch_{batch_id}/{index:04d}_",
+                get_bundle_progress_callback(index),
+                ndjson_writer
+            ): index
+            for index, parameters in enumerate(patient_parameters)
+        }
+
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                response = future.result()
+                response_body = response.get_body().decode("utf-8")
+                if response.status_code in (200, 207):
+                    response_content = json.loads(response_body)
+                    manifest[index] = {
+                        "index": index,
+                        "status": "success" if response.status_code == 200 else "partial",
+                        "blobUrl": response_content.get("blobUrl"),
+                        "patient": response_content.get("success_data", {}).get("patient", {}).get("message")
+                    }
+                else:
+                    manifest[index] = {
+                        "index": index,
+                        "status": "error",
+                        "status_code": response.status_code,
+                        "message": response_body
+                    }
+            except Exception as e:
+                logging.error(f"Exception while generating FHIR bundle {index} of batch {batch_id}: {e}")
+                manifest[index] = {
+                    "index": index,
+                    "status": "error",
+                    "status_code": 500,
+                    "message": "An error occurred while generating the FHIR bundle."
+                }
+            logging.info(f"FHIR bundle {index} of batch {batch_id} completed with status {manifest[index]['status']}.")
+            if progress_callback is not None:
+                progress_callback(f"{index:04d}", manifest[index]["status"])
+
+    # Commit the NDJSON files once every bundle has been appended, then drop the checkpoints of the stored bundles
+    ndjson_output = None
+    if ndjson_writer:
+        try:
+            ndjson_output = ndjson_writer.close()
+            for index, parameters in enumerate(patient_parameters):
+                if parameters.get("bundle_id") and manifest[index]["status"] in ("success", "partial"):
+                    checkpoint_store.delete(parameters["bundle_id"])
+        except Exception as e:
+            logging.error(f"Failed to commit the NDJSON files for batch {batch_id}: {e}")
+            for entry in manifest:
+                if entry["status"] in ("success", "partial"):
+                    entry.update(status="error", status_code=500, message="An error occurred while storing the NDJSON files.")
+
+    succeeded = sum(1 for entry in manifest if entry["status"] in ("success", "partial"))
+    response_content = {
+        "message": f"Generated {succeeded} of {len(manifest)} FHIR bundles for batch {batch_id}.",
+        "batch_id": batch_id,
+        "succeeded": succeeded,
+        "failed": len(manifest) - succeeded,
+        "manifest": manifest
+    }
+    if ndjson_output is not None:
+        response_content["output"] = ndjson_output
+
+    # Store the manifest next to the generated bundles
+    try:
+        manifest_body, content_settings = encodeJsonBlob(response_content, "application/json")
+        manifest_blob_client = uploadBlob(f"fhir_bundle_batch_{batch_id}/manifest.json", manifest_body, content_settings=content_settings)
+        response_content["manifestUrl"] = manifest_blob_client.url
+    except Exception as e:
+        logging.error(f"Failed to store the manifest for batch {batch_id}: {e}")
+
+    if succeeded == len(manifest):
+        status_code = 200
+    elif succeeded:
+        status_code = 207
+    else:
+        status_code = 500
+
+    return func.HttpResponse(
+        dumpJson(response_content),
+        status_code=status_code,
+        mimetype="application/json"
+    )
@@ -0,0 +1,93 @@
+import logging
+import os
+import re
+import json
+import shutil
+import threading
+from BlobStorage import getContainerClient, uploadBlob
+
+
+# Default checkpoint settings, overridable through the app settings
+DEFAULT_CHECKPOINT_BACKEND = os.environ.get("FHIR_CHECKPOINT_BACKEND", "local")
+DEFAULT_CHECKPOINT_DIR = os.environ.get("FHIR_CHECKPOINT_DIR", ".generation_checkpoints")
+DEFAULT_CHECKPOINT_BLOB_PREFIX = os.environ.get("FHIR_CHECKPOINT_BLOB_PREFIX", "checkpoints/")
+
+# Bundle IDs are used in file and blob names
+BUNDLE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+# Checkpoints stored on the local disk of the worker - enough to resume after a timeout or a restart on the same host
+class LocalCheckpointStore:
+    def __init__(self, checkpoint_dir=DEFAULT_CHECKPOINT_DIR):
+        self.checkpoint_dir = checkpoint_dir
+
+    def save(self, bundle_id, resource_key, resource_data):
+        bundle_dir = os.path.join(self.checkpoint_dir, bundle_id)
+        os.makedirs(bundle_dir, exist_ok=True)
+        path = os.path.join(bundle_dir, f"{resource_key}.json")
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(resource_data, checkpoint_file)
+        os.replace(temp_path, path)        # Atomic, so a resumed request never reads a partial checkpoint
+
+    def load(self, bundle_id):
+        bundle_dir = os.path.join(self.checkpoint_dir, bundle_id)
+        checkpoint = {}
+        if not os.path.isdir(bundle_dir):
+            return checkpoint
+        for file_name in os.listdir(bundle_dir):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(bundle_dir, file_name), "r") as checkpoint_file:
+                    checkpoint[file_name[:-len(".json")]] = json.load(checkpoint_file)
+            except (OSError, ValueError) as e:
+                logging.error(f"Skipping unreadable checkpoint {file_name} of bundle {bundle_id}: {e}")
+        return checkpoint
+
+    def delete(self, bundle_id):
+        shutil.rmtree(os.path.join(self.checkpoint_dir, bundle_id), ignore_errors=True)
+
+
+# Checkpoints stored in the Blob Storage container, so any worker can resume the bundle after a host recycle
+class BlobCheckpointStore:
+    def __init__(self, blob_prefix=DEFAULT_CHECKPOINT_BLOB_PREFIX):
+        self.blob_prefix = blob_prefix
+
+    def save(self, bundle_id, resource_key, resource_data):
+        uploadBlob(f"{self.blob_prefix}{bundle_id}/{resource_key}.json", json.dumps(resource_data))
+
+    def load(self, bundle_id):
+        container_client = getContainerClient()
+        bundle_prefix = f"{self.blob_prefix}{bundle_id}/"
+        checkpoint = {}
+        for blob in container_client.list_blobs(name_starts_with=bundle_prefix):
+            resource_key = blob.name[len(bundle_prefix):-len(".json")]
+            try:
+                checkpoint[resource_key] = json.loads(container_client.download_blob(blob.name).readall())
+            except ValueError as e:
+                logging.error(f"Skipping unreadable checkpoint {blob.name}: {e}")
+        return checkpoint
+
+    def delete(self, bundle_id):
+        container_client = getContainerClient()
+        for blob in container_client.list_blobs(name_starts_with=f"{self.blob_prefix}{bundle_id}/"):
+            container_client.delete_blob(blob.name)
+
+
+# Available checkpoint backends, selected with the FHIR_CHECKPOINT_BACKEND app setting
+CHECKPOINT_BACKENDS = {
+    "local": LocalCheckpointStore,
+    "blob": BlobCheckpointStore
+}
+
+
+# Function to create the checkpoint store of the configured backend
+def create_checkpoint_store(backend=DEFAULT_CHECKPOINT_BACKEND):
+    if backend not in CHECKPOINT_BACKENDS:
+        raise ValueError(f"FHIR_CHECKPOINT_BACKEND must be one of: {', '.join(CHECKPOINT_BACKENDS)}.")
+    return CHECKPOINT_BACKENDS[backend]()
+
+
+# Checkpoint store shared by all the requests handled by this worker
+checkpoint_store = create_checkpoint_store()
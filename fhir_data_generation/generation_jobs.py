@@ -0,0 +1,280 @@
+import logging
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import tempfile
+import threading
+from fhir_data_generation.fhir_resource_generation import generate_fhir_bundle, generate_fhir_bundle_batch
+
+
+# Default job settings, overridable through the app settings
+DEFAULT_JOB_QUEUE_BACKEND = os.environ.get("FHIR_JOB_QUEUE_BACKEND", "memory")
+DEFAULT_JOB_QUEUE_PATH = os.environ.get("FHIR_JOB_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "generation_jobs.sqlite3"))    # The app directory is read-only when deployed
+DEFAULT_JOB_WORKERS = int(os.environ.get("FHIR_JOB_WORKERS", 2))
+DEFAULT_JOB_RETENTION_SECONDS = int(os.environ.get("FHIR_JOB_RETENTION_SECONDS", 24 * 60 * 60))
+DEFAULT_JOB_LEASE_SECONDS = int(os.environ.get("FHIR_JOB_LEASE_SECONDS", 10 * 60))        # Running jobs not updated for this long are requeued
+POLL_INTERVAL_SECONDS = 0.5
+
+
+# In-process job queue, for local runs and single-worker deployments. Jobs are lost when the worker restarts.
+class InMemoryJobQueue:
+    def __init__(self, retention_seconds=DEFAULT_JOB_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+
+    def create_job(self, job_id, parameters):
+        now = time.time()
+        with self._lock:
+            # Forget finished jobs past their retention, so the store doesn't grow with the worker's uptime
+            for expired_id in [key for key, job in self._jobs.items() if job["status"] in ("succeeded", "failed") and now - job["updated"] > self.retention_seconds]:
+                del self._jobs[expired_id]
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "status": "queued",
+                "parameters": parameters,
+                "progress": {},
+                "result": None,
+                "created": now,
+                "updated": now
+            }
+        self._queue.put(job_id)
+
+    # Function to take the next queued job, waiting up to `timeout` seconds for one
+    def claim_job(self, timeout=None):
+        try:
+            job_id = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return self.update_job(job_id, status="running")
+
+    def update_job(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.update(fields, updated=time.time())
+            return json.loads(json.dumps(job))        # Callers never share the stored job
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job else None
+
+
+# Job queue stored in a SQLite database, so jobs survive a worker restart and can be shared by the workers of a host
+# A running job is leased to its worker while the job is updated (the runner refreshes it while the job runs), and
+# requeued once the lease expires, so the jobs of a worker that died are run again after a restart.
+class SqliteJobQueue:
+    def __init__(self, path=DEFAULT_JOB_QUEUE_PATH, lease_seconds=DEFAULT_JOB_LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS generation_jobs ("
+                "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, parameters TEXT NOT NULL, progress TEXT NOT NULL, "
+                "result TEXT, created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS generation_jobs_status ON generation_jobs (status, created)")
+            self._requeue_stale_jobs(connection)
+
+    # Function to requeue the running jobs whose lease has expired, returning how many were requeued
+    def _requeue_stale_jobs(self, connection):
+        requeued = connection.execute(
+            "UPDATE generation_jobs SET status = 'queued', updated = ? WHERE status = 'running' AND updated < ?",
+            (time.time(), time.time() - self.lease_seconds)
+        ).rowcount
+        if requeued:
+            logging.info(f"Requeued {requeued} generation jobs whose worker stopped.")
+        return requeued
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    @staticmethod
+    def _to_job(row):
+        if row is None:
+            return None
+        return {
+            "job_id": row["job_id"],
+            "status": row["status"],
+            "parameters": json.loads(row["parameters"]),
+            "progress": json.loads(row["progress"]),
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "created": row["created"],
+            "updated": row["updated"]
+        }
+
+    def create_job(self, job_id, parameters):
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute(
+                "INSERT INTO generation_jobs VALUES (?, 'queued', ?, '{}', NULL, ?, ?)",
+                (job_id, json.dumps(parameters), now, now)
+            )
+        finally:
+            connection.close()
+
+    # Function to take the oldest queued job, polling up to `timeout` seconds for one
+    def claim_job(self, timeout=None):
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            connection = self._connect()
+            try:
+                # Claim the job in a write transaction, so two workers never run the same job
+                connection.execute("BEGIN IMMEDIATE")
+                self._requeue_stale_jobs(connection)
+                row = connection.execute(
+                    "SELECT job_id FROM generation_jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+                ).fetchone()
+                if row:
+                    connection.execute(
+                        "UPDATE generation_jobs SET status = 'running', updated = ? WHERE job_id = ?",
+                        (time.time(), row["job_id"])
+                    )
+                connection.execute("COMMIT")
+            finally:
+                connection.close()
+
+            if row:
+                return self.get_job(row["job_id"])
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+    def update_job(self, job_id, **fields):
+        columns = []
+        values = []
+        for column in ("status", "progress", "result"):
+            if column in fields:
+                columns.append(f"{column} = ?")
+                values.append(fields[column] if column == "status" else json.dumps(fields[column]))
+        connection = self._connect()
+        try:
+            connection.execute(
+                f"UPDATE generation_jobs SET {', '.join(columns + ['updated = ?'])} WHERE job_id = ?",
+                (*values, time.time(), job_id)
+            )
+        finally:
+            connection.close()
+        return self.get_job(job_id)
+
+    def get_job(self, job_id):
+        connection = self._connect()
+        try:
+            return self._to_job(connection.execute("SELECT * FROM generation_jobs WHERE job_id = ?", (job_id,)).fetchone())
+        finally:
+            connection.close()
+
+
+# Available queue backends, selected with the FHIR_JOB_QUEUE_BACKEND app setting
+JOB_QUEUE_BACKENDS = {
+    "memory": InMemoryJobQueue,
+    "sqlite": SqliteJobQueue
+}
+
+
+# Function to create the job queue of the configured backend
+def create_job_queue(backend=DEFAULT_JOB_QUEUE_BACKEND):
+    if backend not in JOB_QUEUE_BACKENDS:
+        raise ValueError(f"FHIR_JOB_QUEUE_BACKEND must be one of: {', '.join(JOB_QUEUE_BACKENDS)}.")
+    return JOB_QUEUE_BACKENDS[backend]()
+
+
+# Background workers that run the queued bundle generations, so a long generation doesn't hold the HTTP
+# request open. The client gets a job ID straight away and polls the job for progress and the result.
+class GenerationJobRunner:
+    def __init__(self, job_queue, workers=DEFAULT_JOB_WORKERS):
+        self.job_queue = job_queue
+        self.workers = workers
+        self._threads = []
+        self._lock = threading.Lock()
+
+    # Function to queue a generation request, returning its job ID
+    def submit(self, user_parameters):
+        job_id = uuid.uuid4().hex
+        self.job_queue.create_job(job_id, user_parameters)
+        self._start_workers()
+        logging.info(f"Queued FHIR bundle generation job {job_id}.")
+        return job_id
+
+    def get_job(self, job_id):
+        return self.job_queue.get_job(job_id)
+
+    # Function to start the worker threads on the first submission
+    def _start_workers(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            for _ in range(self.workers - len(self._threads)):
+                thread = threading.Thread(target=self._work, name="fhir-generation-job", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            try:
+                job = self.job_queue.claim_job(timeout=60)
+                if job:
+                    self.run_job(job["job_id"], job["parameters"])
+            except Exception as e:
+                logging.error(f"FHIR generation job worker failed: {e}")
+                time.sleep(POLL_INTERVAL_SECONDS)
+
+    # Function to keep the lease of a running job until `stopped` is set, by updating the job periodically
+    def _renew_lease(self, job_id, stopped):
+        lease_seconds = getattr(self.job_queue, "lease_seconds", None)
+        if not lease_seconds:
+            return
+        while not stopped.wait(lease_seconds / 3):
+            try:
+                self.job_queue.update_job(job_id)
+            except Exception as e:
+                logging.error(f"Failed to renew the lease of FHIR bundle generation job {job_id}: {e}")
+
+    # Function to run a single job, recording the progress of each resource type (and of each bundle of a batch) and the final response
+    def run_job(self, job_id, user_parameters):
+        logging.info(f"Running FHIR bundle generation job {job_id}.")
+        progress = {}
+        progress_lock = threading.Lock()
+
+        def progress_callback(resource_key, status):
+            with progress_lock:
+                progress[resource_key] = status
+                self.job_queue.update_job(job_id, progress=dict(progress))
+
+        lease_stopped = threading.Event()
+        threading.Thread(target=self._renew_lease, args=(job_id, lease_stopped), name="fhir-generation-job-lease", daemon=True).start()
+        try:
+            if "patient_count" in user_parameters or "patients" in user_parameters:
+                response = generate_fhir_bundle_batch(user_parameters, progress_callback=progress_callback)
+            else:
+                response = generate_fhir_bundle(user_parameters, progress_callback=progress_callback)
+
+            response_body = response.get_body().decode("utf-8")
+            try:
+                response_content = json.loads(response_body)
+            except ValueError:
+                response_content = {"message": response_body}
+            status = "succeeded" if response.status_code in (200, 207) else "failed"
+            result = {"status_code": response.status_code, "response": response_content}
+        except Exception as e:
+            logging.error(f"Exception while running FHIR bundle generation job {job_id}: {e}")
+            status = "failed"
+            result = {"status_code": 500, "response": {"message": "An error occurred while generating the FHIR bundle."}}
+        finally:
+            lease_stopped.set()
+
+        self.job_queue.update_job(job_id, status=status, result=result)
+        logging.info(f"FHIR bundle generation job {job_id} {status}.")
+
+
+# Job runner shared by all the requests handled by this worker
+generation_job_runner = GenerationJobRunner(create_job_queue())
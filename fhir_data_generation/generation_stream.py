@@ -0,0 +1,46 @@
+import logging
+import json
+import queue
+import threading
+from Serialization import dumpJsonBytes
+from fhir_data_generation.fhir_resource_generation import generate_fhir_bundle
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+# Function to generate a bundle while streaming it as newline-delimited JSON: one line per entry as soon as it decodes,
+# then a final "complete" line with the blob URL and the generation response (or an "error" line)
+def stream_fhir_bundle(user_parameters):
+    lines = queue.Queue()
+
+    def run_generation():
+        try:
+            response = generate_fhir_bundle(user_parameters, entry_callback=lines.put)
+            response_body = response.get_body().decode("utf-8")
+            try:
+                response_content = json.loads(response_body)
+            except ValueError:
+                response_content = {"message": response_body}
+            lines.put({
+                "type": "complete" if response.status_code in (200, 207) else "error",
+                "status_code": response.status_code,
+                "blobUrl": response_content.get("blobUrl"),
+                "response": response_content
+            })
+        except Exception as e:
+            logging.error(f"Exception while streaming FHIR bundle generation: {e}")
+            lines.put({
+                "type": "error",
+                "status_code": 500,
+                "response": {"message": "An error occurred while generating the FHIR bundle."}
+            })
+        finally:
+            lines.put(None)
+
+    # Generate on a separate thread, so each line is sent while the remaining resource types are still generating
+    threading.Thread(target=run_generation, name="fhir-generation-stream", daemon=True).start()
+    while True:
+        line = lines.get()
+        if line is None:
+            return
+        yield dumpJsonBytes(line, pretty=False) + b"\n"
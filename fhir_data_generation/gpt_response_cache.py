@@ -0,0 +1,155 @@
+import logging
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# Default cache settings, overridable through the app settings
+DEFAULT_CACHE_DIR = os.environ.get("FHIR_GPT_CACHE_DIR", ".gpt_response_cache")
+DEFAULT_MEMORY_ENTRIES = int(os.environ.get("FHIR_GPT_CACHE_MEMORY_ENTRIES", 256))
+DEFAULT_TTL_SECONDS = int(os.environ.get("FHIR_GPT_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60))
+DEFAULT_MAX_DISK_BYTES = int(os.environ.get("FHIR_GPT_CACHE_MAX_BYTES", 100 * 1024 * 1024))
+
+
+# Two-tier cache of GPT responses: an in-memory LRU in front of an on-disk store with TTL and size-based eviction
+class GptResponseCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, memory_entries=DEFAULT_MEMORY_ENTRIES,
+                 ttl_seconds=DEFAULT_TTL_SECONDS, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.memory_entries = memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None        # Computed lazily on the first write
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0
+        }
+
+    # Function to build the cache key for a GPT call. max_tokens is the budget set by the caller (None when the budget
+    # of the resource type is used), so calls with different budgets never share an entry.
+    @staticmethod
+    def make_key(model, prompt, temperature, max_tokens=None, resource_type=None, seed=None):
+        key_data = json.dumps({
+            "model": model,
+            "prompt": prompt,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "resource_type": resource_type,
+            "seed": seed
+        }, sort_keys=True)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    # Function to fetch a cached response, checking the memory tier first and then the disk tier
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, "r") as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+
+        # Expired entries are removed and treated as a miss
+        if time.time() - cached.get("created", 0) > self.ttl_seconds:
+            self._remove_file(path)
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+
+        try:
+            os.utime(path)        # Keep recently used entries at the back of the eviction order
+        except OSError:
+            pass
+
+        response = cached.get("response")
+        with self._lock:
+            self.stats["disk_hits"] += 1
+            self._remember(key, response)
+        return response
+
+    # Function to store a response in both tiers
+    def set(self, key, response):
+        with self._lock:
+            self._remember(key, response)
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(key)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as cache_file:
+                json.dump({"created": time.time(), "response": response}, cache_file)
+            size = os.path.getsize(temp_path)
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temp_path, path)        # Atomic, so concurrent readers never see a partial entry
+        except OSError as e:
+            logging.error(f"Failed to write GPT response to the disk cache: {e}")
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += size - previous_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    # Function to add a response to the memory tier, evicting the least recently used entry when full
+    def _remember(self, key, response):
+        self._memory[key] = response
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _scan_disk_bytes(self):
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                total += entry.stat().st_size
+        return total
+
+    # Function to remove expired entries, then the least recently used ones, until the disk tier fits its size limit
+    def _evict_disk(self):
+        now = time.time()
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json")
+        )
+        total = sum(size for _, size, _ in entries)
+        target = self.max_disk_bytes * 0.9        # Leave some headroom so every write doesn't trigger eviction
+        for modified, size, path in entries:
+            if total <= target and now - modified <= self.ttl_seconds:
+                continue
+            if self._remove_file(path):
+                total -= size
+                self.stats["evictions"] += 1
+        self._disk_bytes = total
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+# Cache shared by all the requests handled by this worker
+gpt_response_cache = GptResponseCache()
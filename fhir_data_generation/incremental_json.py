@@ -0,0 +1,86 @@
+import json
+
+
+# Maximum amount of text accepted before the top-level JSON object starts (e.g. a markdown preamble)
+MAX_PREAMBLE_CHARACTERS = 2000
+
+# Characters that can appear outside of strings in a JSON document
+JSON_STRUCTURAL_CHARACTERS = set("{}[],:")
+JSON_LITERAL_CHARACTERS = set("0123456789+-.eEtrufalsn")
+JSON_WHITESPACE = set(" \t\r\n")
+
+
+# Exception raised as soon as the streamed text can no longer become a valid JSON object
+class JsonStructureError(ValueError):
+    pass
+
+
+# Incremental scanner that follows the structure of a streamed JSON object, one chunk at a time.
+# It skips any text before the first '{', reports structural errors as soon as they appear,
+# and knows when the top-level object has closed so the rest of the stream can be dropped.
+class IncrementalJsonObjectScanner:
+    def __init__(self):
+        self._parts = []
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._preamble_characters = 0
+        self.started = False
+        self.complete = False
+
+    # Function to scan the next chunk of text, returning True once the top-level object is complete
+    def feed(self, text):
+        if self.complete:
+            return True
+
+        start_index = 0
+        if not self.started:
+            start_index = text.find("{")
+            if start_index == -1:
+                self._preamble_characters += len(text)
+                if self._preamble_characters > MAX_PREAMBLE_CHARACTERS:
+                    raise JsonStructureError("No JSON object found in the generated text.")
+                return False
+            self.started = True
+
+        for index in range(start_index, len(text)):
+            character = text[index]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif character == "\\":
+                    self._escape = True
+                elif character == '"':
+                    self._in_string = False
+                continue
+
+            if character == '"':
+                self._in_string = True
+            elif character in "{[":
+                self._stack.append(character)
+            elif character in "}]":
+                expected = "{" if character == "}" else "["
+                if not self._stack or self._stack[-1] != expected:
+                    raise JsonStructureError(f"Unexpected '{character}' in the generated JSON.")
+                self._stack.pop()
+                if not self._stack:
+                    self._parts.append(text[start_index:index + 1])
+                    self.complete = True
+                    return True
+            elif character not in JSON_STRUCTURAL_CHARACTERS and character not in JSON_LITERAL_CHARACTERS and character not in JSON_WHITESPACE:
+                raise JsonStructureError(f"Unexpected character {character!r} in the generated JSON.")
+
+        self._parts.append(text[start_index:])
+        return False
+
+    # The JSON text of the object scanned so far
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    # Function to parse the scanned object once it is complete
+    def parse(self):
+        if not self.complete:
+            raise JsonStructureError("The generated JSON object is incomplete.")
+        return json.loads(self.text)
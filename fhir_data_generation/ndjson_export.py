@@ -0,0 +1,100 @@
+import logging
+import os
+import base64
+import threading
+from BlobStorage import getContainerClient
+from Serialization import dumpJsonBytes
+
+
+# Size of the blocks staged for each NDJSON file, overridable through the app settings
+DEFAULT_BLOCK_SIZE = int(os.environ.get("FHIR_NDJSON_BLOCK_SIZE", 4 * 1024 * 1024))
+NDJSON_CONTENT_TYPE = "application/fhir+ndjson"
+
+
+# Writer for the FHIR Bulk Data layout: one NDJSON file per resource type (Patient.ndjson, Observation.ndjson, ...).
+# Resources are buffered per type and staged as blocks once a buffer is full, then every file is committed on close,
+# so memory stays bounded by the block size whatever the number of resources written.
+class NdjsonExportWriter:
+    def __init__(self, blob_prefix, block_size=DEFAULT_BLOCK_SIZE):
+        self.blob_prefix = blob_prefix
+        self.block_size = block_size
+        self._files = {}
+        self._lock = threading.Lock()
+        self._container_client = getContainerClient()
+
+    # Function to append a resource to the NDJSON file of its type
+    def append(self, resource):
+        line = dumpJsonBytes(resource, pretty=False) + b"\n"
+        resource_type = resource.get("resourceType", "Unknown")
+
+        with self._lock:
+            ndjson_file = self._files.setdefault(resource_type, {"buffer": bytearray(), "block_ids": [], "count": 0})
+            ndjson_file["buffer"] += line
+            ndjson_file["count"] += 1
+            block = self._take_block(ndjson_file) if len(ndjson_file["buffer"]) >= self.block_size else None
+
+        # Stage outside the lock, so other bundles keep appending during the upload
+        if block:
+            self._stage_block(resource_type, *block)
+
+    # Function to take the buffered lines of a file as its next block (called with the lock held)
+    @staticmethod
+    def _take_block(ndjson_file):
+        block_id = base64.b64encode(f"{len(ndjson_file['block_ids']):08d}".encode("ascii")).decode("ascii")
+        ndjson_file["block_ids"].append(block_id)
+        data = bytes(ndjson_file["buffer"])
+        ndjson_file["buffer"] = bytearray()
+        return block_id, data
+
+    def _get_blob_name(self, resource_type):
+        return f"{self.blob_prefix}{resource_type}.ndjson"
+
+    def _stage_block(self, resource_type, block_id, data):
+        blob_client = self._container_client.get_blob_client(self._get_blob_name(resource_type))
+        blob_client.stage_block(block_id, data)
+
+    # Function to stage the remaining lines and commit every file, returning the Bulk Data style output list
+    def close(self):
+        from azure.storage.blob import BlobBlock, ContentSettings
+
+        with self._lock:
+            remaining = [
+                (resource_type, *self._take_block(ndjson_file))
+                for resource_type, ndjson_file in self._files.items() if ndjson_file["buffer"]
+            ]
+        for resource_type, block_id, data in remaining:
+            self._stage_block(resource_type, block_id, data)
+
+        output = []
+        for resource_type, ndjson_file in self._files.items():
+            blob_client = self._container_client.get_blob_client(self._get_blob_name(resource_type))
+            blob_client.commit_block_list(
+                [BlobBlock(block_id=block_id) for block_id in ndjson_file["block_ids"]],
+                content_settings=ContentSettings(content_type=NDJSON_CONTENT_TYPE)
+            )
+            output.append({"type": resource_type, "url": blob_client.url, "count": ndjson_file["count"]})
+            logging.info(f"Committed {ndjson_file['count']} {resource_type} resources in {len(ndjson_file['block_ids'])} blocks.")
+        return output
+
+
+# Resources of a single bundle of a batch, held until the bundle is stored and then appended to the batch's shared
+# writer, so a bundle that fails leaves nothing in the batch's files (its resources would reference a patient that
+# is not stored). Memory is bounded by the size of one bundle.
+class NdjsonBundleBuffer:
+    def __init__(self, writer):
+        self.writer = writer
+        self.blob_prefix = writer.blob_prefix
+        self._resources = []
+        self._lock = threading.Lock()
+
+    # Function to hold a resource until the bundle is stored
+    def append(self, resource):
+        with self._lock:
+            self._resources.append(resource)
+
+    # Function to append the held resources to the batch's files, once the bundle is stored
+    def flush(self):
+        with self._lock:
+            resources, self._resources = self._resources, []
+        for resource in resources:
+            self.writer.append(resource)
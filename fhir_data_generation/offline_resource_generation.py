@@ -0,0 +1,435 @@
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+
+
+# -------------------- Vocabularies -------------------------
+# (code, display) pairs used to build the coded elements of the offline resources
+
+FAMILY_NAMES = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+    "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+    "Lee", "Perez", "Thompson", "White", "Harris", "Sanchez", "Clark", "Ramirez", "Lewis", "Robinson"
+]
+
+GIVEN_NAMES = {
+    "male": ["James", "Robert", "John", "Michael", "David", "William", "Richard", "Joseph", "Thomas", "Charles", "Daniel", "Matthew"],
+    "female": ["Mary", "Patricia", "Jennifer", "Linda", "Elizabeth", "Barbara", "Susan", "Jessica", "Sarah", "Karen", "Nancy", "Lisa"],
+    "other": ["Alex", "Jordan", "Taylor", "Morgan", "Casey", "Riley"],
+    "unknown": ["Alex", "Jordan", "Taylor", "Morgan", "Casey", "Riley"]
+}
+
+# (city, state, postal code prefix)
+ADDRESSES = [
+    ("Springfield", "IL", "627"), ("Columbus", "OH", "432"), ("Austin", "TX", "787"), ("Denver", "CO", "802"),
+    ("Portland", "OR", "972"), ("Madison", "WI", "537"), ("Raleigh", "NC", "276"), ("Boston", "MA", "021"),
+    ("Phoenix", "AZ", "850"), ("Nashville", "TN", "372"), ("Sacramento", "CA", "958"), ("Albany", "NY", "122")
+]
+
+STREET_NAMES = ["Main St", "Oak Ave", "Maple Dr", "Cedar Ln", "Elm St", "Pine Rd", "Washington Blvd", "Lake View Dr"]
+
+MARITAL_STATUSES = [("M", "Married"), ("S", "Never Married"), ("D", "Divorced"), ("W", "Widowed")]
+
+CONDITION_CODES = [
+    ("44054006", "Diabetes mellitus type 2"), ("38341003", "Hypertensive disorder"), ("195967001", "Asthma"),
+    ("13645005", "Chronic obstructive lung disease"), ("55822004", "Hyperlipidemia"), ("35489007", "Depressive disorder"),
+    ("69896004", "Rheumatoid arthritis"), ("40930008", "Hypothyroidism"), ("399211009", "History of myocardial infarction"),
+    ("271737000", "Anemia")
+]
+
+SEVERITY_CODES = [("255604002", "Mild"), ("6736007", "Moderate"), ("24484000", "Severe")]
+
+ENCOUNTER_CLASSES = [("AMB", "ambulatory"), ("IMP", "inpatient encounter"), ("EMER", "emergency"), ("VR", "virtual")]
+
+ENCOUNTER_TYPES = [
+    ("185349003", "Encounter for check up"), ("390906007", "Follow-up encounter"),
+    ("50849002", "Emergency room admission"), ("183452005", "Emergency hospital admission")
+]
+
+APPOINTMENT_SERVICE_CATEGORIES = [("gp", "General Practice"), ("8", "Counselling"), ("27", "Specialist Medical")]
+
+APPOINTMENT_TYPES = [("ROUTINE", "Routine appointment"), ("FOLLOWUP", "A follow up visit"), ("CHECKUP", "A routine check-up")]
+
+# (LOINC code, display, unit, UCUM code, normal low, normal high) per observation type
+OBSERVATION_CODES = {
+    "heart_rate": ("8867-4", "Heart rate", "beats/minute", "/min", 55, 110),
+    "laboratory": [
+        ("718-7", "Hemoglobin [Mass/volume] in Blood", "g/dL", "g/dL", 11.5, 17.5),
+        ("2345-7", "Glucose [Mass/volume] in Serum or Plasma", "mg/dL", "mg/dL", 70, 180),
+        ("2160-0", "Creatinine [Mass/volume] in Serum or Plasma", "mg/dL", "mg/dL", 0.6, 1.4),
+        ("789-8", "Erythrocytes [#/volume] in Blood by Automated count", "10^12/L", "10*12/L", 3.8, 6.0),
+        ("6690-2", "Leukocytes [#/volume] in Blood by Automated count", "10^9/L", "10*9/L", 3.5, 11.0)
+    ]
+}
+
+SERVICE_REQUEST_CODES = [
+    ("24642003", "Psychiatry procedure or service"), ("252160004", "Standard chest X-ray"),
+    ("26604007", "Complete blood count"), ("104177005", "Blood culture for bacteria"),
+    ("73761001", "Colonoscopy")
+]
+
+MEDICATION_CODES = [
+    ("860975", "metformin hydrochloride 500 MG Oral Tablet", "Take one tablet by mouth twice daily with meals"),
+    ("314076", "lisinopril 10 MG Oral Tablet", "Take one tablet by mouth once daily"),
+    ("617312", "atorvastatin 10 MG Oral Tablet", "Take one tablet by mouth once daily at bedtime"),
+    ("895994", "albuterol 0.09 MG/ACTUAT Inhalation Aerosol", "Inhale two puffs every 4 to 6 hours as needed"),
+    ("313782", "acetaminophen 325 MG Oral Tablet", "Take one tablet by mouth every 6 hours as needed for pain"),
+    ("966247", "levothyroxine sodium 0.05 MG Oral Tablet", "Take one tablet by mouth every morning")
+]
+
+ALLERGY_CODES = [
+    ("764146007", "Penicillin", "medication"), ("387207008", "Ibuprofen", "medication"),
+    ("256349002", "Peanut", "food"), ("735029006", "Shellfish", "food"),
+    ("111088007", "Latex", "environment"), ("256277009", "Grass pollen", "environment")
+]
+
+# Default distributions, overridable per request through the offline config
+DEFAULT_OFFLINE_CONFIG = {
+    "gender_weights": {"male": 0.49, "female": 0.49, "other": 0.01, "unknown": 0.01},
+    "age_range": [1, 90],
+    "history_days": 3 * 365,         # How far back clinical dates are spread
+    "seed": None
+}
+
+SNOMED = "http://snomed.info/sct"
+LOINC = "http://loinc.org"
+RXNORM = "http://www.nlm.nih.gov/research/umls/rxnorm"
+UCUM = "http://unitsofmeasure.org"
+
+# Random generator used when the caller doesn't provide a (seeded) one
+shared_rng = random.Random()
+
+
+# -------------------- Helpers -------------------------
+
+# Function to create the random generator of a resource, seeded from the offline config (and the resource's key, if
+# given) when the config has a seed. A generator per resource keeps seeded output independent of thread scheduling.
+def create_offline_rng(offline_config=None, resource_key=None):
+    seed = (offline_config or {}).get("seed")
+    if seed is None:
+        return shared_rng
+    return random.Random(f"{seed}:{resource_key}" if resource_key is not None else seed)
+
+
+# Function to check an offline config from a request, raising a ValueError that names the problem if it is invalid
+def validate_offline_config(offline_config):
+    if offline_config is None:
+        return
+    if not isinstance(offline_config, dict):
+        raise ValueError("offline_config must be an object.")
+
+    def is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    gender_weights = offline_config.get("gender_weights", DEFAULT_OFFLINE_CONFIG["gender_weights"])
+    if not isinstance(gender_weights, dict) or not gender_weights or any(gender not in GIVEN_NAMES for gender in gender_weights):
+        raise ValueError(f"offline_config.gender_weights must map genders to weights, the allowed genders are: {', '.join(GIVEN_NAMES)}.")
+    if not all(is_number(weight) and weight >= 0 for weight in gender_weights.values()) or sum(gender_weights.values()) <= 0:
+        raise ValueError("offline_config.gender_weights must be non-negative numbers, at least one of them positive.")
+
+    age_range = offline_config.get("age_range", DEFAULT_OFFLINE_CONFIG["age_range"])
+    if (not isinstance(age_range, list) or len(age_range) != 2 or not all(isinstance(age, int) and not isinstance(age, bool) for age in age_range)
+            or not 0 <= age_range[0] <= age_range[1]):
+        raise ValueError("offline_config.age_range must be [low, high] in whole years, with 0 <= low <= high.")
+
+    history_days = offline_config.get("history_days", DEFAULT_OFFLINE_CONFIG["history_days"])
+    if not is_number(history_days) or history_days < 0:
+        raise ValueError("offline_config.history_days must be a non-negative number.")
+
+    seed = offline_config.get("seed")
+    if seed is not None and not isinstance(seed, (int, str)):
+        raise ValueError("offline_config.seed must be an integer or a string.")
+
+
+def coding(system, code, display):
+    return {"coding": [{"system": system, "code": code, "display": display}], "text": display}
+
+
+def new_id(rng, prefix):
+    return f"{prefix}-{uuid.UUID(int=rng.getrandbits(128), version=4).hex[:12]}"
+
+
+def meta():
+    return {"versionId": "1", "lastUpdated": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+
+
+def identifier(rng, system, prefix):
+    return [{"use": "official", "system": system, "value": f"{prefix}-{rng.randint(1000000, 9999999)}"}]
+
+
+def random_datetime(rng, config):
+    return datetime.now(timezone.utc) - timedelta(days=rng.uniform(0, config["history_days"]))
+
+
+def isoformat(value):
+    return value.isoformat(timespec="seconds")
+
+
+# Function to apply the user input data on top of a generated resource.
+# Only elements that exist in the generated resource are overridden (dotted keys address nested elements),
+# so loose prompt-style input (e.g. {"system": "icd-10-cm"}) can't produce an invalid resource.
+def apply_input_data(resource, input_data):
+    if not isinstance(input_data, dict):
+        return resource
+
+    for key, value in input_data.items():
+        parts = key.split(".")
+        target = resource
+        for part in parts[:-1]:
+            target = target.get(part) if isinstance(target, dict) else None
+            if isinstance(target, list) and target:
+                target = target[0]
+        if not isinstance(target, dict) or parts[-1] not in target:
+            logging.info(f"Offline generation ignored input data element not present in {resource.get('resourceType')}: {key}")
+            continue
+
+        current = target[parts[-1]]
+        if isinstance(current, dict) and isinstance(value, dict):
+            apply_input_data(current, value)
+        elif isinstance(current, list) and current and isinstance(current[0], dict) and isinstance(value, dict):
+            apply_input_data(current[0], value)
+        else:
+            target[parts[-1]] = value
+    return resource
+
+
+# -------------------- Resource builders -------------------------
+
+def build_patient(rng, config, patient_id=None):
+    genders = list(config["gender_weights"])
+    gender = rng.choices(genders, weights=[config["gender_weights"][g] for g in genders])[0]
+    age_low, age_high = config["age_range"]
+    birth_date = datetime.now(timezone.utc).date() - timedelta(days=rng.randint(age_low * 365, age_high * 365))
+    city, state, postal_prefix = rng.choice(ADDRESSES)
+    marital_code, marital_display = rng.choice(MARITAL_STATUSES)
+
+    return {
+        "resourceType": "Patient",
+        "id": new_id(rng, "patient"),
+        "meta": meta(),
+        "identifier": identifier(rng, "http://hospital.example.org/mrn", "MRN"),
+        "active": True,
+        "name": [{"use": "official", "family": rng.choice(FAMILY_NAMES), "given": [rng.choice(GIVEN_NAMES[gender])]}],
+        "telecom": [{"system": "phone", "value": f"555-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}", "use": "home"}],
+        "gender": gender,
+        "birthDate": birth_date.isoformat(),
+        "address": [{
+            "use": "home",
+            "line": [f"{rng.randint(1, 9999)} {rng.choice(STREET_NAMES)}"],
+            "city": city,
+            "state": state,
+            "postalCode": f"{postal_prefix}{rng.randint(10, 99)}",
+            "country": "US"
+        }],
+        "maritalStatus": coding("http://terminology.hl7.org/CodeSystem/v3-MaritalStatus", marital_code, marital_display),
+        "communication": [{"language": coding("urn:ietf:bcp:47", "en-US", "English (United States)"), "preferred": True}],
+        "generalPractitioner": [{"reference": f"Practitioner/{new_id(rng, 'practitioner')}"}],
+        "managingOrganization": {"reference": f"Organization/{new_id(rng, 'organization')}"}
+    }
+
+
+def build_condition(rng, config, patient_id):
+    code, display = rng.choice(CONDITION_CODES)
+    severity_code, severity_display = rng.choice(SEVERITY_CODES)
+    onset = random_datetime(rng, config)
+
+    return {
+        "resourceType": "Condition",
+        "id": new_id(rng, "condition"),
+        "meta": meta(),
+        "identifier": identifier(rng, "http://hospital.example.org/condition", "COND"),
+        "clinicalStatus": coding("http://terminology.hl7.org/CodeSystem/condition-clinical", "active", "Active"),
+        "verificationStatus": coding("http://terminology.hl7.org/CodeSystem/condition-ver-status", "confirmed", "Confirmed"),
+        "category": [coding("http://terminology.hl7.org/CodeSystem/condition-category", "problem-list-item", "Problem List Item")],
+        "severity": coding(SNOMED, severity_code, severity_display),
+        "code": coding(SNOMED, code, display),
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "onsetPeriod": {"start": isoformat(onset)},
+        "recordedDate": isoformat(onset + timedelta(days=rng.randint(0, 14)))
+    }
+
+
+def build_encounter(rng, config, patient_id):
+    class_code, class_display = rng.choice(ENCOUNTER_CLASSES)
+    type_code, type_display = rng.choice(ENCOUNTER_TYPES)
+    start = random_datetime(rng, config)
+
+    return {
+        "resourceType": "Encounter",
+        "id": new_id(rng, "encounter"),
+        "meta": meta(),
+        "identifier": identifier(rng, "http://hospital.example.org/encounter", "ENC"),
+        "status": "completed",
+        "class": [coding("http://terminology.hl7.org/CodeSystem/v3-ActCode", class_code, class_display)],
+        "type": [coding(SNOMED, type_code, type_display)],
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "actualPeriod": {"start": isoformat(start), "end": isoformat(start + timedelta(minutes=rng.randint(15, 240)))},
+        "location": [{"location": {"reference": f"Location/{new_id(rng, 'location')}"}}]
+    }
+
+
+def build_appointment(rng, config, patient_id):
+    category_code, category_display = rng.choice(APPOINTMENT_SERVICE_CATEGORIES)
+    type_code, type_display = rng.choice(APPOINTMENT_TYPES)
+    minutes = rng.choice([15, 20, 30, 45, 60])
+    start = (datetime.now(timezone.utc) + timedelta(days=rng.randint(1, 90))).replace(hour=rng.randint(8, 16), minute=0, second=0, microsecond=0)
+
+    return {
+        "resourceType": "Appointment",
+        "id": new_id(rng, "appointment"),
+        "meta": meta(),
+        "identifier": identifier(rng, "http://hospital.example.org/appointment", "APPT"),
+        "status": "booked",
+        "serviceCategory": [coding("http://terminology.hl7.org/CodeSystem/service-category", category_code, category_display)],
+        "appointmentType": coding("http://terminology.hl7.org/CodeSystem/v2-0276", type_code, type_display),
+        "start": isoformat(start),
+        "end": isoformat(start + timedelta(minutes=minutes)),
+        "minutesDuration": minutes,
+        "created": (start - timedelta(days=rng.randint(1, 30))).date().isoformat(),
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "participant": [{"actor": {"reference": f"Patient/{patient_id}"}, "status": "accepted"}]
+    }
+
+
+def build_observation(rng, config, patient_id, observation_type="laboratory"):
+    effective = random_datetime(rng, config)
+    observation = {
+        "resourceType": "Observation",
+        "id": new_id(rng, "observation"),
+        "meta": meta(),
+        "identifier": identifier(rng, "http://hospital.example.org/observation", "OBS"),
+        "status": "final",
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "effectiveDateTime": isoformat(effective),
+        "issued": isoformat(effective + timedelta(hours=rng.randint(1, 48))),
+        "performer": [{"reference": f"Practitioner/{new_id(rng, 'practitioner')}"}]
+    }
+
+    if observation_type == "blood_pressure":
+        observation["category"] = [coding("http://terminology.hl7.org/CodeSystem/observation-category", "vital-signs", "Vital Signs")]
+        observation["code"] = coding(LOINC, "85354-9", "Blood pressure panel with all children optional")
+        observation["component"] = [
+            {
+                "code": coding(LOINC, "8480-6", "Systolic blood pressure"),
+                "valueQuantity": {"value": rng.randint(95, 165), "unit": "mmHg", "system": UCUM, "code": "mm[Hg]"}
+            },
+            {
+                "code": coding(LOINC, "8462-4", "Diastolic blood pressure"),
+                "valueQuantity": {"value": rng.randint(60, 100), "unit": "mmHg", "system": UCUM, "code": "mm[Hg]"}
+            }
+        ]
+    elif observation_type == "heart_rate":
+        code, display, unit, ucum, low, high = OBSERVATION_CODES["heart_rate"]
+        observation["category"] = [coding("http://terminology.hl7.org/CodeSystem/observation-category", "vital-signs", "Vital Signs")]
+        observation["code"] = coding(LOINC, code, display)
+        observation["valueQuantity"] = {"value": rng.randint(low, high), "unit": unit, "system": UCUM, "code": ucum}
+    else:
+        code, display, unit, ucum, low, high = rng.choice(OBSERVATION_CODES["laboratory"])
+        observation["category"] = [coding("http://terminology.hl7.org/CodeSystem/observation-category", "laboratory", "Laboratory")]
+        observation["code"] = coding(LOINC, code, display)
+        observation["valueQuantity"] = {"value": round(rng.uniform(low * 0.8, high * 1.2), 1), "unit": unit, "system": UCUM, "code": ucum}
+        observation["referenceRange"] = [{
+            "low": {"value": low, "unit": unit, "system": UCUM, "code": ucum},
+            "high": {"value": high, "unit": unit, "system": UCUM, "code": ucum}
+        }]
+
+    return observation
+
+
+def build_service_request(rng, config, patient_id):
+    code, display = rng.choice(SERVICE_REQUEST_CODES)
+    authored = random_datetime(rng, config)
+
+    return {
+        "resourceType": "ServiceRequest",
+        "id": new_id(rng, "servicerequest"),
+        "meta": meta(),
+        "identifier": identifier(rng, "http://hospital.example.org/servicerequest", "SR"),
+        "status": "active",
+        "intent": "order",
+        "category": [coding(SNOMED, "108252007", "Laboratory procedure")],
+        "code": {"concept": coding(SNOMED, code, display)},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "occurrenceDateTime": isoformat(authored + timedelta(days=rng.randint(1, 30))),
+        "authoredOn": isoformat(authored),
+        "requester": {"reference": f"Practitioner/{new_id(rng, 'practitioner')}"}
+    }
+
+
+def build_medication_request(rng, config, patient_id):
+    code, display, instruction = rng.choice(MEDICATION_CODES)
+    authored = random_datetime(rng, config)
+    quantity = rng.choice([30, 60, 90])
+
+    return {
+        "resourceType": "MedicationRequest",
+        "id": new_id(rng, "medreq"),
+        "meta": meta(),
+        "identifier": identifier(rng, "http://hospital.example.org/medicationrequest", "MR"),
+        "status": "active",
+        "intent": "order",
+        "category": [coding("http://terminology.hl7.org/CodeSystem/medicationrequest-admin-location", "community", "Community")],
+        "medication": {"concept": coding(RXNORM, code, display)},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "authoredOn": isoformat(authored),
+        "requester": {"reference": f"Practitioner/{new_id(rng, 'practitioner')}"},
+        "dosageInstruction": [{
+            "text": instruction,
+            "doseAndRate": [{"doseQuantity": {"value": 1, "unit": "tablet", "system": UCUM, "code": "{tbl}"}}]
+        }],
+        "dispenseRequest": {
+            "validityPeriod": {"start": isoformat(authored), "end": isoformat(authored + timedelta(days=365))},
+            "numberOfRepeatsAllowed": rng.randint(0, 5),
+            "quantity": {"value": quantity, "unit": "tablet", "system": UCUM, "code": "{tbl}"}
+        }
+    }
+
+
+def build_allergy_intolerance(rng, config, patient_id):
+    code, display, category = rng.choice(ALLERGY_CODES)
+    recorded = random_datetime(rng, config)
+
+    return {
+        "resourceType": "AllergyIntolerance",
+        "id": new_id(rng, "allergyintolerance"),
+        "meta": meta(),
+        "identifier": identifier(rng, "http://hospital.example.org/allergyintolerance", "ALG"),
+        "clinicalStatus": coding("http://terminology.hl7.org/CodeSystem/allergyintolerance-clinical", "active", "Active"),
+        "verificationStatus": coding("http://terminology.hl7.org/CodeSystem/allergyintolerance-verification", "confirmed", "Confirmed"),
+        "category": [category],
+        "criticality": rng.choice(["low", "high", "unable-to-assess"]),
+        "code": coding(SNOMED, code, display),
+        "patient": {"reference": f"Patient/{patient_id}"},
+        "recordedDate": isoformat(recorded)
+    }
+
+
+# Builders for each resourceType supported by the offline engine
+OFFLINE_RESOURCE_BUILDERS = {
+    "Patient": build_patient,
+    "Condition": build_condition,
+    "Encounter": build_encounter,
+    "Appointment": build_appointment,
+    "Observation": build_observation,
+    "ServiceRequest": build_service_request,
+    "MedicationRequest": build_medication_request,
+    "AllergyIntolerance": build_allergy_intolerance
+}
+
+
+# Function to generate a FHIR resource from the vocabularies and distributions, without any network call
+def generate_offline_resource(resource_type, patient_id=None, input_data=None, observation_type=None, offline_config=None, rng=None):
+    if resource_type not in OFFLINE_RESOURCE_BUILDERS:
+        raise ValueError(f"Unsupported resource type for offline generation: {resource_type}")
+
+    config = dict(DEFAULT_OFFLINE_CONFIG)
+    config.update(offline_config or {})
+    rng = rng or shared_rng
+
+    if resource_type == "Observation":
+        resource = build_observation(rng, config, patient_id, observation_type or "laboratory")
+    else:
+        resource = OFFLINE_RESOURCE_BUILDERS[resource_type](rng, config, patient_id)
+
+    return apply_input_data(resource, input_data)
@@ -0,0 +1,115 @@
+import logging
+import os
+import json
+import math
+import threading
+
+
+# Default budgeting settings, overridable through the app settings
+DEFAULT_MAX_TOKENS = 4096                                                              # Budget used until enough samples are recorded
+MAX_TOKENS_CEILING = int(os.environ.get("FHIR_MAX_TOKENS_CEILING", DEFAULT_MAX_TOKENS))  # Largest budget ever requested
+MIN_TOKENS_BUDGET = int(os.environ.get("FHIR_MIN_TOKENS_BUDGET", 256))
+BUDGET_PERCENTILE = float(os.environ.get("FHIR_TOKEN_BUDGET_PERCENTILE", 0.99))
+BUDGET_MARGIN = float(os.environ.get("FHIR_TOKEN_BUDGET_MARGIN", 0.2))                 # Added on top of the percentile
+MIN_SAMPLES = int(os.environ.get("FHIR_TOKEN_BUDGET_MIN_SAMPLES", 20))
+HISTOGRAM_BUCKET_SIZE = 32
+BUDGET_FILE = os.environ.get("FHIR_TOKEN_BUDGET_FILE")                                # Optional, to keep histograms across restarts
+SAVE_EVERY = 20
+
+
+# Completion-token histograms per resource type and prompt variant, used to reserve only the tokens a completion
+# actually needs (percentile plus margin) instead of a fixed 4096 for every call
+class TokenBudget:
+    def __init__(self, budget_file=BUDGET_FILE):
+        self.budget_file = budget_file
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self._load()
+
+    @staticmethod
+    def _key(resource_type, variant):
+        return f"{resource_type}/{variant}"
+
+    def _load(self):
+        if not self.budget_file:
+            return
+        try:
+            with open(self.budget_file, "r") as budget_file:
+                self._histograms = json.load(budget_file)
+        except (OSError, ValueError):
+            self._histograms = {}
+
+    def _save(self):
+        try:
+            temp_path = f"{self.budget_file}.tmp"
+            with open(temp_path, "w") as budget_file:
+                json.dump(self._histograms, budget_file)
+            os.replace(temp_path, self.budget_file)
+        except OSError as e:
+            logging.error(f"Failed to store token budget histograms: {e}")
+
+    # Function to record the completion tokens used by a call, and whether it was cut off by the budget
+    def record(self, resource_type, variant, completion_tokens, truncated=False):
+        if not resource_type or completion_tokens is None:
+            return
+
+        with self._lock:
+            histogram = self._histograms.setdefault(self._key(resource_type, variant), {"samples": 0, "truncated": 0, "buckets": {}})
+            bucket = str(completion_tokens // HISTOGRAM_BUCKET_SIZE)
+            histogram["buckets"][bucket] = histogram["buckets"].get(bucket, 0) + 1
+            histogram["samples"] += 1
+            if truncated:
+                histogram["truncated"] += 1
+
+            self._unsaved += 1
+            if self.budget_file and self._unsaved >= SAVE_EVERY:
+                self._unsaved = 0
+                self._save()
+
+    # Function to get the max_tokens budget for a call, derived from the recorded histogram
+    def get_budget(self, resource_type, variant="default"):
+        if not resource_type:
+            return DEFAULT_MAX_TOKENS
+
+        with self._lock:
+            histogram = self._histograms.get(self._key(resource_type, variant))
+            if not histogram or histogram["samples"] < MIN_SAMPLES:
+                return min(DEFAULT_MAX_TOKENS, MAX_TOKENS_CEILING)
+
+            # Walk the buckets up to the configured percentile
+            target = math.ceil(histogram["samples"] * BUDGET_PERCENTILE)
+            seen = 0
+            percentile_tokens = 0
+            for bucket in sorted(histogram["buckets"], key=int):
+                seen += histogram["buckets"][bucket]
+                percentile_tokens = (int(bucket) + 1) * HISTOGRAM_BUCKET_SIZE
+                if seen >= target:
+                    break
+
+        budget = int(percentile_tokens * (1 + BUDGET_MARGIN))
+        return max(MIN_TOKENS_BUDGET, min(budget, MAX_TOKENS_CEILING))
+
+    # Function to get the larger budget used to retry a truncated completion
+    @staticmethod
+    def get_retry_budget(max_tokens):
+        return min(MAX_TOKENS_CEILING, max(max_tokens * 2, DEFAULT_MAX_TOKENS))
+
+    # Function to summarise the histograms (samples, truncations and current budget per resource type and variant)
+    def summary(self):
+        with self._lock:
+            keys = list(self._histograms)
+        summary = {}
+        for key in keys:
+            resource_type, variant = key.split("/", 1)
+            histogram = self._histograms[key]
+            summary[key] = {
+                "samples": histogram["samples"],
+                "truncated": histogram["truncated"],
+                "budget": self.get_budget(resource_type, variant)
+            }
+        return summary
+
+
+# Budgets shared by all the requests handled by this worker
+token_budget = TokenBudget()
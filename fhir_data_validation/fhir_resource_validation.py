@@ -0,0 +1,421 @@
+import json  
+import logging
+import os
+from datetime import datetime  
+import azure.functions as func  
+from concurrent.futures import ThreadPoolExecutor
+from BlobStorage import uploadBlob, getContainerClient
+from fhir_data_validation.schema_index import schema_index, get_resource_class
+from fhir_data_validation.repair_rules import repair_rule_set, describe_repair, count_repair_rules
+from Serialization import dumpJson, encodeJsonBlob
+
+# The fhir.resources models, pydantic and the Blob SDK are imported on first use, to keep cold starts short
+
+
+fhir_resource_validation_blueprint = func.Blueprint()
+
+# Limits for validating every bundle under blob prefixes, overridable through the app settings
+MAX_VALIDATION_BLOBS = int(os.environ.get("FHIR_VALIDATION_MAX_BLOBS", 100))
+DEFAULT_VALIDATION_CONCURRENCY = int(os.environ.get("FHIR_VALIDATION_CONCURRENCY", 4))
+
+
+# Function to fetch all the fields for each resourceType present in the generated data
+def extract_all_fields(data, parent_key=''):  
+    fields = []  
+    
+    if isinstance(data, dict):  
+        for key, value in data.items():  
+            new_key = f"{parent_key}.{key}" if parent_key else key  
+            fields.append(new_key)  
+            fields.extend(extract_all_fields(value, new_key))  
+    elif isinstance(data, list):  
+        for index, item in enumerate(data):  
+            new_key = f"{parent_key}[{index}]"
+            fields.append(new_key) 
+            fields.extend(extract_all_fields(item, new_key))  
+    else:  
+        if parent_key:  
+            fields.append(parent_key) 
+    
+    return fields
+
+# Function to check if fields in the resource exists within a nested dictionary structure
+def check_field_presence(field, data):  
+    parts = field.split('.')     # Split into a list of parts
+    current = data  
+    
+    # Iterates through each part
+    for part in parts:
+        # Check if the current part exists as a key within that dictionary
+        if isinstance(current, dict) and part in current:  
+            current = current[part]  
+        # Check if the current part exists as a key within that dictionary  
+        elif isinstance(current, list):  
+            try:  
+                index = int(part.strip('[]'))  
+                current = current[index]  
+            except:  
+                return False  
+        else:  
+            return False  
+    return True
+
+# Function to apply the repair rules of the resource type (see repair_rules.py) to a resource, in a single traversal,
+# returning the repaired resource (the resource itself if no rule fired) and the rules that fired as (rule, path) pairs
+def repair_fhir_resource(resource_type, resource_data):
+    return repair_rule_set.apply(resource_type, resource_data)
+
+
+# Function to validate individual FHIR resources. Known issues are repaired first, then the repaired resource is validated
+# once. Returns the validation result and the repaired resource (the resource itself if nothing was repaired).
+def validate_individual_fhir_resource(resource_type, resource_data):
+    from pydantic import ValidationError
+
+    try:
+        # Look up the schema of the resource type, built once per process
+        schema = schema_index.get(resource_type)
+
+        # Check if the resource type is supported  
+        if schema is None:  
+            return {  
+                "status": "error",  
+                "message": f"Unsupported resource type: {resource_type}"  
+            }, resource_data
+
+        # Adjust the resource data for known issues
+        resource_data, repairs = repair_fhir_resource(resource_type, resource_data)
+
+        # Get the particular resource class
+        resource_class = schema["resource_class"]
+
+        # Get required and optional fields for the particular resource
+        required_fields, optional_fields = schema["required_fields"], schema["optional_field_set"]
+
+        # Get all fields present in the generated resource data  
+        present_fields = extract_all_fields(resource_data)
+        present_field_set = set(present_fields)
+        
+        try:  
+            # Validate the resource using the FHIR resource model  
+            resource_class(**resource_data)
+            validation_result = {  
+                "status": "success",  
+                "resourceType": resource_type,
+                "message": f"Resource {resource_type}/{resource_data.get('id', 'unknown')} is valid."  
+            }
+        except ValidationError as e:
+            validation_result = {  
+                "status": "error", 
+                "resourceType": resource_type, 
+                "message": f"Resource {resource_type}/{resource_data.get('id', 'unknown')} validation failed. Error: {str(e)}"  
+            }
+
+        # Record whether the resource was valid as generated or only after repairs
+        validation_result["repaired"] = bool(repairs)
+        if repairs:
+            validation_result["repairs"] = [describe_repair(rule, path) for rule, path in repairs]
+            validation_result["repair_rules"] = list(dict.fromkeys(rule["name"] for rule, path in repairs))
+
+        # Identify missing fields  
+        missing_fields = set()      # Use a set to avoid duplicates  
+        for field in required_fields:  
+            if not field.endswith('__ext') and field not in optional_fields and field not in present_field_set:
+                missing_fields.add(field)  
+        missing_fields = list(missing_fields) 
+
+        logging.info(f"Validation results for {resource_type}/{resource_data.get('id', 'unknown')}:")
+        logging.info(f"Existing fields in the resource data for {resource_type}/{resource_data.get('id', 'unknown')}: {present_fields}")  
+        #logging.info(f"Optional fields for {resource_type}/{resource_data.get('id', 'unknown')}: {optional_fields}")
+        logging.info(f"Missing fields for {resource_type}/{resource_data.get('id', 'unknown')}: {missing_fields}")
+        
+        return validation_result, resource_data
+        
+    except ValueError as e:
+        return {  
+            "status": "error",
+            "resourceType": resource_type,
+            "message": str(e)
+        }, resource_data
+
+# Function to validate the entire FHIR data bundle
+def validate_fhir_data(file_path):
+    logging.info('Validating FHIR bundle.')
+
+    # Read the generated FHIR bundle from the file
+    original_file_path = file_path
+    with open(original_file_path, "r") as json_file:  
+        file_content = json_file.read()  
+        if not file_content.strip():  
+            raise ValueError("JSON file is empty")
+    
+    fhir_resource = json.loads(file_content)
+    logging.info(f"Read FHIR bundle from file: {original_file_path}")
+    return validate_fhir_bundle(fhir_resource, original_file_path)
+
+
+# Function to get the container (None for the configured one) and name of a blob given by name or URL
+def get_blob_location(blob_name=None, blob_url=None):
+    if blob_url:
+        from azure.storage.blob import BlobClient
+
+        blob_reference = BlobClient.from_blob_url(blob_url)
+        return blob_reference.container_name, blob_reference.blob_name
+    return None, blob_name
+
+
+# Function to load a FHIR bundle from Azure Blob Storage, by blob name (in the configured container) or blob URL
+def load_fhir_data_from_blob(blob_name=None, blob_url=None):
+    container_name, blob_name = get_blob_location(blob_name, blob_url)
+
+    # Parse the bundle straight from the download stream (gzipped blobs are decompressed by the SDK), without a local file
+    blob_content = getContainerClient(container_name).download_blob(blob_name).readall()
+    if not blob_content.strip():
+        raise ValueError("JSON blob is empty")
+    logging.info(f"Read FHIR bundle from blob: {blob_name}")
+    return json.loads(blob_content), blob_name
+
+
+# Function to validate every FHIR bundle stored under the given blob prefixes, returning the results of each blob
+def validate_fhir_data_from_blob_prefixes(blob_prefixes):
+    container_client = getContainerClient()
+    blob_names = [
+        blob.name
+        for blob_prefix in blob_prefixes
+        for blob in container_client.list_blobs(name_starts_with=blob_prefix)
+        if blob.name.endswith(".json") and not blob.name.endswith("manifest.json")
+    ]
+    if len(blob_names) > MAX_VALIDATION_BLOBS:
+        logging.error(f"{len(blob_names)} blobs found under {blob_prefixes}, more than the maximum of {MAX_VALIDATION_BLOBS}.")
+        return func.HttpResponse(
+            dumpJson({
+                "status": "error",
+                "message": f"At most {MAX_VALIDATION_BLOBS} bundles can be validated in a single request, {len(blob_names)} found."
+            }),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    def validate_blob(blob_name):
+        try:
+            fhir_resource, _ = load_fhir_data_from_blob(blob_name)
+            response = validate_fhir_bundle(fhir_resource, blob_name)
+        except Exception as e:
+            logging.error(f"Exception while validating blob {blob_name}: {e}")
+            return {"blobName": blob_name, "status_code": 500, "response": {"status": "error", "message": f"Blob {blob_name} could not be validated."}}
+        response_body = response.get_body().decode("utf-8")
+        try:
+            response_content = json.loads(response_body)
+        except ValueError:
+            response_content = {"message": response_body}
+        return {"blobName": blob_name, "status_code": response.status_code, "response": response_content}
+
+    # Download and validate the blobs concurrently, keeping the listing order in the results
+    with ThreadPoolExecutor(max_workers=max(1, min(DEFAULT_VALIDATION_CONCURRENCY, len(blob_names)))) as executor:
+        results = list(executor.map(validate_blob, blob_names))
+
+    succeeded = sum(1 for result in results if result["status_code"] == 200)
+    return func.HttpResponse(
+        dumpJson({
+            "status": "success" if succeeded == len(results) else "error",
+            "message": f"Validated {succeeded} of {len(results)} FHIR bundles under {blob_prefixes}.",
+            "results": results
+        }),
+        status_code=200 if succeeded == len(results) else 207,
+        mimetype="application/json"
+    )
+
+
+# Function to validate a FHIR bundle (or a single resource) in a single pass: each resource is repaired (copy-on-write,
+# the input is never modified) and validated once, then the repaired bundle is validated once.
+# Returns the repaired bundle, the validation results and whether the original bundle was valid.
+def validate_bundle_resources(fhir_resource):
+    from pydantic import ValidationError
+
+    Bundle = get_resource_class("Bundle")
+
+    validation_results = []          # Empty list to store the validation results
+    validation_success = True        # Var to store the validation status
+
+    # Convert the provided JSON structure into a FHIR bundle format if necessary  
+    if 'entry' not in fhir_resource:  
+        entries = []  
+        for key, resource in fhir_resource.items():  
+            if isinstance(resource, list):  
+                for res in resource:  
+                    entries.append({"resource": res})  
+            else:  
+                entries.append({"resource": resource})  
+        validated_fhir_resource = {  
+            "resourceType": "Bundle",  
+            "type": "collection",  
+            "entry": entries  
+        }  
+        logging.info("Converted JSON to FHIR bundle format.")
+    else:
+        validated_fhir_resource = dict(fhir_resource)
+        if validated_fhir_resource.get("resourceType") == "Bundle" and 'type' not in validated_fhir_resource:  
+            # The original bundle is invalid without a type, so the repaired bundle is returned
+            validated_fhir_resource['type'] = 'collection'  
+            validation_success = False
+            logging.info("Set the bundle type to 'collection'.")  
+
+    if validated_fhir_resource.get("resourceType") == "Bundle":
+        entries = validated_fhir_resource.get('entry', [])
+        resources = [
+            entry.get("resource") for entry in entries
+            if entry.get("resource") and 'resourceType' in entry.get("resource")
+        ]
+
+        # Validate the resources, across the validation processes for large bundles (results come back in entry order)
+        from fhir_data_validation.validation_pool import validation_process_pool
+        if validation_process_pool.is_enabled_for(len(resources)):
+            logging.info(f"Validating {len(resources)} resources in {validation_process_pool.processes} processes.")
+            outcomes = iter(validation_process_pool.validate_resources(resources))
+        else:
+            outcomes = (validate_individual_fhir_resource(resource_data.get("resourceType"), resource_data) for resource_data in resources)
+
+        # Record the result of each entry, replacing the entries whose resource was repaired
+        validated_entries = []
+        for entry in entries:
+            resource_data = entry.get("resource")
+
+            # Check if resourceType is missing
+            if not resource_data or 'resourceType' not in resource_data:
+                logging.error(f"Missing 'resourceType' in resource: {json.dumps(resource_data)}")
+                validation_results.append({
+                    "status": "error",  
+                    "message": f"Missing 'resourceType' in resource {resource_data}"
+                })
+                validation_success = False
+                validated_entries.append(entry)
+                continue
+            
+            validation_result, validated_resource_data = next(outcomes)
+            validation_results.append(validation_result)
+            if validation_result["status"] == "error":  
+                validation_success = False
+            validated_entries.append(entry if validated_resource_data is resource_data else {**entry, "resource": validated_resource_data})
+        validated_fhir_resource["entry"] = validated_entries
+
+        # Validate the Bundle itself
+        logging.info("Validating the entire FHIR bundle.")
+        try:
+            Bundle(**validated_fhir_resource)
+        except ValidationError as e:
+            validation_results.insert(0, {
+                "status": "error",  
+                "message": f"Bundle validation failed: {str(e)}"
+            })
+            validation_success = False
+
+    else:
+        resource_type = validated_fhir_resource.get("resourceType")
+        validation_result, validated_fhir_resource = validate_individual_fhir_resource(resource_type, validated_fhir_resource) 
+        validation_results.append(validation_result)
+        if validation_result["status"] == "error":  
+            validation_success = False
+
+    return validated_fhir_resource, validation_results, validation_success
+
+
+# Function to validate a FHIR bundle already in memory - original_file_path names the file or blob it was read from.
+# If the original bundle has errors, the repaired bundle is uploaded with the results.
+def validate_fhir_bundle(fhir_resource, original_file_path="inline_bundle"):
+    try:
+        validated_fhir_resource, validation_results, validation_success = validate_bundle_resources(fhir_resource)
+
+        # Count the resources valid as generated, valid after repairs and invalid
+        validation_summary = {
+            "valid": sum(1 for result in validation_results if result["status"] == "success" and not result.get("repaired")),
+            "repaired": sum(1 for result in validation_results if result["status"] == "success" and result.get("repaired")),
+            "invalid": sum(1 for result in validation_results if result["status"] != "success"),
+            "repair_rules": count_repair_rules(validation_results)
+        }
+        
+        # If original FHIR bundle doesn't contain any errors after validation
+        if validation_success:
+            initial_validation_response = {  
+                "status": "success",  
+                "message": "Validation of original bundle completed successfully.",  
+                "initial_validation": {  
+                    "status": "success",    
+                    "filePath": original_file_path,  
+                    "message": "Original FHIR Bundle and resourceTypes are valid. No re-validation needed.",  
+                    "summary": validation_summary,
+                    "results": validation_results  
+                }
+            }
+            # Convert validated data to JSON string  
+            initial_validation_response_json = dumpJson(initial_validation_response)  
+
+            return func.HttpResponse( 
+                initial_validation_response_json, 
+                status_code=200,
+                mimetype="application/json"  
+            )
+            
+        # Else if original FHIR bundle contains errors after validation, store the repaired bundle
+        else:
+            # Extract the id from the original file name  
+            base_filename = os.path.basename(original_file_path)
+            if base_filename.startswith("generated_fhir_bundle_"):
+                # If original filename is "generated_fhir_bundle_{patiendID}"                            [normal case]
+                base_id = base_filename.replace("generated_fhir_bundle_", "").replace(".json", "")
+                # Store the modified data in a FHIR bundle dyanmically with base patientID
+                new_file_path = f"fhir_data_validation/validated_fhir_bundle_{base_id}.json"
+            else:      # Store the modified data in a FHIR bundle dyanmically with current datetime       [edge case]
+                new_file_path = f"fhir_data_validation/validated_fhir_bundle_{datetime.now().strftime('%Y%m%d%H%M%S')}.json"
+            
+            # Convert validated data to JSON, compact and gzipped as configured
+            validated_data_body, content_settings = encodeJsonBlob(validated_fhir_resource)
+            logging.info("FHIR bundle validation process completed successfully.")
+
+            # Store the JSON file in Azure Blob Storage  
+            file_name = new_file_path
+
+            # Upload the JSON string to the blob with the worker's pooled storage client
+            blob_client = uploadBlob(file_name, validated_data_body, content_settings=content_settings)
+            blob_url = blob_client.url         # Fetch the URL of the uploaded blob  
+
+            # Return response for the newly generated validated bundle using ValidationAPI
+            initial_validation_response = {  
+                "status": "error",
+                "filePath": original_file_path, 
+                "message": "Initial FHIR Bundle contains errors. Generating validated bundle."
+            }
+            re_validation_response = {  
+                "status": "success",
+                "filePath": f"Validated FHIR bundle '{new_file_path}' available to download from Postman",
+                "message": "FHIR Bundle and resourceTypes are valid after re-validation.",  
+                "blobUrl": blob_url,
+                "summary": validation_summary,
+                "results": validation_results  
+            }
+            
+            # Create response dictionary
+            postman_response = {  
+                "status": "success",  
+                "message": "Validation of original bundle and validated bundle completed successfully.",  
+                "initial_validation": initial_validation_response, 
+                "re_validation": re_validation_response
+            } 
+            # Convert response dictionary to JSON string  
+            postman_response_json = dumpJson(postman_response)  
+
+            # Return the JSON content in the response with headers to prompt download  
+            logging.info("Validated FHIR bundle available to download from Postman. Click on the 'Save Response' button and choose 'Save to a file' to download the JSON file.") 
+            return func.HttpResponse(  
+                postman_response_json,
+                status_code=200,  
+                headers={  
+                    "Content-Disposition": f"attachment; filename={new_file_path}",  
+                    "Content-Type": "application/json"  
+                }  
+            )
+    
+    except Exception as e:  
+        logging.error(f"An unexpected error occurred: {str(e)}") 
+        return func.HttpResponse(  
+            f"An unexpected error occurred: {str(e)}", 
+              status_code=500
+        )
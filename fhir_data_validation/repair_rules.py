@@ -0,0 +1,231 @@
+import json
+import threading
+from collections import Counter
+from datetime import datetime
+import pytz
+from fhir_data_validation.schema_index import schema_index
+
+
+# Repairs applied to generated resources before validation, declared as rules on element paths (dotted, without list
+# indices). A rule applies to the resource types it names ("*" for all), at its "path" or at every path of the schema
+# index listed by "schema_paths". The rules of a path run in the order they are declared here.
+REPAIR_RULES = [
+    {"name": "encounter-class-list", "resource_types": ["Encounter"], "path": "class", "action": "wrap-list"},
+    {"name": "encounter-period", "resource_types": ["Encounter"], "path": "period", "action": "drop"},
+    {"name": "encounter-participant", "resource_types": ["Encounter"], "path": "participant", "action": "drop"},
+    {"name": "encounter-diagnosis", "resource_types": ["Encounter"], "path": "diagnosis", "action": "drop"},
+    {"name": "appointment-instruction-list", "resource_types": ["Appointment"], "path": "patientInstruction", "action": "wrap-list"},
+    {"name": "appointment-instruction-text", "resource_types": ["Appointment"], "path": "patientInstruction", "action": "drop-plain-text"},
+    {"name": "appointment-comment", "resource_types": ["Appointment"], "path": "comment", "action": "drop"},
+    {"name": "service-request-code", "resource_types": ["ServiceRequest"], "path": "code", "action": "drop-other-shape", "shape": "CodeableReference", "keys": ["concept", "reference"]},
+    {"name": "service-request-timing-event", "resource_types": ["ServiceRequest"], "path": "occurrenceTiming.event", "action": "unwrap-field", "field": "effectiveDateTime"},
+    {"name": "medication-request-medication", "resource_types": ["MedicationRequest"], "path": "medicationCodeableConcept", "action": "rename", "target": "medication.concept"},
+    {"name": "allergy-intolerance-reaction", "resource_types": ["AllergyIntolerance"], "path": "reaction", "action": "drop"},
+    {"name": "allergy-intolerance-type", "resource_types": ["AllergyIntolerance"], "path": "type", "action": "drop"},
+    {"name": "timezone-aware-datetimes", "resource_types": ["*"], "schema_paths": "datetime_paths", "action": "normalize-datetime"}
+]
+
+# Value returned by an action to remove the element
+DROPPED = object()
+
+
+# Function to ensure datetime fields are timezone aware (values that already are are returned unchanged). Date-only values
+# (YYYY-MM-DD, a valid partial dateTime) have no time to attach a timezone to, so they are kept at their precision.
+def ensure_timezone_aware(dt_str):
+    if len(dt_str) == 10:
+        return dt_str
+    try:
+        dt = datetime.fromisoformat(dt_str)
+        if dt.tzinfo is None:
+            return dt.replace(tzinfo=pytz.UTC).isoformat()
+        return dt_str
+    except ValueError:
+        return dt_str
+
+
+# Repair actions: each takes the value of the element, the rule and the object holding the element, and returns the
+# repaired value, DROPPED to remove the element, or the value itself (the same object) when the rule does not apply
+def wrap_list(value, rule, parent):
+    return value if isinstance(value, list) else [value]
+
+
+def drop(value, rule, parent):
+    return DROPPED
+
+
+# The value is moved to the rule's target path, unless the first element of that path is already present
+def rename(value, rule, parent):
+    return value if rule["target"].split(".")[0] in parent else DROPPED
+
+
+def normalize_datetime(value, rule, parent):
+    if isinstance(value, str):
+        return ensure_timezone_aware(value)
+    if isinstance(value, list):
+        items = [ensure_timezone_aware(item) if isinstance(item, str) else item for item in value]
+        return items if items != value else value
+    return value
+
+
+# Keep a value of the rule's shape (an object with one of its keys) and drop any other, e.g. an R4 CodeableConcept
+# generated where R5 expects a CodeableReference
+def drop_other_shape(value, rule, parent):
+    return value if isinstance(value, dict) and any(key in value for key in rule["keys"]) else DROPPED
+
+
+# Drop the list items generated as plain text (strings that are not JSON)
+def drop_plain_text(value, rule, parent):
+    if not isinstance(value, list):
+        return value
+
+    def is_kept(item):
+        if not isinstance(item, str):
+            return True
+        try:
+            json.loads(item)
+            return True
+        except json.JSONDecodeError:
+            return False
+    items = [item for item in value if is_kept(item)]
+    return items if len(items) != len(value) else value
+
+
+# Replace the list items generated as objects by the value of the rule's field
+def unwrap_field(value, rule, parent):
+    if not isinstance(value, list) or not any(isinstance(item, dict) and rule["field"] in item for item in value):
+        return value
+    return [item[rule["field"]] if isinstance(item, dict) and rule["field"] in item else item for item in value]
+
+
+REPAIR_ACTIONS = {
+    "wrap-list": wrap_list,
+    "drop": drop,
+    "rename": rename,
+    "normalize-datetime": normalize_datetime,
+    "drop-plain-text": drop_plain_text,
+    "unwrap-field": unwrap_field,
+    "drop-other-shape": drop_other_shape
+}
+
+# How each action is described in the validation results, after the element path
+REPAIR_DESCRIPTIONS = {
+    "wrap-list": "wrapped in a list",
+    "drop": "removed",
+    "rename": "moved to {target}",
+    "normalize-datetime": "made timezone aware",
+    "drop-plain-text": "text removed",
+    "unwrap-field": "objects replaced by their {field}",
+    "drop-other-shape": "removed (not a {shape})"
+}
+
+
+# Function to set a value at a dotted path of a dict, creating the missing objects along the path
+def set_path(data, path, value):
+    *parents, key = path.split(".")
+    for parent in parents:
+        data = data.setdefault(parent, {})
+    data[key] = value
+
+
+# Repair rules compiled into a dispatch table per resource type (element path -> rules), built once per process on
+# first use, so a resource is repaired in a single traversal that only descends into elements with rules below them
+class RepairRuleSet:
+    def __init__(self, rules=REPAIR_RULES):
+        for rule in rules:
+            if rule["action"] not in REPAIR_ACTIONS:
+                raise ValueError(f"Unknown action {rule['action']!r} in repair rule {rule['name']!r}.")
+        self.rules = rules
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _compile(self, resource_type):
+        schema = schema_index.get(resource_type)
+        rules_by_path = {}
+        for rule in self.rules:
+            if "*" not in rule["resource_types"] and resource_type not in rule["resource_types"]:
+                continue
+            paths = schema[rule["schema_paths"]] if "schema_paths" in rule else [rule["path"]]
+            for path in paths:
+                rules_by_path.setdefault(path, []).append(rule)
+
+        # Paths with rules below them, the only elements the traversal descends into
+        prefixes = set()
+        for path in rules_by_path:
+            parts = path.split(".")
+            prefixes.update(".".join(parts[:index]) for index in range(1, len(parts)))
+
+        return {
+            "rules": {path: tuple(rules) for path, rules in rules_by_path.items()},
+            "prefixes": frozenset(prefixes)
+        }
+
+    # Function to get the dispatch table of a resource type, or None if the type is not supported
+    def get_table(self, resource_type):
+        table = self._tables.get(resource_type)
+        if table is None and schema_index.get(resource_type) is not None:
+            with self._lock:
+                table = self._tables.get(resource_type)
+                if table is None:
+                    table = self._tables[resource_type] = self._compile(resource_type)
+        return table
+
+    # Function to apply the rules of a resource type to a resource, returning the repaired resource and the rules that
+    # fired as (rule, path) pairs. The resource is never modified: objects and lists are copied only along the paths
+    # a rule changes (copy-on-write), so a resource that needs no repair is returned as is.
+    def apply(self, resource_type, resource_data):
+        table = self.get_table(resource_type)
+        if table is None:
+            return resource_data, []
+        fired = {}
+        repaired = self._apply_rules(resource_data, table, "", fired)
+        return repaired, list(fired.values())
+
+    def _apply_rules(self, data, table, parent_path, fired):
+        if isinstance(data, list):
+            items = [self._apply_rules(item, table, parent_path, fired) for item in data]
+            return items if any(item is not original for item, original in zip(items, data)) else data
+        if not isinstance(data, dict):
+            return data
+
+        changed = {}
+        moved = []
+        for key, value in data.items():
+            path = f"{parent_path}.{key}" if parent_path else key
+            new_value = value
+            for rule in table["rules"].get(path, ()):
+                result = REPAIR_ACTIONS[rule["action"]](new_value, rule, data)
+                if result is new_value:
+                    continue
+                fired.setdefault((rule["name"], path), (rule, path))        # A rule is reported once per element path
+                if rule["action"] == "rename":
+                    moved.append((rule["target"], new_value))
+                new_value = result
+                if result is DROPPED:
+                    break
+            if new_value is not DROPPED and path in table["prefixes"]:
+                new_value = self._apply_rules(new_value, table, path, fired)
+            if new_value is not value:
+                changed[key] = new_value
+
+        if not changed:
+            return data
+        repaired = {key: changed.get(key, value) for key, value in data.items() if changed.get(key) is not DROPPED}
+        for target, value in moved:
+            target_path = f"{parent_path}.{target}" if parent_path else target
+            set_path(repaired, target, self._apply_rules(value, table, target_path, fired))
+        return repaired
+
+
+# Function to describe a rule that fired on an element, for the validation results
+def describe_repair(rule, path):
+    return f"{path} {REPAIR_DESCRIPTIONS[rule['action']].format(**rule)}"
+
+
+# Function to count the resources each rule repaired across validation results, most frequent first (a rule that
+# repaired several elements of a resource counts once, the elements are listed in the resource's repairs)
+def count_repair_rules(validation_results):
+    return dict(Counter(name for result in validation_results for name in result.get("repair_rules", ())).most_common())
+
+
+# Rule set shared by all the validations of this worker
+repair_rule_set = RepairRuleSet()
@@ -0,0 +1,178 @@
+import logging
+import time
+import typing
+import datetime
+import importlib
+import threading
+
+
+# Resource types supported by validation, mapped to the fhir.resources module of their model. The models are
+# imported on first use (each takes tens of milliseconds), so a cold start only pays for the types it validates.
+RESOURCE_CLASSES = {
+    "Patient": "fhir.resources.patient",
+    "Condition": "fhir.resources.condition",
+    "Encounter": "fhir.resources.encounter",
+    "Appointment": "fhir.resources.appointment",
+    "Observation": "fhir.resources.observation",
+    "ServiceRequest": "fhir.resources.servicerequest",
+    "MedicationRequest": "fhir.resources.medicationrequest",
+    "AllergyIntolerance": "fhir.resources.allergyintolerance"
+}
+
+_loaded_classes = {}
+
+
+# Function to get the fhir.resources model of a resource type (Bundle included), importing its module on first use
+def get_resource_class(resource_type):
+    resource_class = _loaded_classes.get(resource_type)
+    if resource_class is None:
+        module_name = RESOURCE_CLASSES.get(resource_type, f"fhir.resources.{resource_type.lower()}")
+        resource_class = getattr(importlib.import_module(module_name), resource_type)
+        _loaded_classes[resource_type] = resource_class
+    return resource_class
+
+# Element paths deeper than this are not indexed (FHIR datatypes are recursive, e.g. Identifier -> Reference -> Identifier)
+MAX_PATH_DEPTH = 4
+
+# Elements that are not walked: generic extension containers and inline resources
+SKIPPED_ELEMENTS = {"extension", "modifierExtension", "contained", "fhir_comments"}
+
+
+# Function to describe a field annotation: whether it is a list, whether it holds a dateTime/instant, and its nested model
+def describe_annotation(annotation):
+    is_list = False
+    is_datetime = False
+    nested_class = None
+
+    pending = [annotation]
+    while pending:
+        current = pending.pop()
+        origin = typing.get_origin(current)
+        if origin is typing.Annotated:
+            base, *metadata = typing.get_args(current)
+            if base is datetime.datetime or any(type(marker).__name__ in ("DateTime", "Instant") for marker in metadata):
+                is_datetime = True
+            pending.append(base)
+        elif origin in (list, typing.List):
+            is_list = True
+            pending.extend(typing.get_args(current))
+        elif origin is not None:        # Optional / Union
+            pending.extend(arg for arg in typing.get_args(current) if arg is not type(None))
+        elif current is datetime.datetime:
+            is_datetime = True
+        elif hasattr(current, "get_model_klass"):
+            nested_class = current.get_model_klass()
+        elif getattr(current, "__name__", "") in ("DateTime", "Instant"):        # pydantic v1 fhirtypes
+            is_datetime = True
+    return is_list, is_datetime, nested_class
+
+
+# Function to list the fields of a model as (JSON name, annotation, required by the model) for pydantic v2 and v1
+def get_model_fields(model_class):
+    if hasattr(model_class, "model_fields"):
+        return [
+            (field.alias or field_name, field.annotation, field.is_required())
+            for field_name, field in model_class.model_fields.items()
+            if not field_name.endswith("__ext")
+        ]
+    fields = []
+    for field_name, field in model_class.__fields__.items():
+        if field_name.endswith("__ext"):
+            continue
+        annotation = field.outer_type_ if field.shape == 1 else typing.List[field.type_]        # 1 is pydantic v1 SHAPE_SINGLETON
+        fields.append((field.alias or field_name, annotation, field.required))
+    return fields
+
+
+# Function to collect the dotted paths of the dateTime/instant and list elements of a model, down to MAX_PATH_DEPTH
+def collect_element_paths(model_class, prefix="", depth=1, datetime_paths=None, list_paths=None):
+    datetime_paths = set() if datetime_paths is None else datetime_paths
+    list_paths = set() if list_paths is None else list_paths
+
+    for element_name, annotation, _ in get_model_fields(model_class):
+        if element_name in SKIPPED_ELEMENTS or element_name.startswith("_"):
+            continue
+        path = f"{prefix}{element_name}"
+        is_list, is_datetime, nested_class = describe_annotation(annotation)
+        if is_list:
+            list_paths.add(path)
+        if is_datetime:
+            datetime_paths.add(path)
+        if nested_class is not None and depth < MAX_PATH_DEPTH:
+            collect_element_paths(nested_class, f"{path}.", depth + 1, datetime_paths, list_paths)
+
+    return datetime_paths, list_paths
+
+
+# Function to build the schema of a resource type: the required/optional split used by validation
+# (fields with a None default and no default factory), the elements required by FHIR, and the dateTime and list paths.
+# Validation repairs every dateTime path, not only the fields it used to list per type, so naive values anywhere in a
+# resource (e.g. note.time, meta.lastUpdated) get a timezone. Date-only values are kept as they are.
+def build_resource_schema(resource_class):
+    required_fields = []
+    optional_fields = []
+    fields = getattr(resource_class, "model_fields", None) or resource_class.__fields__
+    for field_name, field in fields.items():
+        if field.default is None and field.default_factory is None:
+            required_fields.append(field_name)
+        else:
+            optional_fields.append(field_name)
+
+    datetime_paths, list_paths = collect_element_paths(resource_class)
+    return {
+        "resource_class": resource_class,
+        "required_fields": required_fields,
+        "optional_fields": optional_fields,
+        "optional_field_set": frozenset(optional_fields),
+        "fhir_required_elements": [element_name for element_name, _, required in get_model_fields(resource_class) if required],
+        "top_level_list_elements": sorted(path for path in list_paths if "." not in path),
+        "datetime_paths": frozenset(datetime_paths),
+        "list_paths": frozenset(list_paths)
+    }
+
+
+# Index of the schema of every supported resource type. Each schema is built once per process, the first time its
+# type is looked up (or all at once by warm_up), and then looked up in O(1).
+class SchemaIndex:
+    def __init__(self, resource_types=tuple(RESOURCE_CLASSES)):
+        self.resource_types = resource_types
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+    def _build(self, resource_type):
+        start_time = time.perf_counter()
+        schema = build_resource_schema(get_resource_class(resource_type))
+        logging.info(f"Built FHIR schema of {resource_type} in {time.perf_counter() - start_time:.3f} seconds.")
+        return schema
+
+    # Function to get the schema of a resource type, or None if the type is not supported
+    def get(self, resource_type):
+        schema = self._schemas.get(resource_type)
+        if schema is None and resource_type in self.resource_types:
+            with self._lock:
+                schema = self._schemas.get(resource_type)
+                if schema is None:
+                    schema = self._schemas[resource_type] = self._build(resource_type)
+        return schema
+
+    # Function to build the schemas of every supported type up front, so no request pays for them
+    def warm_up(self):
+        start_time = time.perf_counter()
+        for resource_type in self.resource_types:
+            self.get(resource_type)
+        logging.info(f"Warmed up the FHIR schema index in {time.perf_counter() - start_time:.3f} seconds.")
+
+
+# Index shared by validation, repair and prompt building in this worker
+schema_index = SchemaIndex()
+
+
+# Function to describe the shape constraints of a resource type for a generation prompt
+def get_schema_prompt_hint(resource_type):
+    schema = schema_index.get(resource_type)
+    if schema is None:
+        return ""
+    hint = f"In the {resource_type} resource, these elements must be JSON arrays even with a single value: {', '.join(schema['top_level_list_elements'])}."
+    if schema["datetime_paths"]:
+        hint += " Every dateTime and instant value must include a timezone offset."
+    return hint
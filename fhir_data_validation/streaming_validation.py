@@ -0,0 +1,479 @@
+import logging
+import os
+import re
+import json
+import zlib
+import base64
+import codecs
+import itertools
+from datetime import datetime
+import azure.functions as func
+from BlobStorage import getContainerClient
+from Serialization import dumpJson, dumpJsonBytes, GZIP_BLOBS, GZIP_LEVEL
+from fhir_data_validation.schema_index import get_resource_class
+from fhir_data_validation.fhir_resource_validation import validate_individual_fhir_resource, repair_fhir_resource, get_blob_location
+from fhir_data_validation.validation_pool import validation_process_pool
+
+
+# Streaming validation settings, overridable through the app settings. Memory use is bounded by these sizes,
+# whatever the size of the bundle.
+STREAM_CHUNK_SIZE = int(os.environ.get("FHIR_STREAM_VALIDATION_CHUNK_SIZE", 1024 * 1024))
+STREAM_BLOCK_SIZE = int(os.environ.get("FHIR_STREAM_VALIDATION_BLOCK_SIZE", 4 * 1024 * 1024))
+STREAM_BATCH_SIZE = int(os.environ.get("FHIR_STREAM_VALIDATION_BATCH_SIZE", 500))
+MAX_ENTRY_CHARACTERS = int(os.environ.get("FHIR_STREAM_VALIDATION_MAX_ENTRY_CHARACTERS", 16 * 1024 * 1024))
+STREAM_HOLD_SIZE = int(os.environ.get("FHIR_STREAM_VALIDATION_HOLD_SIZE", STREAM_BLOCK_SIZE))        # Output held before the first change
+MAX_REPORTED_ERRORS = 100        # Only the first errors are returned, the summary counts all of them
+
+STREAM_INPUT_FORMATS = ("bundle", "ndjson")
+OUTPUT_CONTENT_TYPES = {"bundle": "application/fhir+json", "ndjson": "application/fhir+ndjson"}
+
+JSON_WHITESPACE = re.compile(r"[ \t\r\n]*")
+
+
+# Reader that parses a JSON document from a stream of text chunks one value at a time, so a bundle's entries can be
+# decoded one by one. The buffer holds the unread part of the current chunk and at most one value being decoded.
+class StreamingJsonReader:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ""
+        self._position = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    # Function to append the next chunk to the unread part of the buffer, returning False at the end of the stream
+    def _refill(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    # Function to get the next character that is not whitespace without consuming it ("" at the end of the stream)
+    def peek(self):
+        while True:
+            self._position = JSON_WHITESPACE.match(self._buffer, self._position).end()
+            if self._position < len(self._buffer) or not self._refill():
+                return self._buffer[self._position:self._position + 1]
+
+    # Function to consume the next character, which must be one of the expected ones
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Expected one of {characters!r} in the JSON stream, found {character or 'the end of the stream'!r}.")
+        self._position += 1
+        return character
+
+    # Function to decode the next JSON value, reading more chunks until it is complete
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                # A value ending with the buffer may continue in the next chunk (e.g. a number)
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            if len(self._buffer) - self._position > MAX_ENTRY_CHARACTERS:
+                raise ValueError(f"A JSON value in the stream is invalid or larger than {MAX_ENTRY_CHARACTERS} characters.")
+            self._refill()
+
+
+# Function to decode a stream of UTF-8 byte chunks into text chunks
+def decode_chunks(byte_chunks):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    for byte_chunk in byte_chunks:
+        text = decoder.decode(byte_chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+# Function to read a local file as text chunks
+def read_file_chunks(file_path, chunk_size=STREAM_CHUNK_SIZE):
+    with open(file_path, "r", encoding="utf-8-sig") as stream:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+# Function to iterate the entries of a streamed bundle. The other bundle fields are stored in bundle_fields as they are
+# read: the fields before "entry" are all known when the first entry is returned, the others once the iteration ends.
+def iter_bundle_entries(chunks, bundle_fields):
+    reader = StreamingJsonReader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.read_value()
+        if not isinstance(key, str):
+            raise ValueError("Invalid field name in the JSON stream.")
+        reader.expect(":")
+        if key == "entry":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                while True:
+                    yield reader.read_value()
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            bundle_fields[key] = reader.read_value()
+        if reader.expect(",}") == "}":
+            break
+    if reader.peek():
+        raise ValueError("Unexpected data after the end of the bundle.")
+
+
+# Function to iterate the resources of a streamed NDJSON file, one per line (unreadable lines are returned as None)
+def iter_ndjson_resources(chunks):
+    remainder = ""
+    for chunk in chunks:
+        lines = (remainder + chunk).split("\n")
+        remainder = lines.pop()
+        if len(remainder) > MAX_ENTRY_CHARACTERS:
+            raise ValueError(f"An NDJSON line is larger than {MAX_ENTRY_CHARACTERS} characters.")
+        for line in lines:
+            if line.strip():
+                yield decode_ndjson_line(line)
+    if remainder.strip():
+        yield decode_ndjson_line(remainder)
+
+
+def decode_ndjson_line(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+# Writer that uploads a blob as a series of staged blocks, so the output never has to be held in memory.
+# Nothing is visible in the container until the blocks are committed (uncommitted blocks are discarded by the service).
+class StagedBlobWriter:
+    def __init__(self, blob_name, content_type, block_size=STREAM_BLOCK_SIZE):
+        self.blob_name = blob_name
+        self.content_type = content_type
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._block_ids = []
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if GZIP_BLOBS else None        # wbits 31 is the gzip format
+        self._blob_client = getContainerClient().get_blob_client(blob_name)
+
+    def write(self, data):
+        self._buffer += self._compressor.compress(data) if self._compressor else data
+        if len(self._buffer) >= self.block_size:
+            self._stage_block()
+
+    def _stage_block(self):
+        block_id = base64.b64encode(f"{len(self._block_ids):08d}".encode("ascii")).decode("ascii")
+        self._blob_client.stage_block(block_id, bytes(self._buffer))
+        self._block_ids.append(block_id)
+        self._buffer = bytearray()
+
+    # Function to stage the remaining data and commit the blob, returning its URL
+    def commit(self):
+        from azure.storage.blob import BlobBlock, ContentSettings
+
+        if self._compressor:
+            self._buffer += self._compressor.flush()
+        if self._buffer or not self._block_ids:
+            self._stage_block()
+        self._blob_client.commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in self._block_ids],
+            content_settings=ContentSettings(content_type=self.content_type, content_encoding="gzip" if self._compressor else None)
+        )
+        return self._blob_client.url
+
+
+# Function to name the blob of the repaired output, like the validated bundles of the non-streaming validation
+def get_validated_blob_name(source_name, input_format):
+    base_filename = os.path.basename(source_name)
+    if input_format == "bundle" and base_filename.startswith("generated_fhir_bundle_"):
+        base_id = base_filename.replace("generated_fhir_bundle_", "").replace(".json", "")
+        return f"fhir_data_validation/validated_fhir_bundle_{base_id}.json"
+    stem = os.path.splitext(base_filename)[0] or "fhir_data"
+    extension = ".ndjson" if input_format == "ndjson" else ".json"
+    return f"fhir_data_validation/validated_{stem}_{datetime.now().strftime('%Y%m%d%H%M%S')}{extension}"
+
+
+# Function to pick the input format from the file or blob name when it is not given
+def get_input_format(source_name, input_format=None):
+    if input_format:
+        return input_format
+    return "ndjson" if source_name.lower().endswith((".ndjson", ".ndjson.gz")) else "bundle"
+
+
+# Validation of a streamed bundle or NDJSON file: resources are validated and repaired in batches as they are parsed,
+# and the repaired output is written to a blob as it goes. Only counts and the first errors are kept in memory.
+# The output is only committed if the input has errors, so nothing is uploaded until the first error: the (repaired)
+# output is held in memory up to STREAM_HOLD_SIZE, and past that rewritten from the source (reopen), with the repairs
+# applied again, if an error comes later. Without reopen, the output is staged from the start.
+class StreamingValidation:
+    def __init__(self, source_name, input_format, reopen=None):
+        self.source_name = source_name
+        self.input_format = input_format
+        self.summary = {"resources": 0, "valid": 0, "repaired": 0, "invalid": 0, "repair_rules": {}}
+        self.errors = []
+        self.validation_success = True
+        self.bundle_fields = {}
+        self._reopen = reopen
+        self._output_needed = reopen is None
+        self._held = bytearray()
+        self._written_fields = set()
+        self._entries_written = 0
+        self._writer = None
+
+    def _record_error(self, validation_result):
+        self.validation_success = False
+        self._output_needed = True
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(validation_result)
+
+    # Function to start staging the output blob, with the output written so far: the held output, or else the entries
+    # written so far read again from the source and repaired again (none of them was invalid)
+    def _start_output(self):
+        self._writer = StagedBlobWriter(get_validated_blob_name(self.source_name, self.input_format), OUTPUT_CONTENT_TYPES[self.input_format])
+        if self._held is not None:
+            self._writer.write(bytes(self._held))
+            self._held = None
+            return
+
+        logging.info(f"Reading {self.source_name} again to write the first {self._entries_written} entries of the validated output.")
+        entries_to_replay = self._entries_written
+        self._entries_written = 0
+        self._written_fields = set()
+        if self.input_format == "ndjson":
+            entries = (entry for entry in iter_ndjson_resources(self._reopen()) if entry is not None)
+        else:
+            entries = iter_bundle_entries(self._reopen(), {})
+        for entry in itertools.islice(entries, entries_to_replay):
+            self._write_entry(self._repair_entry(entry))
+
+    # Function to apply the repairs to an entry read again from the source, as its validation did the first time
+    def _repair_entry(self, entry):
+        resource_data = entry if self.input_format == "ndjson" else entry.get("resource")
+        repaired_resource_data, _ = repair_fhir_resource(resource_data.get("resourceType"), resource_data)
+        if repaired_resource_data is resource_data:
+            return entry
+        return repaired_resource_data if self.input_format == "ndjson" else {**entry, "resource": repaired_resource_data}
+
+    def _write(self, data):
+        if self._writer is None and self._output_needed:
+            self._start_output()
+        if self._writer is not None:
+            self._writer.write(data)
+        elif self._held is not None:
+            self._held += data
+            if len(self._held) > STREAM_HOLD_SIZE:
+                self._held = None        # Rewritten from the source if a change comes later
+
+    # Function to write the bundle fields read since the last call, as the start or end of the output bundle
+    def _write_bundle_fields(self):
+        for key, value in self.bundle_fields.items():
+            if key not in self._written_fields:
+                self._write(dumpJsonBytes(key, pretty=False) + b":" + dumpJsonBytes(value, pretty=False) + b",")
+                self._written_fields.add(key)
+
+    def _write_entry(self, entry):
+        if self.input_format == "ndjson":
+            self._write(dumpJsonBytes(entry, pretty=False) + b"\n")
+        elif self._entries_written == 0:
+            self._write(b"{")
+            self._write_bundle_fields()
+            self._write(b'"entry":[' + dumpJsonBytes(entry, pretty=False))
+        else:
+            self._write(b"," + dumpJsonBytes(entry, pretty=False))
+        self._entries_written += 1
+
+    # Function to validate a batch of entries (bundle entries, or resources for NDJSON) and write them in order
+    def _validate_batch(self, batch):
+        resources = [resource for _, resource in batch if resource]
+        if validation_process_pool.is_enabled_for(len(resources)):
+            outcomes = iter(validation_process_pool.validate_resources(resources))
+        else:
+            outcomes = (validate_individual_fhir_resource(resource_data.get("resourceType"), resource_data) for resource_data in resources)
+
+        for entry, resource_data in batch:
+            if not resource_data:
+                if entry is not None or self.input_format == "bundle":        # Unreadable NDJSON lines are dropped
+                    self._write_entry(entry)
+                continue
+            validation_result, validated_resource_data = next(outcomes)
+            self.summary["resources"] += 1
+            if validation_result["status"] == "error":
+                self.summary["invalid"] += 1
+                self._record_error(validation_result)
+            elif validation_result.get("repaired"):
+                self.summary["repaired"] += 1
+            else:
+                self.summary["valid"] += 1
+            for rule_name in validation_result.get("repair_rules", ()):
+                self.summary["repair_rules"][rule_name] = self.summary["repair_rules"].get(rule_name, 0) + 1
+            if validated_resource_data is not resource_data:
+                entry = validated_resource_data if self.input_format == "ndjson" else {**entry, "resource": validated_resource_data}
+            self._write_entry(entry)
+
+    # Function to take the resource of an entry, recording an error if it has none (entries without one are kept as is)
+    def _get_resource(self, index, entry):
+        if self.input_format == "ndjson":
+            resource_data = entry
+            if entry is None:
+                self._record_error({"status": "error", "message": f"Line {index + 1} is not valid JSON and was skipped."})
+                return None
+        else:
+            resource_data = entry.get("resource") if isinstance(entry, dict) else None
+        if isinstance(resource_data, dict) and "resourceType" in resource_data:
+            return resource_data
+        self._record_error({"status": "error", "message": f"Missing 'resourceType' in {'entry' if self.input_format == 'bundle' else 'line'} {index + 1}."})
+        return None
+
+    # Function to validate a bundle entry without its resource (resources are validated one by one)
+    def _validate_bundle_entry(self, index, entry):
+        from pydantic import ValidationError
+        from fhir.resources.bundle import BundleEntry
+
+        try:
+            BundleEntry(**{key: value for key, value in entry.items() if key != "resource"})
+        except ValidationError as e:
+            self._record_error({"status": "error", "message": f"Bundle entry {index + 1} validation failed: {str(e)}"})
+
+    # Function to validate the bundle fields, without the entries (validated one by one)
+    def _validate_bundle_fields(self):
+        from pydantic import ValidationError
+
+        try:
+            get_resource_class("Bundle")(**self.bundle_fields)
+        except ValidationError as e:
+            self.errors.insert(0, {"status": "error", "message": f"Bundle validation failed: {str(e)}"})
+            self.errors = self.errors[:MAX_REPORTED_ERRORS]
+            self.validation_success = False
+            self._output_needed = True
+
+    # Function to run the validation over the text chunks of the input
+    def run(self, chunks):
+        if self.input_format == "ndjson":
+            entries = iter_ndjson_resources(chunks)
+        else:
+            entries = iter_bundle_entries(chunks, self.bundle_fields)
+
+        batch = []
+        for index, entry in enumerate(entries):
+            if self.input_format == "bundle" and isinstance(entry, dict):
+                self._validate_bundle_entry(index, entry)
+            batch.append((entry, self._get_resource(index, entry)))
+            if len(batch) >= STREAM_BATCH_SIZE:
+                self._validate_batch(batch)
+                batch = []
+        self._validate_batch(batch)
+
+        if self.input_format == "bundle":
+            if self.bundle_fields.get("resourceType") != "Bundle":
+                raise ValueError("Streaming validation needs a FHIR Bundle or NDJSON input.")
+            if "type" not in self.bundle_fields:
+                # The original bundle is invalid without a type, so the repaired bundle is returned
+                self.bundle_fields["type"] = "collection"
+                self.validation_success = False
+                self._output_needed = True
+            self._validate_bundle_fields()
+
+            # Close the output bundle with the fields read after the entries
+            if self._writer is None and self._output_needed:
+                self._start_output()
+            remaining_fields = [
+                dumpJsonBytes(key, pretty=False) + b":" + dumpJsonBytes(value, pretty=False)
+                for key, value in self.bundle_fields.items() if key not in self._written_fields
+            ]
+            if self._entries_written:
+                self._write(b"]" + b"".join(b"," + field for field in remaining_fields) + b"}")
+            else:
+                self._write(b"{" + b",".join(remaining_fields) + b"}")
+
+    # Function to build the response, committing the repaired output if the input had errors
+    def get_response(self):
+        if self.validation_success:
+            return func.HttpResponse(
+                dumpJson({
+                    "status": "success",
+                    "message": "Validation of original bundle completed successfully.",
+                    "initial_validation": {
+                        "status": "success",
+                        "filePath": self.source_name,
+                        "message": "Original FHIR Bundle and resourceTypes are valid. No re-validation needed.",
+                        "summary": self.summary,
+                        "errors": self.errors
+                    }
+                }),
+                status_code=200,
+                mimetype="application/json"
+            )
+
+        if self._writer is None:
+            self._start_output()
+        blob_url = self._writer.commit()
+        logging.info(f"Streamed validated FHIR data to {self._writer.blob_name}.")
+        return func.HttpResponse(
+            dumpJson({
+                "status": "success",
+                "message": "Validation of original bundle and validated bundle completed successfully.",
+                "initial_validation": {
+                    "status": "error",
+                    "filePath": self.source_name,
+                    "message": "Initial FHIR Bundle contains errors. Generating validated bundle."
+                },
+                "re_validation": {
+                    "status": "success",
+                    "filePath": f"Validated FHIR bundle '{self._writer.blob_name}' available to download from Postman",
+                    "message": "FHIR Bundle and resourceTypes are valid after re-validation.",
+                    "blobUrl": blob_url,
+                    "summary": self.summary,
+                    "errors": self.errors
+                }
+            }),
+            status_code=200,
+            mimetype="application/json"
+        )
+
+
+# Function to validate a bundle or NDJSON file from text chunks with bounded memory. reopen, if given, returns the
+# chunks again from the start, so the output is only uploaded once the input turns out to need changes.
+def validate_fhir_stream(chunks, source_name, input_format=None, reopen=None):
+    input_format = get_input_format(source_name, input_format)
+    logging.info(f"Streaming validation of {source_name} as {input_format}.")
+    streaming_validation = StreamingValidation(source_name, input_format, reopen)
+    try:
+        streaming_validation.run(chunks)
+    except ValueError as e:
+        logging.error(f"Streaming validation of {source_name} failed: {e}")
+        return func.HttpResponse(
+            dumpJson({
+                "status": "error",
+                "message": f"FHIR data in {source_name} could not be read: {str(e)}"
+            }),
+            status_code=400,
+            mimetype="application/json"
+        )
+    return streaming_validation.get_response()
+
+
+# Function to validate a local bundle or NDJSON file without loading it in memory
+def validate_fhir_file_streaming(file_path, input_format=None):
+    return validate_fhir_stream(read_file_chunks(file_path), file_path, input_format, lambda: read_file_chunks(file_path))
+
+
+# Function to validate a bundle or NDJSON blob as it downloads, without loading it in memory
+def validate_fhir_blob_streaming(blob_name=None, blob_url=None, input_format=None):
+    container_name, blob_name = get_blob_location(blob_name, blob_url)
+    container_client = getContainerClient(container_name)
+
+    def read_blob_chunks():
+        return decode_chunks(container_client.download_blob(blob_name).chunks())
+    return validate_fhir_stream(read_blob_chunks(), blob_name, input_format, read_blob_chunks)
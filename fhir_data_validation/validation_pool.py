@@ -0,0 +1,90 @@
+import logging
+import os
+import math
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from fhir_data_validation.schema_index import schema_index
+from fhir_data_validation.fhir_resource_validation import validate_individual_fhir_resource
+
+
+# Parallel validation settings, overridable through the app settings. Below the minimum number of resources, the cost of
+# sending the resources to the processes is larger than the time saved (see benchmarks/validation_benchmark.py).
+DEFAULT_VALIDATION_PROCESSES = int(os.environ.get("FHIR_VALIDATION_PROCESSES", os.cpu_count() or 1))
+DEFAULT_PARALLEL_VALIDATION_MIN_RESOURCES = int(os.environ.get("FHIR_PARALLEL_VALIDATION_MIN_RESOURCES", 100))
+SHARDS_PER_PROCESS = 4        # More shards than processes, so a slow shard doesn't hold up the others
+
+
+# Function run once in each validation process when it starts, so no shard pays for importing the models
+def warm_up_validation_process():
+    logging.disable(logging.INFO)        # Per-resource validation logs are not forwarded from the processes
+    schema_index.warm_up()
+
+
+# Function to validate a shard of resources in a validation process. Returns the result of each resource and its
+# repaired version, or None if it was not repaired, so unchanged resources are not sent back.
+def validate_resource_shard(resources):
+    outcomes = []
+    for resource_data in resources:
+        validation_result, validated_resource_data = validate_individual_fhir_resource(resource_data.get("resourceType"), resource_data)
+        outcomes.append((validation_result, None if validated_resource_data is resource_data else validated_resource_data))
+    return outcomes
+
+
+# Pool of validation processes shared by all the requests handled by this worker. The processes are started on the
+# first large bundle (or by warm_up) and kept running, each with the schema index already built.
+class ValidationProcessPool:
+    def __init__(self, processes=DEFAULT_VALIDATION_PROCESSES, min_resources=DEFAULT_PARALLEL_VALIDATION_MIN_RESOURCES):
+        self.processes = processes
+        self.min_resources = min_resources
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # Function to tell whether a number of resources is worth validating in parallel
+    def is_enabled_for(self, resource_count):
+        return self.processes > 1 and resource_count >= self.min_resources
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked, as forking the threaded function host is not safe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=warm_up_validation_process
+                )
+                logging.info(f"Started {self.processes} validation processes.")
+            return self._executor
+
+    # Function to validate resources across the processes, returning (validation result, repaired resource) in their order
+    def validate_resources(self, resources):
+        shard_size = max(1, math.ceil(len(resources) / (self.processes * SHARDS_PER_PROCESS)))
+        shards = [resources[index:index + shard_size] for index in range(0, len(resources), shard_size)]
+        try:
+            shard_outcomes = list(self._get_executor().map(validate_resource_shard, shards))
+        except Exception as e:
+            # A broken pool (e.g. a killed process) is replaced on the next call, and this bundle is validated serially
+            logging.error(f"Parallel validation failed, validating serially: {e}")
+            self.shutdown()
+            return [validate_individual_fhir_resource(resource_data.get("resourceType"), resource_data) for resource_data in resources]
+
+        return [
+            (validation_result, resource_data if validated_resource_data is None else validated_resource_data)
+            for resource_data, (validation_result, validated_resource_data) in zip(resources, (outcome for outcomes in shard_outcomes for outcome in outcomes))
+        ]
+
+    # Function to start the processes up front, so the first large bundle doesn't wait for them
+    def warm_up(self):
+        if self.processes > 1:
+            list(self._get_executor().map(validate_resource_shard, [[] for _ in range(self.processes)]))
+
+    def shutdown(self):
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Process pool shared by all the requests handled by this worker
+validation_process_pool = ValidationProcessPool()
@@ -1,9 +1,25 @@
 import logging
 import json
 import os
+import time
+import threading
 import azure.functions as func
-from fhir_data_generation.fhir_resource_generation import fhir_resource_generation_blueprint, generate_fhir_bundle
-from fhir_data_validation.fhir_resource_validation import fhir_resource_validation_blueprint, validate_fhir_data
+from fhir_data_generation.fhir_resource_generation import fhir_resource_generation_blueprint, generate_fhir_bundle, generate_fhir_bundle_batch
+from fhir_data_validation.fhir_resource_validation import fhir_resource_validation_blueprint, validate_fhir_data, validate_fhir_bundle, load_fhir_data_from_blob, validate_fhir_data_from_blob_prefixes
+from fhir_data_generation.generation_jobs import generation_job_runner
+from fhir_data_generation.generation_stream import stream_fhir_bundle, NDJSON_MEDIA_TYPE
+from fhir_data_validation.schema_index import schema_index
+from fhir_data_validation.validation_pool import validation_process_pool
+from fhir_data_validation.streaming_validation import validate_fhir_file_streaming, validate_fhir_blob_streaming, STREAM_INPUT_FORMATS
+from Serialization import dumpJson, compressResponse
+from OpenAI import getClient
+from BlobStorage import getContainerClient
+
+# HTTP streaming needs the FastAPI extension (azurefunctions-extensions-http-fastapi, with azure-functions 1.20 or later)
+try:
+    from azurefunctions.extensions.http.fastapi import Request, StreamingResponse
+except ImportError:
+    StreamingResponse = None
 
 
 app = func.FunctionApp()
@@ -11,6 +27,36 @@ app.register_blueprint(fhir_resource_generation_blueprint)
 app.register_blueprint(fhir_resource_validation_blueprint)
 
 
+# Function to do up front what the first requests of a new worker would otherwise pay for: build the FHIR schema index,
+# start the validation processes and create the OpenAI and Blob Storage clients (importing their SDKs)
+def warm_up_worker():
+    start_time = time.perf_counter()
+    warm_up_steps = (
+        ("FHIR schema index", schema_index.warm_up),
+        ("validation processes", validation_process_pool.warm_up),
+        ("OpenAI client", getClient),
+        ("Blob Storage client", getContainerClient)
+    )
+    for name, warm_up_step in warm_up_steps:
+        try:
+            warm_up_step()
+        except Exception as e:
+            logging.warning(f"Warm-up of the {name} failed: {e}")
+    logging.info(f"Worker warmed up in {time.perf_counter() - start_time:.3f} seconds.")
+
+
+# Warm up in the background at startup if configured, without delaying the indexing of the functions
+if os.environ.get("FHIR_WARM_UP_ON_STARTUP", "false").lower() == "true":
+    threading.Thread(target=warm_up_worker, name="fhir-warm-up", daemon=True).start()
+
+
+# Warm up each instance added on scale-out (the warmup trigger only runs on the Premium and Dedicated plans)
+@app.function_name(name="WarmUp")
+@app.warm_up_trigger("warmup")
+def warm_up(warmup) -> None:
+    warm_up_worker()
+
+
 @app.function_name(name="FHIRResourceGenerationAPI")  
 @app.route(route="FHIRResourceGenerationAPI", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)  
 def fhir_resource_generation(req: func.HttpRequest) -> func.HttpResponse:  
@@ -20,7 +66,24 @@ def fhir_resource_generation(req: func.HttpRequest) -> func.HttpResponse:
         # Parse user-provided parameters
         user_parameters = req.get_json()
 
-        return generate_fhir_bundle(user_parameters)
+        # Queue the generation and return a job ID straight away if requested
+        if user_parameters.get("async_job", False):
+            job_id = generation_job_runner.submit(user_parameters)
+            return func.HttpResponse(
+                dumpJson({
+                    "job_id": job_id,
+                    "status": "queued",
+                    "statusUrl": f"/api/FHIRGenerationJobAPI/{job_id}"
+                }),
+                status_code=202,
+                mimetype="application/json"
+            )
+
+        # Generate multiple patient bundles in a single invocation if requested
+        if "patient_count" in user_parameters or "patients" in user_parameters:
+            return compressResponse(req, generate_fhir_bundle_batch(user_parameters))
+
+        return compressResponse(req, generate_fhir_bundle(user_parameters))
     except ValueError as e:  
         logging.error(f"Error parsing user parameters: {e}")  
         return func.HttpResponse(  
@@ -33,6 +96,73 @@ def fhir_resource_generation(req: func.HttpRequest) -> func.HttpResponse:
             "An unexpected error occurred while processing the request.",  
             status_code=500  
         )
+
+
+
+# Streaming variant of FHIRResourceGenerationAPI: one NDJSON line per entry as soon as it is generated, then the blob URL
+if StreamingResponse is not None:
+    @app.function_name(name="FHIRResourceGenerationStreamAPI")
+    @app.route(route="FHIRResourceGenerationStreamAPI", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+    async def fhir_resource_generation_stream(req: Request) -> StreamingResponse:
+        logging.info('Processing request to stream a generated FHIR bundle.')
+        try:
+            user_parameters = await req.json()
+        except ValueError as e:
+            logging.error(f"Error parsing user parameters: {e}")
+            return StreamingResponse(iter([b"Invalid JSON data provided in the request body."]), status_code=400)
+        return StreamingResponse(stream_fhir_bundle(user_parameters), media_type=NDJSON_MEDIA_TYPE)
+else:
+    # Without the extension the same lines are returned in a single buffered response
+    @app.function_name(name="FHIRResourceGenerationStreamAPI")
+    @app.route(route="FHIRResourceGenerationStreamAPI", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+    def fhir_resource_generation_stream(req: func.HttpRequest) -> func.HttpResponse:
+        logging.info('Processing request to generate a FHIR bundle as NDJSON (buffered, HTTP streaming is not available).')
+        try:
+            user_parameters = req.get_json()
+        except ValueError as e:
+            logging.error(f"Error parsing user parameters: {e}")
+            return func.HttpResponse(
+                "Invalid JSON data provided in the request body.",
+                status_code=400
+            )
+        return compressResponse(req, func.HttpResponse(
+            b"".join(stream_fhir_bundle(user_parameters)),
+            status_code=200,
+            mimetype=NDJSON_MEDIA_TYPE
+        ))
+
+
+@app.function_name(name="FHIRGenerationJobAPI")
+@app.route(route="FHIRGenerationJobAPI/{job_id}", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def fhir_generation_job(req: func.HttpRequest) -> func.HttpResponse:
+    job_id = req.route_params.get("job_id")
+    logging.info(f"Processing request for the status of generation job {job_id}.")
+
+    try:
+        job = generation_job_runner.get_job(job_id)
+        if job is None:
+            return func.HttpResponse(
+                json.dumps({
+                    "status": "error",
+                    "message": f"Generation job {job_id} not found."
+                }),
+                status_code=404,
+                mimetype="application/json"
+            )
+
+        # Report the status, the progress of each resource type and, once finished, the generation response
+        job.pop("parameters", None)
+        return compressResponse(req, func.HttpResponse(
+            dumpJson(job),
+            status_code=200,
+            mimetype="application/json"
+        ))
+    except Exception as e:
+        logging.error(f"Exception during generation job status request: {e}")
+        return func.HttpResponse(
+            "An unexpected error occurred while processing the request.",
+            status_code=500
+        )
     
 
 @app.function_name(name="FHIRBundleValidationAPI")  
@@ -55,6 +185,74 @@ def fhir_resource_validation(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json"  
             )
         
+        # Validate an inline bundle sent in the request body
+        bundle = req_body.get('bundle')
+        if bundle is not None:
+            if not isinstance(bundle, dict):
+                logging.error("bundle parameter is not a JSON object.")
+                return func.HttpResponse(
+                    json.dumps({
+                        "status": "error",
+                        "message": "bundle parameter must be a JSON object."
+                    }),
+                    status_code=400,
+                    mimetype="application/json"
+                )
+            return compressResponse(req, validate_fhir_bundle(bundle))
+
+        # Large bundles and NDJSON files can be validated as a stream, without loading them in memory
+        streaming = bool(req_body.get('streaming', False))
+        input_format = req_body.get('input_format')
+        if input_format is not None and input_format not in STREAM_INPUT_FORMATS:
+            logging.error("Invalid input_format provided.")
+            return func.HttpResponse(
+                json.dumps({
+                    "status": "error",
+                    "message": f"input_format must be one of: {', '.join(STREAM_INPUT_FORMATS)}."
+                }),
+                status_code=400,
+                mimetype="application/json"
+            )
+
+        # Validate a bundle stored in Azure Blob Storage, by blob name or URL
+        blob_name = req_body.get('blob_name')
+        blob_url = req_body.get('blob_url')
+        if blob_name or blob_url:
+            from azure.core.exceptions import ResourceNotFoundError
+
+            try:
+                if streaming:
+                    return compressResponse(req, validate_fhir_blob_streaming(blob_name, blob_url, input_format))
+                fhir_resource, blob_name = load_fhir_data_from_blob(blob_name, blob_url)
+            except ResourceNotFoundError:
+                logging.error("Provided FHIR bundle blob does not exist.")
+                return func.HttpResponse(
+                    json.dumps({
+                        "status": "error",
+                        "message": "Provided FHIR bundle blob does not exist."
+                    }),
+                    status_code=404,
+                    mimetype="application/json"
+                )
+            return compressResponse(req, validate_fhir_bundle(fhir_resource, blob_name))
+
+        # Validate every bundle stored under the given blob prefixes
+        blob_prefixes = req_body.get('blob_prefixes')
+        if blob_prefixes:
+            if isinstance(blob_prefixes, str):
+                blob_prefixes = [blob_prefixes]
+            if not isinstance(blob_prefixes, list) or not all(isinstance(blob_prefix, str) for blob_prefix in blob_prefixes):
+                logging.error("blob_prefixes parameter is not a list of strings.")
+                return func.HttpResponse(
+                    json.dumps({
+                        "status": "error",
+                        "message": "blob_prefixes parameter must be a list of strings."
+                    }),
+                    status_code=400,
+                    mimetype="application/json"
+                )
+            return compressResponse(req, validate_fhir_data_from_blob_prefixes(blob_prefixes))
+
         # Extract the filename from the request body
         file_path = req_body.get('file_path')  
 
@@ -64,7 +262,7 @@ def fhir_resource_validation(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse(  
                 json.dumps({
                     "status": "error", 
-                    "message": "file_path parameter cannot be empty."
+                    "message": "One of file_path, blob_name, blob_url, bundle or blob_prefixes is required."
                 }),  
                 status_code=400,  
                 mimetype="application/json"  
@@ -83,7 +281,9 @@ def fhir_resource_validation(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         # Call the validate_fhir_data function to validate the FHIR data
-        return validate_fhir_data(file_path)
+        if streaming:
+            return compressResponse(req, validate_fhir_file_streaming(file_path, input_format))
+        return compressResponse(req, validate_fhir_data(file_path))
     except Exception as e:  
         logging.error(f"Exception during validation request: {e}")  
         return func.HttpResponse(  
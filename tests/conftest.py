@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# The function app modules are imported from the repository root, as the Functions host does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
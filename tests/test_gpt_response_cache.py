@@ -0,0 +1,28 @@
+from fhir_data_generation.gpt_response_cache import GptResponseCache
+
+
+def make_key(**options):
+    return GptResponseCache.make_key("gpt", "Generate a Patient", 0.7, **options)
+
+
+def test_calls_with_different_budgets_do_not_share_an_entry():
+    assert make_key(max_tokens=300) != make_key(max_tokens=4096)
+    assert make_key(max_tokens=300) != make_key(resource_type="Patient")
+    assert make_key(max_tokens=300, resource_type="Patient") != make_key(resource_type="Patient")
+
+
+def test_resource_type_and_seed_are_part_of_the_key():
+    assert make_key(resource_type="Patient") != make_key(resource_type="Condition")
+    assert make_key(resource_type="Patient", seed=1) != make_key(resource_type="Patient", seed=2)
+    assert make_key(max_tokens=300, resource_type="Patient", seed=1) == make_key(seed=1, resource_type="Patient", max_tokens=300)
+
+
+def test_entries_are_served_from_both_tiers(tmp_path):
+    key = make_key(max_tokens=300)
+    GptResponseCache(cache_dir=str(tmp_path)).set(key, '{"resourceType": "Patient"}')
+
+    cache = GptResponseCache(cache_dir=str(tmp_path))
+    assert cache.get(key) == '{"resourceType": "Patient"}'
+    assert cache.get(key) == '{"resourceType": "Patient"}'
+    assert cache.get(make_key(max_tokens=4096)) is None
+    assert (cache.stats["disk_hits"], cache.stats["memory_hits"], cache.stats["misses"]) == (1, 1, 1)
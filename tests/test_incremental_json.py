@@ -0,0 +1,83 @@
+import json
+import pytest
+from fhir_data_generation.incremental_json import IncrementalJsonObjectScanner, JsonStructureError, MAX_PREAMBLE_CHARACTERS
+
+
+# Function to feed a text to a new scanner in chunks of the given size, returning the scanner
+def scan(text, chunk_size):
+    scanner = IncrementalJsonObjectScanner()
+    for index in range(0, len(text), chunk_size):
+        if scanner.feed(text[index:index + chunk_size]):
+            break
+    return scanner
+
+
+RESOURCE = {
+    "resourceType": "Observation",
+    "status": "final",
+    "note": [{"text": "Braces } ] { [ and quotes \" inside a string, a backslash \\ and an escaped \\\" quote"}],
+    "valueQuantity": {"value": -1.5e3, "unit": "mg"},
+    "component": [],
+    "issued": "2024-01-01T10:00:00+00:00"
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1000])
+def test_escaped_characters_do_not_end_strings(chunk_size):
+    scanner = scan(json.dumps(RESOURCE), chunk_size)
+
+    assert scanner.complete
+    assert scanner.parse() == RESOURCE
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1000])
+def test_preamble_and_trailing_text_are_dropped(chunk_size):
+    text = "Here is the resource:\n```json\n" + json.dumps(RESOURCE, indent=2) + "\n```\nLet me know if you need more."
+    scanner = scan(text, chunk_size)
+
+    assert scanner.complete
+    assert scanner.text.startswith("{") and scanner.text.endswith("}")
+    assert scanner.parse() == RESOURCE
+
+
+def test_feed_after_completion_is_ignored():
+    scanner = IncrementalJsonObjectScanner()
+
+    assert scanner.feed('{"a": 1} {')
+    assert scanner.feed("not json at all ]")
+    assert scanner.parse() == {"a": 1}
+
+
+def test_preamble_without_object_aborts():
+    scanner = IncrementalJsonObjectScanner()
+    scanner.feed("x" * MAX_PREAMBLE_CHARACTERS)
+
+    with pytest.raises(JsonStructureError):
+        scanner.feed("x")
+
+
+@pytest.mark.parametrize("text", [
+    '{"a": [1, 2}',
+    '{"a": 1]]',
+    '{"a": <unknown>}',
+    '{"a": 1, b: 2}'
+])
+def test_structural_errors_abort_the_stream(text):
+    with pytest.raises(JsonStructureError):
+        scan(text, 1)
+
+
+def test_structural_error_is_raised_before_the_end_of_the_stream():
+    scanner = IncrementalJsonObjectScanner()
+    scanner.feed('{"resourceType": "Patient", ')
+
+    with pytest.raises(JsonStructureError):
+        scanner.feed("name: ")
+
+
+def test_incomplete_object_cannot_be_parsed():
+    scanner = scan('{"a": {"b": 1}', 4)
+
+    assert not scanner.complete
+    with pytest.raises(JsonStructureError):
+        scanner.parse()
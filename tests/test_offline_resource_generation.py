@@ -0,0 +1,78 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import pytest
+import fhir_data_generation.offline_resource_generation as offline_resource_generation
+import fhir_data_generation.fhir_resource_generation as fhir_resource_generation
+from fhir_data_generation.offline_resource_generation import create_offline_rng, shared_rng, validate_offline_config
+
+
+# Clock of the offline engine frozen, since its dates are spread back from now
+class FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def frozen_clock(monkeypatch):
+    monkeypatch.setattr(offline_resource_generation, "datetime", FrozenDatetime)
+
+
+RESOURCES = [
+    ("Patient", None), ("Condition", None), ("Encounter", None), ("Appointment", None),
+    ("Observation", "heart_rate"), ("Observation", "blood_pressure"), ("Observation", "laboratory"),
+    ("ServiceRequest", None), ("MedicationRequest", None), ("AllergyIntolerance", None)
+]
+
+
+# Function to generate the resources of a bundle with the offline engine in the given order, on several threads
+def generate_bundle_resources(user_parameters, resources):
+    token = fhir_resource_generation.generation_context.set(fhir_resource_generation.create_generation_context(user_parameters))
+    try:
+        def generate(resource):
+            resource_type, observation_type = resource
+            return resource, json.loads(fhir_resource_generation.generate_resource_without_llm(resource_type, "offline", "p1", None, observation_type))
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [fhir_resource_generation.submit_with_context(executor, generate, resource) for resource in resources]
+            return dict(future.result() for future in futures)
+    finally:
+        fhir_resource_generation.generation_context.reset(token)
+
+
+def test_seeded_output_does_not_depend_on_the_generation_order():
+    user_parameters = {"offline_config": {"seed": 7}, "bundle_id": "b1"}
+
+    in_order = generate_bundle_resources(user_parameters, RESOURCES)
+    reversed_order = generate_bundle_resources(user_parameters, list(reversed(RESOURCES)))
+
+    assert in_order == reversed_order
+
+
+def test_bundles_with_the_same_seed_differ_by_bundle_id():
+    first = generate_bundle_resources({"offline_config": {"seed": 7}, "bundle_id": "b1"}, RESOURCES)
+    second = generate_bundle_resources({"offline_config": {"seed": 7}, "bundle_id": "b2"}, RESOURCES)
+
+    assert first[("Condition", None)] != second[("Condition", None)]
+
+
+def test_each_resource_gets_its_own_generator():
+    offline_config = {"seed": 7}
+
+    assert create_offline_rng(offline_config, "b1:Condition").random() == create_offline_rng(offline_config, "b1:Condition").random()
+    assert create_offline_rng(offline_config, "b1:Condition").random() != create_offline_rng(offline_config, "b1:Encounter").random()
+    assert create_offline_rng(None, "b1:Condition") is shared_rng
+
+
+@pytest.mark.parametrize("offline_config", [
+    {"gender_weights": {"man": 1}},
+    {"gender_weights": {"male": -1, "female": 2}},
+    {"gender_weights": {"male": 0}},
+    {"age_range": [50, 20]},
+    {"history_days": -1},
+    {"seed": 1.5},
+    []
+])
+def test_invalid_offline_configs_are_rejected(offline_config):
+    with pytest.raises(ValueError):
+        validate_offline_config(offline_config)
@@ -0,0 +1,210 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+import OpenAI
+from OpenAI import RateLimiter, getRetryAfter
+
+
+# Clock standing in for the time module of OpenAI.py: sleeping moves the clock forward instead of blocking
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(OpenAI, "time", fake_clock)
+    return fake_clock
+
+
+def test_requests_per_minute(clock):
+    limiter = RateLimiter(requests_per_minute=2)
+
+    limiter.acquire(0)
+    limiter.acquire(0)
+    assert clock.sleeps == []
+
+    limiter.acquire(0)
+    assert sum(clock.sleeps) == pytest.approx(30)
+
+
+def test_tokens_per_minute(clock):
+    limiter = RateLimiter(tokens_per_minute=600)
+
+    limiter.acquire(400)
+    assert clock.sleeps == []
+
+    # 200 tokens are left, the 200 missing ones are refilled at 10 per second
+    limiter.acquire(400)
+    assert sum(clock.sleeps) == pytest.approx(20)
+
+
+def test_call_larger_than_the_quota_waits_for_a_full_bucket(clock):
+    limiter = RateLimiter(tokens_per_minute=600)
+    limiter.acquire(300)
+
+    limiter.acquire(5000)
+    assert sum(clock.sleeps) == pytest.approx(30)
+
+
+def test_the_slowest_quota_sets_the_wait(clock):
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=600)
+    limiter.acquire(600)
+
+    limiter.acquire(60)
+    assert sum(clock.sleeps) == pytest.approx(6)
+
+
+def test_buckets_refill_up_to_the_quota(clock):
+    limiter = RateLimiter(requests_per_minute=1, tokens_per_minute=100)
+    clock.now += 3600
+
+    limiter.acquire(100)
+    assert clock.sleeps == []
+    limiter.acquire(100)
+    assert sum(clock.sleeps) == pytest.approx(60)
+
+
+def test_reconcile_gives_back_unused_tokens(clock):
+    limiter = RateLimiter(tokens_per_minute=600)
+    limiter.acquire(600)
+
+    limiter.reconcile(600, 200)
+    limiter.acquire(400)
+    assert clock.sleeps == []
+
+
+def test_reconcile_takes_extra_tokens(clock):
+    limiter = RateLimiter(tokens_per_minute=600)
+    limiter.acquire(100)
+
+    limiter.reconcile(100, 400)
+    limiter.acquire(300)
+    assert sum(clock.sleeps) == pytest.approx(10)
+
+
+def test_no_limits_never_wait(clock):
+    limiter = RateLimiter()
+
+    for _ in range(100):
+        limiter.acquire(100000)
+    limiter.reconcile(100000, 0)
+    assert clock.sleeps == []
+
+
+def test_pause_holds_back_every_caller(clock):
+    limiter = RateLimiter()
+    limiter.pause(5)
+    limiter.pause(2)
+
+    limiter.acquire(0)
+    assert sum(clock.sleeps) == pytest.approx(5)
+    limiter.acquire(0)
+    assert sum(clock.sleeps) == pytest.approx(5)
+
+
+def test_acquire_async_waits_without_blocking(clock, monkeypatch):
+    async def sleep(seconds):
+        clock.sleep(seconds)
+    monkeypatch.setattr(OpenAI, "asyncio", SimpleNamespace(sleep=sleep))
+    limiter = RateLimiter(requests_per_minute=1)
+
+    asyncio.run(limiter.acquire_async(0))
+    asyncio.run(limiter.acquire_async(0))
+    assert sum(clock.sleeps) == pytest.approx(60)
+
+
+# Function to build the error the SDK raises for a throttled call, with only the response headers that are read
+def make_rate_limit_error(headers):
+    from openai import RateLimitError
+    response = SimpleNamespace(status_code=429, headers=headers, request=None)
+    return RateLimitError("Too many requests", response=response, body=None)
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500", "retry-after": "9"}, 1.5),
+    ({"retry-after": "7"}, 7.0)
+])
+def test_retry_after_headers(headers, expected):
+    assert getRetryAfter(make_rate_limit_error(headers), 0) == expected
+
+
+def test_retry_after_falls_back_to_backoff():
+    assert 8 <= getRetryAfter(make_rate_limit_error({"retry-after": "soon"}), 3) <= 9
+    assert 1 <= getRetryAfter(make_rate_limit_error({}), 0) <= 2
+
+
+# Client whose calls raise the given errors before returning a response
+class FakeClient:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=self)
+
+    def with_options(self, **options):
+        return self
+
+    def create(self, **options):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "response"
+
+
+GPT_OPTIONS = {"engine": "gpt", "messages": [{"role": "user", "content": "Hi"}], "temperature": 0, "max_tokens": 100}
+
+
+def test_throttled_calls_pause_the_limiter_and_retry(clock, monkeypatch):
+    client = FakeClient([make_rate_limit_error({"retry-after": "3"}), make_rate_limit_error({"retry-after-ms": "500"})])
+    monkeypatch.setattr(OpenAI, "getClient", lambda: client)
+    monkeypatch.setattr(OpenAI, "rate_limiter", RateLimiter())
+
+    assert OpenAI.createChatCompletion(GPT_OPTIONS, 100) == "response"
+    assert client.calls == 3
+    assert clock.sleeps == pytest.approx([3, 0.5])
+
+
+def test_throttled_calls_give_up_after_the_retries(clock, monkeypatch):
+    from openai import RateLimitError
+    client = FakeClient([make_rate_limit_error({"retry-after": "1"}) for _ in range(OpenAI.MAX_RETRIES + 1)])
+    monkeypatch.setattr(OpenAI, "getClient", lambda: client)
+    monkeypatch.setattr(OpenAI, "rate_limiter", RateLimiter())
+
+    with pytest.raises(RateLimitError):
+        OpenAI.createChatCompletion(GPT_OPTIONS, 100)
+    assert client.calls == OpenAI.MAX_RETRIES + 1
+
+
+def test_retries_do_not_take_the_estimate_again(clock, monkeypatch):
+    client = FakeClient([make_rate_limit_error({"retry-after": "1"}) for _ in range(3)])
+    limiter = RateLimiter(tokens_per_minute=600)
+    monkeypatch.setattr(OpenAI, "getClient", lambda: client)
+    monkeypatch.setattr(OpenAI, "rate_limiter", limiter)
+
+    assert OpenAI.createChatCompletion(GPT_OPTIONS, 500) == "response"
+    # Only the call that succeeded holds a reservation, so another 100 tokens fit right away
+    clock.sleeps.clear()
+    limiter.acquire(100)
+    assert clock.sleeps == []
+
+
+def test_failed_calls_give_back_their_reservation(clock, monkeypatch):
+    client = FakeClient([ValueError("Bad request")])
+    limiter = RateLimiter(tokens_per_minute=600)
+    monkeypatch.setattr(OpenAI, "getClient", lambda: client)
+    monkeypatch.setattr(OpenAI, "rate_limiter", limiter)
+
+    with pytest.raises(ValueError):
+        OpenAI.createChatCompletion(GPT_OPTIONS, 600)
+    limiter.acquire(600)
+    assert clock.sleeps == []
+    assert client.calls == 1
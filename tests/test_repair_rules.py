@@ -0,0 +1,210 @@
+import copy
+import json
+import random
+from datetime import datetime
+import pytest
+import pytz
+from fhir_data_generation.offline_resource_generation import generate_offline_resource
+from fhir_data_validation.fhir_resource_validation import validate_individual_fhir_resource
+from fhir_data_validation.repair_rules import RepairRuleSet, ensure_timezone_aware, repair_rule_set
+
+
+# The repairs validate_individual_fhir_resource made in place before they were declared as rules, kept as the reference
+# the rules must reproduce (on a copy, so the test inputs are not modified)
+def pre_series_repair(resource_type, resource_data):
+    resource_data = copy.deepcopy(resource_data)
+
+    def aware(dt_str):
+        try:
+            dt = datetime.fromisoformat(dt_str)
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=pytz.UTC)
+            return dt.isoformat()
+        except ValueError:
+            return dt_str
+
+    if resource_type == "Encounter":
+        if 'class' in resource_data and not isinstance(resource_data['class'], list):
+            resource_data['class'] = [resource_data['class']]
+        for field in ('period', 'participant', 'diagnosis'):
+            resource_data.pop(field, None)
+
+    if resource_type == "Appointment":
+        if 'patientInstruction' in resource_data and not isinstance(resource_data['patientInstruction'], list):
+            resource_data['patientInstruction'] = [resource_data['patientInstruction']]
+        if 'patientInstruction' in resource_data:
+            for i, instruction in enumerate(resource_data['patientInstruction']):
+                try:
+                    json.loads(instruction)
+                except json.JSONDecodeError:
+                    del resource_data['patientInstruction'][i]
+        resource_data.pop('comment', None)
+
+    if resource_type == "ServiceRequest":
+        if 'occurrenceDateTime' in resource_data:
+            resource_data['occurrenceDateTime'] = aware(resource_data['occurrenceDateTime'])
+        if 'occurrenceTiming' in resource_data:
+            if 'event' in resource_data['occurrenceTiming']:
+                resource_data['occurrenceTiming']['event'] = [
+                    aware(event['effectiveDateTime']) if isinstance(event, dict) and 'effectiveDateTime' in event else event
+                    for event in resource_data['occurrenceTiming']['event']
+                ]
+            if 'repeat' in resource_data['occurrenceTiming'] and 'boundsPeriod' in resource_data['occurrenceTiming']['repeat']:
+                bounds_period = resource_data['occurrenceTiming']['repeat']['boundsPeriod']
+                for field in ('start', 'end'):
+                    if field in bounds_period:
+                        bounds_period[field] = aware(bounds_period[field])
+        resource_data.pop('code', None)
+
+    if resource_type == "MedicationRequest":
+        if "dispenseRequest" in resource_data and "validityPeriod" in resource_data["dispenseRequest"]:
+            if "start" in resource_data["dispenseRequest"]["validityPeriod"]:
+                resource_data["dispenseRequest"]["validityPeriod"]["start"] = aware(resource_data["dispenseRequest"]["validityPeriod"]["start"])
+        if "medication" not in resource_data and 'medicationCodeableConcept' in resource_data:
+            resource_data["medication"] = {"concept": resource_data.pop("medicationCodeableConcept")}
+
+    if resource_type == "AllergyIntolerance":
+        for note in resource_data.get("note", []):
+            if "time" in note:
+                note["time"] = aware(note["time"])
+        resource_data.pop("reaction", None)
+        resource_data.pop("type", None)
+
+    for field in ("effectiveDateTime", "authoredOn", "recordedDate", "onsetDateTime", "issued"):
+        if field in resource_data:
+            resource_data[field] = aware(resource_data[field])
+    return resource_data
+
+
+# Generated resources with the issues the repairs were written for. Their dateTime values are naive and at the
+# elements the old repairs listed, where the old and new repairs agree (the rules also cover every other dateTime
+# element, keep date-only and timezone-aware values as they are, unwrap timing events that were plain strings, and
+# keep a ServiceRequest.code that is already an R5 CodeableReference).
+RESOURCES = [
+    ("Patient", {"resourceType": "Patient", "id": "p1", "gender": "female", "birthDate": "1980-01-01"}),
+    ("Encounter", {
+        "resourceType": "Encounter", "id": "e1", "status": "completed",
+        "class": {"coding": [{"code": "AMB"}]},
+        "period": {"start": "2021-01-01T10:00:00"},
+        "participant": [{"type": [{"text": "doctor"}]}],
+        "diagnosis": [{"condition": [{"reference": "Condition/c1"}]}],
+        "subject": {"reference": "Patient/p1"}
+    }),
+    ("Appointment", {
+        "resourceType": "Appointment", "id": "a1", "status": "booked",
+        "patientInstruction": "Take the medication with water",
+        "comment": "Bring previous results"
+    }),
+    ("ServiceRequest", {
+        "resourceType": "ServiceRequest", "id": "s1", "status": "active", "intent": "order",
+        "code": {"text": "X-ray"},
+        "authoredOn": "2021-01-01T09:30:00",
+        "occurrenceTiming": {
+            "event": [{"effectiveDateTime": "2021-02-01T09:00:00"}, {"effectiveDateTime": "2021-03-01T09:00:00"}],
+            "repeat": {"boundsPeriod": {"start": "2021-02-01T00:00:00", "end": "2021-06-01T00:00:00"}, "frequency": 1}
+        },
+        "subject": {"reference": "Patient/p1"}
+    }),
+    ("MedicationRequest", {
+        "resourceType": "MedicationRequest", "id": "m1", "status": "active", "intent": "order",
+        "medicationCodeableConcept": {"coding": [{"code": "1191"}], "text": "Aspirin"},
+        "authoredOn": "2021-01-01T09:30:00",
+        "dispenseRequest": {"validityPeriod": {"start": "2021-01-01T00:00:00"}, "numberOfRepeatsAllowed": 2}
+    }),
+    ("AllergyIntolerance", {
+        "resourceType": "AllergyIntolerance", "id": "ai1",
+        "type": "allergy",
+        "reaction": [{"manifestation": [{"text": "Rash"}]}],
+        "recordedDate": "2020-05-01T08:00:00",
+        "onsetDateTime": "2019-05-01T08:00:00",
+        "note": [{"text": "Mild", "time": "2020-05-01T08:15:00"}]
+    }),
+    ("Condition", {
+        "resourceType": "Condition", "id": "c1",
+        "onsetDateTime": "2021-01-01T10:00:00", "recordedDate": "2021-01-02T11:00:00",
+        "code": {"text": "Hypertension"}
+    }),
+    ("Observation", {
+        "resourceType": "Observation", "id": "o1", "status": "final", "code": {"text": "Weight"},
+        "effectiveDateTime": "2021-01-01T10:00:00", "issued": "2021-01-01T12:00:00",
+        "valueQuantity": {"value": 70, "unit": "kg"}
+    })
+]
+
+
+@pytest.mark.parametrize("resource_type, resource_data", RESOURCES, ids=[resource_type for resource_type, _ in RESOURCES])
+def test_rules_match_the_pre_series_repairs(resource_type, resource_data):
+    snapshot = copy.deepcopy(resource_data)
+
+    repaired, repairs = repair_rule_set.apply(resource_type, resource_data)
+
+    assert repaired == pre_series_repair(resource_type, snapshot)
+    assert resource_data == snapshot
+    assert bool(repairs) == (repaired != snapshot)
+
+
+@pytest.mark.parametrize("resource_type, resource_data", RESOURCES, ids=[resource_type for resource_type, _ in RESOURCES])
+def test_repaired_resources_are_returned_as_is(resource_type, resource_data):
+    repaired, _ = repair_rule_set.apply(resource_type, resource_data)
+
+    assert repair_rule_set.apply(resource_type, repaired) == (repaired, [])
+    assert repair_rule_set.apply(resource_type, repaired)[0] is repaired
+
+
+def test_unchanged_elements_are_shared_with_the_input():
+    _, resource_data = RESOURCES[3]
+
+    repaired, _ = repair_rule_set.apply("ServiceRequest", resource_data)
+
+    assert repaired is not resource_data
+    assert repaired["subject"] is resource_data["subject"]
+    assert repaired["occurrenceTiming"] is not resource_data["occurrenceTiming"]
+
+
+def test_rules_are_reported_once_per_element_path():
+    resource_data = {"resourceType": "Condition", "note": [{"text": "a", "time": "2021-01-01T10:00:00"}, {"text": "b", "time": "2021-01-02T10:00:00"}]}
+
+    repaired, repairs = repair_rule_set.apply("Condition", resource_data)
+
+    assert [note["time"] for note in repaired["note"]] == ["2021-01-01T10:00:00+00:00", "2021-01-02T10:00:00+00:00"]
+    assert [(rule["name"], path) for rule, path in repairs] == [("timezone-aware-datetimes", "note.time")]
+
+
+def test_date_only_and_timezone_aware_values_are_kept():
+    resource_data = {"resourceType": "Condition", "onsetDateTime": "2021-01-01", "recordedDate": "2021-01-02T11:00:00Z"}
+
+    assert repair_rule_set.apply("Condition", resource_data) == (resource_data, [])
+    assert ensure_timezone_aware("2021-13-01") == "2021-13-01"
+    assert ensure_timezone_aware("not a date") == "not a date"
+
+
+def test_unsupported_resource_types_are_not_repaired():
+    resource_data = {"resourceType": "Device", "period": {"start": "2021-01-01T10:00:00"}}
+
+    assert repair_rule_set.apply("Device", resource_data) == (resource_data, [])
+
+
+def test_unknown_actions_are_rejected():
+    with pytest.raises(ValueError):
+        RepairRuleSet([{"name": "bad", "resource_types": ["*"], "path": "id", "action": "rewrite"}])
+
+
+@pytest.mark.parametrize("code", [
+    {"concept": {"coding": [{"code": "363680008"}], "text": "X-ray"}},
+    {"reference": {"reference": "ActivityDefinition/x-ray"}}
+])
+def test_service_request_code_is_kept_when_already_a_codeable_reference(code):
+    resource_data = {"resourceType": "ServiceRequest", "status": "active", "intent": "order", "code": code}
+
+    assert repair_rule_set.apply("ServiceRequest", resource_data) == (resource_data, [])
+
+
+def test_offline_service_request_keeps_its_code():
+    resource_data = generate_offline_resource("ServiceRequest", "p1", rng=random.Random(1))
+    snapshot = copy.deepcopy(resource_data)
+
+    validation_result, repaired = validate_individual_fhir_resource("ServiceRequest", resource_data)
+
+    assert validation_result["status"] == "success"
+    assert repaired["code"] == snapshot["code"]
+    assert "service-request-code" not in validation_result.get("repair_rules", [])
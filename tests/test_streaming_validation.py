@@ -0,0 +1,168 @@
+import io
+import json
+from types import SimpleNamespace
+import pytest
+import fhir_data_validation.streaming_validation as streaming_validation
+from fhir_data_validation.streaming_validation import StreamingJsonReader, decode_chunks, iter_bundle_entries, iter_ndjson_resources
+
+
+# Function to split a text (or bytes) into chunks of the given size
+def split(data, chunk_size):
+    return [data[index:index + chunk_size] for index in range(0, len(data), chunk_size)]
+
+
+BUNDLE = {
+    "resourceType": "Bundle",
+    "id": "bundle-1",
+    "type": "collection",
+    "entry": [
+        {"resource": {"resourceType": "Patient", "id": "p1", "name": [{"family": "Müller", "given": ["Zoë"]}], "birthDate": "1980-01-01"}},
+        {"resource": {"resourceType": "Observation", "id": "o1", "valueQuantity": {"value": 12345.678e-2, "unit": "mg"}, "note": [{"text": "a \"quoted\" } ] , : text \\ é 😀"}]}},
+        {"resource": {"resourceType": "Condition", "id": "c1", "onsetDateTime": "2021-01-01T10:00:00", "abatementBoolean": False, "stage": []}},
+        {"fullUrl": "urn:uuid:1", "resource": {"resourceType": "Encounter", "id": 7, "priority": None}}
+    ],
+    "meta": {"lastUpdated": "2024-01-01T00:00:00Z"},
+    "total": 4
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 100000])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_bundle_entries_match_json_load(chunk_size, indent):
+    text = json.dumps(BUNDLE, indent=indent, ensure_ascii=False)
+    expected = json.load(io.StringIO(text))
+
+    bundle_fields = {}
+    entries = list(iter_bundle_entries(split(text, chunk_size), bundle_fields))
+
+    assert entries == expected["entry"]
+    assert bundle_fields == {key: value for key, value in expected.items() if key != "entry"}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3])
+def test_fields_before_entry_are_known_at_the_first_entry(chunk_size):
+    bundle_fields = {}
+    entries = iter_bundle_entries(split(json.dumps(BUNDLE), chunk_size), bundle_fields)
+
+    next(entries)
+    assert bundle_fields == {"resourceType": "Bundle", "id": "bundle-1", "type": "collection"}
+
+
+@pytest.mark.parametrize("text", ['{}', '{"entry": []}', ' {\n "type" : "batch" ,\n "entry" : [ ] } \n'])
+def test_bundles_without_entries(text):
+    bundle_fields = {}
+
+    assert list(iter_bundle_entries(split(text, 1), bundle_fields)) == []
+    assert bundle_fields == {key: value for key, value in json.loads(text).items() if key != "entry"}
+
+
+@pytest.mark.parametrize("text", [
+    '{"entry": [{"a": 1}, {"b": 2}',
+    '{"entry": [{"a": 1}}',
+    '{"entry": [{"a": 1}]} {"entry": []}',
+    '[{"a": 1}]',
+    '{"entry": [{"a": tru}]}'
+])
+def test_invalid_bundles_raise(text):
+    with pytest.raises(ValueError):
+        list(iter_bundle_entries(split(text, 2), {}))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5])
+def test_numbers_split_across_chunks(chunk_size):
+    reader = StreamingJsonReader(split("[123456789, -0.5e10]", chunk_size))
+
+    assert reader.read_value() == [123456789, -0.5e10]
+    assert reader.peek() == ""
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 1000])
+def test_ndjson_resources_match_json_loads(chunk_size):
+    lines = [json.dumps(entry["resource"], ensure_ascii=False) for entry in BUNDLE["entry"]]
+    text = "\n".join(lines[:2]) + "\n\n  \n" + "\r\n".join(lines[2:])
+
+    resources = list(iter_ndjson_resources(split(text, chunk_size)))
+
+    assert resources == [json.loads(line) for line in lines]
+
+
+def test_unreadable_ndjson_lines_are_none():
+    text = '{"resourceType": "Patient"}\n{"resourceType": \n{"resourceType": "Condition"}'
+
+    assert list(iter_ndjson_resources(split(text, 4))) == [{"resourceType": "Patient"}, None, {"resourceType": "Condition"}]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3])
+def test_utf8_characters_split_across_byte_chunks(chunk_size):
+    text = json.dumps(BUNDLE, ensure_ascii=False)
+    data = "\ufeff".encode("utf-8") + text.encode("utf-8")
+
+    assert "".join(decode_chunks(split(data, chunk_size))) == text
+
+
+# Container standing in for Blob Storage, recording the blobs opened for writing and the committed ones
+class FakeContainer:
+    def __init__(self):
+        self.opened = []
+        self.staged = {}
+        self.committed = {}
+
+    def get_blob_client(self, blob_name):
+        self.opened.append(blob_name)
+        return SimpleNamespace(
+            url=f"https://blob/{blob_name}",
+            stage_block=lambda block_id, data: self.staged.setdefault(blob_name, {}).__setitem__(block_id, data),
+            commit_block_list=lambda blocks, **options: self.committed.__setitem__(blob_name, b"".join(self.staged[blob_name][block.id] for block in blocks))
+        )
+
+
+@pytest.fixture
+def container(monkeypatch):
+    fake_container = FakeContainer()
+    monkeypatch.setattr(streaming_validation, "getContainerClient", lambda *args: fake_container)
+    monkeypatch.setattr(streaming_validation, "GZIP_BLOBS", False)
+    return fake_container
+
+
+# Function to build a bundle of patients whose meta.lastUpdated needs a timezone, invalid at the given indexes
+def build_patient_bundle(count, invalid_indexes=()):
+    return {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [
+            {"fullUrl": f"urn:uuid:p{index}", "resource": {
+                "resourceType": "Patient", "id": f"p{index}", "meta": {"lastUpdated": "2024-01-01T10:00:00"},
+                "gender": 5 if index in invalid_indexes else "female"
+            }}
+            for index in range(count)
+        ]
+    }
+
+
+def validate_file(tmp_path, bundle):
+    file_path = tmp_path / "bundle.json"
+    file_path.write_text(json.dumps(bundle))
+    return json.loads(streaming_validation.validate_fhir_file_streaming(str(file_path)).get_body())
+
+
+@pytest.mark.parametrize("hold_size", [0, 10 ** 9])
+def test_repaired_only_input_uploads_nothing(tmp_path, container, monkeypatch, hold_size):
+    monkeypatch.setattr(streaming_validation, "STREAM_HOLD_SIZE", hold_size)
+
+    response = validate_file(tmp_path, build_patient_bundle(20))
+
+    assert "re_validation" not in response
+    assert response["initial_validation"]["summary"]["repaired"] == 20
+    assert container.opened == []
+
+
+@pytest.mark.parametrize("hold_size", [0, 200, 10 ** 9])
+def test_output_after_a_late_error_is_repaired(tmp_path, container, monkeypatch, hold_size):
+    monkeypatch.setattr(streaming_validation, "STREAM_HOLD_SIZE", hold_size)
+
+    response = validate_file(tmp_path, build_patient_bundle(20, invalid_indexes=(18,)))
+
+    assert response["re_validation"]["summary"]["invalid"] == 1
+    output = json.loads(container.committed[container.opened[0]])
+    assert [entry["resource"]["meta"]["lastUpdated"] for entry in output["entry"]] == ["2024-01-01T10:00:00+00:00"] * 20
+    assert output["type"] == "collection"